@@ -1,9 +1,13 @@
+from collections import OrderedDict
+from dataclasses import dataclass
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
 from sqlalchemy.orm import Session
-from .database import get_db
+from typing import Callable, Dict, List, Optional, Set
+import time
+from .database import get_read_db, run_db
 from .models import User
 from .schemas import TokenData
 import os
@@ -13,6 +17,13 @@ SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production-pleas
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# Кэш проверенных токенов
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_TTL_SECONDS = float(os.getenv("TOKEN_CACHE_TTL_SECONDS", "60"))
+
+# Пользователи с доступом к служебным эндпоинтам /admin (id через запятую)
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv("ADMIN_USER_IDS", "").split(",") if user_id.strip()}
+
 # OAuth2 схема для получения токена
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
@@ -45,10 +56,96 @@ def verify_token(token: str = Depends(oauth2_scheme)) -> TokenData:
         raise credentials_exception
     return token_data
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> User:
+@dataclass(frozen=True)
+class Principal:
+    """Пользователь запроса (без привязки к сессии БД)"""
+    id: int
+    username: str
+
+class TokenCache:
+    """LRU кэш: токен -> Principal.
+
+    Запись живет не дольше TOKEN_CACHE_TTL_SECONDS и не дольше exp самого токена.
+    При деактивации пользователя (is_active=False) все его токены удаляются.
+    """
+
+    def __init__(self, max_size: int = TOKEN_CACHE_SIZE, ttl: float = TOKEN_CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._by_user: Dict[int, Set[str]] = {}
+        self._listeners: List[Callable[[int], None]] = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def add_listener(self, listener: Callable[[int], None]):
+        """Вызывается при каждом сбросе пользователя (например, для оповещения других воркеров)"""
+        self._listeners.append(listener)
+
+    def get(self, token: str) -> Optional[Principal]:
+        entry = self._entries.get(token)
+        if entry is None:
+            self.misses += 1
+            return None
+        principal, expires_at = entry
+        if expires_at <= time.time():
+            self._remove(token)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(token)
+        self.hits += 1
+        return principal
+
+    def put(self, token: str, principal: Principal, token_exp: Optional[float] = None):
+        if self.max_size <= 0:
+            return
+        expires_at = time.time() + self.ttl
+        if token_exp is not None:
+            expires_at = min(expires_at, token_exp)
+        self._remove(token)
+        self._entries[token] = (principal, expires_at)
+        self._by_user.setdefault(principal.id, set()).add(token)
+        while len(self._entries) > self.max_size:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def invalidate_user(self, user_id: int, notify: bool = True):
+        for token in list(self._by_user.get(user_id, ())):
+            self._remove(token)
+        if notify:
+            for listener in self._listeners:
+                listener(user_id)
+
+    def clear(self):
+        self._entries.clear()
+        self._by_user.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def _remove(self, token: str):
+        entry = self._entries.pop(token, None)
+        if entry is None:
+            return
+        tokens = self._by_user.get(entry[0].id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._by_user[entry[0].id]
+
+token_cache = TokenCache()
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_read_db)) -> Principal:
     """
-    Получение текущего пользователя из токена
+    Получение текущего пользователя из токена (запрос к БД идет в пуле потоков).
+    Проверенные токены кэшируются, повторные запросы не декодируют JWT и не ходят в БД.
     """
+    principal = token_cache.get(token)
+    if principal is not None:
+        return principal
+    
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -62,8 +159,15 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     except JWTError:
         raise credentials_exception
     
-    user = db.query(User).filter(User.username == username).first()
+    user = await run_db(lambda: db.query(User).filter(User.username == username).first())
     if user is None:
         raise credentials_exception
-    return user
+    principal = Principal(id=user.id, username=user.username)
+    token_cache.put(token, principal, payload.get("exp"))
+    return principal
 
+async def get_admin_user(current_user: Principal = Depends(get_current_user)) -> Principal:
+    """Текущий пользователь, если он указан в ADMIN_USER_IDS"""
+    if current_user.id not in ADMIN_USER_IDS:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+    return current_user
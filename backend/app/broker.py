@@ -0,0 +1,339 @@
+"""Брокер сообщений между процессами uvicorn.
+
+InMemoryBroker - один процесс, доставка только локальная.
+UnixSocketBroker - несколько воркеров на одной машине (или в контейнерах с общим
+volume для сокета): воркеры подключаются к серверу брокера, который хранит, на каких воркерах
+онлайн каждый пользователь, и пересылает кадры туда, где есть его сессии.
+
+Сервер запускается отдельным процессом:
+    python -m app.broker
+Протокол - JSON построчно через Unix-сокет.
+"""
+import asyncio
+import json
+import os
+import time
+from typing import Callable, Dict, List, Optional, Set
+from .persistence import id_generator
+from .log import get_logger, setup_logging
+from .protocol import OutgoingFrame
+
+# memory - один процесс; unix:///path/to/socket - общий брокер для нескольких воркеров
+BROKER_URL = os.getenv("BROKER_URL", "memory")
+BROKER_RECONNECT_SECONDS = float(os.getenv("BROKER_RECONNECT_SECONDS", "1"))
+# Максимальный размер строки протокола (SDP и пачки сообщений бывают большими)
+BROKER_MAX_FRAME = int(os.getenv("BROKER_MAX_FRAME", str(16 * 1024 * 1024)))
+# Предел неотправленных байт в сокет брокера: соединение с зависшей стороной разрывается,
+# а не копит кадры в памяти (после переподключения воркер заново передает присутствие)
+BROKER_WRITE_BUFFER = int(os.getenv("BROKER_WRITE_BUFFER", str(64 * 1024 * 1024)))
+# Сколько секунд номер отключившегося воркера не выдается другим: воркер переподключается с тем же номером
+BROKER_WORKER_ID_HOLD_SECONDS = float(os.getenv("BROKER_WORKER_ID_HOLD_SECONDS", "300"))
+MAX_WORKERS = 16
+
+log = get_logger("broker")
+
+
+class WorkerIdTaken(ConnectionError):
+    """Брокер отказал в номере, выданном воркеру при первом подключении"""
+
+
+class InMemoryBroker:
+    """Брокер для одного процесса: других воркеров нет"""
+
+    distributed = False
+
+    def __init__(self):
+        self.worker_id = 0
+        self.hub = None
+        self._handlers: Dict[str, List[Callable[[dict], None]]] = {}
+
+    async def start(self, hub):
+        self.hub = hub
+
+    async def stop(self):
+        pass
+
+    def remote_online(self, user_id: int) -> bool:
+        return False
+
+    def set_presence(self, user_id: int, online: bool):
+        pass
+
+    def deliver(self, user_id: int, text: str, frame_type: Optional[str] = None, message_id: Optional[int] = None):
+        pass
+
+    def subscribe(self, channel: str, handler: Callable[[dict], None]):
+        """Обработчик событий канала от других воркеров"""
+        self._handlers.setdefault(channel, []).append(handler)
+
+    def publish(self, channel: str, payload: dict):
+        """Событие для остальных воркеров (локальные обработчики не вызываются)"""
+        pass
+
+    def _dispatch(self, channel: str, payload: dict):
+        for handler in self._handlers.get(channel, ()):
+            try:
+                handler(payload)
+            except Exception as e:
+                log.error("broker_handler_failed", exc_info=True, channel=channel, error=str(e))
+
+
+class UnixSocketBroker(InMemoryBroker):
+    """Клиент брокера для воркера uvicorn"""
+
+    distributed = True
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        # user_id -> воркеры, на которых у пользователя есть сессии
+        self._remote: Dict[int, Set[int]] = {}
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._stopping = False
+        # Номер, выданный брокером при первом подключении; при переподключении запрашивается он же
+        self._assigned_id: Optional[int] = None
+
+    async def start(self, hub):
+        self.hub = hub
+        self._stopping = False
+        # До приветствия брокера номер воркера не известен - id не выдаются
+        id_generator.suspend()
+        try:
+            await self._connect()
+        except OSError as e:
+            # Сервер брокера еще не поднялся - ждем его
+            log.warning("broker_unavailable", path=self.path, error=str(e))
+            await self._reconnect()
+        self._reader_task = asyncio.get_running_loop().create_task(self._read_loop())
+
+    async def stop(self):
+        self._stopping = True
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except (asyncio.CancelledError, Exception):
+                pass
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def remote_online(self, user_id: int) -> bool:
+        return bool(self._remote.get(user_id))
+
+    def set_presence(self, user_id: int, online: bool):
+        self._send({"op": "presence", "user_id": user_id, "online": online})
+
+    def deliver(self, user_id: int, text: str, frame_type: Optional[str] = None, message_id: Optional[int] = None):
+        self._send({"op": "deliver", "user_id": user_id, "frame": text, "frame_type": frame_type,
+                    "message_id": message_id})
+
+    def publish(self, channel: str, payload: dict):
+        self._send({"op": "publish", "channel": channel, "payload": payload})
+
+    def _send(self, message: dict):
+        writer = self._writer
+        if writer is None or writer.is_closing():
+            return
+        if writer.transport.get_write_buffer_size() > BROKER_WRITE_BUFFER:
+            log.warning("broker_stalled", path=self.path, buffered=writer.transport.get_write_buffer_size())
+            # close() ждал бы, пока буфер уйдет в сокет
+            writer.transport.abort()
+            return
+        writer.write(json.dumps(message, separators=(",", ":")).encode() + b"\n")
+
+    async def _connect(self):
+        reader, writer = await asyncio.open_unix_connection(self.path, limit=BROKER_MAX_FRAME)
+        self._reader = reader
+        self._writer = writer
+        # После переподключения сообщаем брокеру всех своих онлайн пользователей
+        users = self.hub.local_user_ids() if self.hub is not None else []
+        self._send({"op": "hello", "users": users, "worker_id": self._assigned_id})
+        welcome = json.loads(await reader.readline() or b"{}")
+        if welcome.get("op") != "welcome":
+            writer.close()
+            self._writer = None
+            raise WorkerIdTaken(welcome.get("error", "broker closed connection"))
+        self.worker_id = self._assigned_id = welcome["worker_id"]
+        self._remote = {int(user_id): set(workers) for user_id, workers in welcome["presence"].items()}
+        # Номер воркера входит в id сообщений, чтобы id разных процессов не пересекались
+        id_generator.set_worker_id(self.worker_id)
+        log.info("broker_connected", path=self.path, worker_id=self.worker_id)
+
+    async def _read_loop(self):
+        while not self._stopping:
+            try:
+                line = await self._reader.readline()
+                if not line:
+                    raise ConnectionError("broker closed connection")
+                self._handle(json.loads(line))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("broker_connection_lost", path=self.path, error=str(e))
+                # Пока нет связи, номер могут выдать другому воркеру - id не выдаем
+                id_generator.suspend()
+                self._writer = None
+                self._remote.clear()
+                await self._reconnect()
+
+    async def _reconnect(self):
+        while not self._stopping:
+            await asyncio.sleep(BROKER_RECONNECT_SECONDS)
+            try:
+                await self._connect()
+                return
+            except WorkerIdTaken as e:
+                log.error("broker_worker_id_taken", path=self.path, worker_id=self._assigned_id, error=str(e))
+            except OSError:
+                continue
+
+    def _handle(self, message: dict):
+        op = message.get("op")
+        if op == "deliver":
+            frame = OutgoingFrame.from_text(message["frame"], message.get("frame_type"), message.get("message_id"))
+            self.hub.deliver_local(message["user_id"], frame)
+        elif op == "presence":
+            workers = self._remote.setdefault(message["user_id"], set())
+            if message["online"]:
+                workers.add(message["worker_id"])
+            else:
+                workers.discard(message["worker_id"])
+                if not workers:
+                    del self._remote[message["user_id"]]
+        elif op == "worker_down":
+            worker_id = message["worker_id"]
+            for user_id in list(self._remote):
+                self._remote[user_id].discard(worker_id)
+                if not self._remote[user_id]:
+                    del self._remote[user_id]
+        elif op == "publish":
+            self._dispatch(message["channel"], message["payload"])
+
+
+class BrokerServer:
+    """Сервер брокера: присутствие пользователей по воркерам и маршрутизация кадров"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.workers: Dict[int, asyncio.StreamWriter] = {}
+        self.presence: Dict[int, Set[int]] = {}
+        # Номер отключившегося воркера -> время отключения (monotonic)
+        self.released: Dict[int, float] = {}
+
+    async def serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self._handle_worker, path=self.path, limit=BROKER_MAX_FRAME)
+        os.chmod(self.path, 0o666)
+        log.info("broker_listening", path=self.path)
+        async with server:
+            await server.serve_forever()
+
+    def _allocate_worker_id(self) -> int:
+        """Свободный номер; номера недавно отключившихся воркеров - в последнюю очередь"""
+        free = [worker_id for worker_id in range(MAX_WORKERS) if worker_id not in self.workers]
+        if not free:
+            raise RuntimeError("too many workers connected to broker")
+        hold_until = time.monotonic() - BROKER_WORKER_ID_HOLD_SECONDS
+        for worker_id in free:
+            if self.released.get(worker_id, hold_until) <= hold_until:
+                return worker_id
+        return min(free, key=lambda worker_id: self.released[worker_id])
+
+    def _send(self, worker_id: int, message: dict):
+        writer = self.workers.get(worker_id)
+        if writer is None or writer.is_closing():
+            return
+        if writer.transport.get_write_buffer_size() > BROKER_WRITE_BUFFER:
+            # Воркер не читает: отключаем его, он переподключится и передаст присутствие заново
+            log.warning("worker_stalled", worker_id=worker_id, buffered=writer.transport.get_write_buffer_size())
+            # close() ждал бы, пока буфер уйдет в сокет
+            writer.transport.abort()
+            return
+        writer.write(json.dumps(message, separators=(",", ":")).encode() + b"\n")
+
+    def _set_presence(self, worker_id: int, user_id: int, online: bool):
+        workers = self.presence.setdefault(user_id, set())
+        if online:
+            workers.add(worker_id)
+        else:
+            workers.discard(worker_id)
+            if not workers:
+                del self.presence[user_id]
+        for other in list(self.workers):
+            if other != worker_id:
+                self._send(other, {"op": "presence", "worker_id": worker_id, "user_id": user_id, "online": online})
+
+    async def _handle_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        hello = json.loads(await reader.readline() or b"{}")
+        if hello.get("op") != "hello":
+            writer.close()
+            return
+        worker_id = hello.get("worker_id")
+        if worker_id is None:
+            worker_id = self._allocate_worker_id()
+        elif worker_id in self.workers or not 0 <= worker_id < MAX_WORKERS:
+            # Два воркера с одним номером выдали бы одинаковые id сообщений
+            log.warning("worker_id_refused", worker_id=worker_id)
+            writer.write(json.dumps({"op": "error", "error": f"worker id {worker_id} is taken"}).encode() + b"\n")
+            writer.close()
+            return
+        self.released.pop(worker_id, None)
+        self.workers[worker_id] = writer
+        self._send(worker_id, {
+            "op": "welcome",
+            "worker_id": worker_id,
+            "presence": {user_id: sorted(workers) for user_id, workers in self.presence.items()},
+        })
+        for user_id in hello.get("users", []):
+            self._set_presence(worker_id, user_id, True)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                op = message.get("op")
+                if op == "presence":
+                    self._set_presence(worker_id, message["user_id"], message["online"])
+                elif op == "deliver":
+                    for target in self.presence.get(message["user_id"], ()):
+                        if target != worker_id:
+                            self._send(target, message)
+                elif op == "publish":
+                    for other in list(self.workers):
+                        if other != worker_id:
+                            self._send(other, message)
+        except (ConnectionError, ValueError) as e:
+            log.warning("worker_connection_lost", worker_id=worker_id, error=str(e))
+        finally:
+            del self.workers[worker_id]
+            self.released[worker_id] = time.monotonic()
+            for user_id in list(self.presence):
+                self.presence[user_id].discard(worker_id)
+                if not self.presence[user_id]:
+                    del self.presence[user_id]
+            for other in list(self.workers):
+                self._send(other, {"op": "worker_down", "worker_id": worker_id})
+            writer.close()
+
+
+def create_broker(url: str = BROKER_URL):
+    """Брокер по BROKER_URL"""
+    if url == "memory":
+        return InMemoryBroker()
+    if url.startswith("unix://"):
+        return UnixSocketBroker(url[len("unix://"):])
+    raise ValueError(f"Unsupported BROKER_URL: {url}")
+
+
+broker = create_broker()
+
+
+if __name__ == "__main__":
+    if not BROKER_URL.startswith("unix://"):
+        raise SystemExit("BROKER_URL must be unix:///path/to/socket to run the broker server")
+    setup_logging()
+    asyncio.run(BrokerServer(BROKER_URL[len("unix://"):]).serve())
@@ -0,0 +1,115 @@
+import json
+import os
+import time
+from datetime import datetime
+from typing import Iterable, List, Optional
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from .models import Message, GroupMember, ChangeLog, Call
+from .persistence import id_generator, id_for_time
+
+# Записи моложе этого еще могут быть не закоммичены (фоновая запись сообщений,
+# параллельные транзакции) - курсор /sync не уходит дальше этой границы
+SYNC_SETTLE_SECONDS = float(os.getenv("SYNC_SETTLE_SECONDS", "5"))
+# Максимум сообщений и изменений за один ответ /sync
+SYNC_LIMIT = int(os.getenv("SYNC_LIMIT", "500"))
+# Сколько хранится журнал изменений; с более старым курсором клиент загружает все заново
+CHANGE_LOG_RETENTION_DAYS = float(os.getenv("CHANGE_LOG_RETENTION_DAYS", "30"))
+
+
+def record_change(db: Session, recipients: Iterable[int], kind: str, **data):
+    """Добавить изменение в журнал каждого из recipients (commit делает вызывающий)"""
+    payload = json.dumps(data, ensure_ascii=False, default=str)
+    now = datetime.utcnow()
+    for user_id in set(recipients):
+        db.add(ChangeLog(id=id_generator.next_id(), user_id=user_id, kind=kind, payload=payload, created_at=now))
+
+
+def record_call(db: Session, call: Call):
+    """Состояние звонка для обоих участников"""
+    record_change(
+        db, [call.initiator_id, call.receiver_id], "call",
+        call_id=call.id,
+        initiator_id=call.initiator_id,
+        receiver_id=call.receiver_id,
+        call_type=call.call_type,
+        status=call.status,
+        ended_at=call.ended_at.isoformat() if call.ended_at else None,
+    )
+
+
+def record_friendship(db: Session, friendship, status: Optional[str] = None):
+    """Изменение дружбы для обеих сторон; status='removed' при удалении"""
+    record_change(
+        db, [friendship.user_id, friendship.friend_id], "friendship",
+        friendship_id=friendship.id,
+        user_id=friendship.user_id,
+        friend_id=friendship.friend_id,
+        status=status or friendship.status,
+    )
+
+
+def record_membership(db: Session, group_id: int, user_ids: Iterable[int], action: str,
+                      group_name: Optional[str] = None):
+    """Изменение состава группы (added, removed, left) для затронутых и всех текущих участников"""
+    user_ids = list(user_ids)
+    db.flush()
+    members = [row[0] for row in db.query(GroupMember.user_id).filter(GroupMember.group_id == group_id)]
+    record_change(db, members + user_ids, "group_member",
+                  group_id=group_id, group_name=group_name, user_ids=user_ids, action=action)
+
+
+def oldest_cursor() -> int:
+    """Курсоры старше этого уже не покрываются журналом"""
+    return id_for_time(time.time() - CHANGE_LOG_RETENTION_DAYS * 86400)
+
+
+def current_cursor() -> int:
+    """Курсор, до которого все записи гарантированно видны"""
+    return id_for_time(time.time() - SYNC_SETTLE_SECONDS)
+
+
+def prune_change_log(db: Session) -> int:
+    """Удалить записи журнала старше CHANGE_LOG_RETENTION_DAYS (по первичному ключу)"""
+    deleted = db.query(ChangeLog).filter(ChangeLog.id < oldest_cursor()).delete(synchronize_session=False)
+    db.commit()
+    return deleted
+
+
+def load_sync(db: Session, user_id: int, since: int, limit: int = SYNC_LIMIT):
+    """Сообщения и изменения пользователя с id > since.
+
+    Каждый источник читается по своему индексу не больше limit + 1 строк.
+    Если какой-то источник не уместился, ответ обрезается по наименьшему
+    последнему id среди обрезанных, и курсор встает на него (has_more).
+    Иначе курсор - граница current_cursor(), поэтому самые свежие записи
+    могут прийти повторно, клиент отбрасывает их по id.
+    Возвращает (сообщения, изменения, курсор, has_more).
+    """
+    group_ids = select(GroupMember.group_id).where(GroupMember.user_id == user_id)
+    sources = [
+        db.query(Message).filter(
+            Message.receiver_id == user_id, Message.is_group == False, Message.id > since
+        ).order_by(Message.id).limit(limit + 1).all(),
+        db.query(Message).filter(
+            Message.sender_id == user_id, Message.id > since
+        ).order_by(Message.id).limit(limit + 1).all(),
+        db.query(Message).filter(
+            Message.group_id.in_(group_ids), Message.sender_id != user_id, Message.id > since
+        ).order_by(Message.id).limit(limit + 1).all(),
+        db.query(ChangeLog).filter(
+            ChangeLog.user_id == user_id, ChangeLog.id > since
+        ).order_by(ChangeLog.id).limit(limit + 1).all(),
+    ]
+    bounds = [rows[limit - 1].id for rows in sources if len(rows) > limit]
+    has_more = bool(bounds)
+    bound: Optional[int] = min(bounds) if bounds else None
+
+    messages = {}
+    for rows in sources[:3]:
+        for msg in rows:
+            if bound is None or msg.id <= bound:
+                messages[msg.id] = msg
+    changes: List[ChangeLog] = [row for row in sources[3] if bound is None or row.id <= bound]
+    cursor = bound if has_more else max(since, current_cursor())
+    return sorted(messages.values(), key=lambda msg: msg.id), changes, cursor, has_more
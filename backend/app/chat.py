@@ -1,67 +1,248 @@
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from .models import Message, OfflineMessage
-import json
+from typing import Dict, Optional, Tuple
+from .models import Message, GroupMember, DeliveryCursor, ReadWatermark, ConversationSummary, Friendship
+from .database import run_db
+from .persistence import message_writer, build_message_row, MESSAGE_BATCH_INTERVAL_MS
+from .membership import membership_index
+from .connections import Connection, ConnectionHub
+from .protocol import OutgoingFrame
+from .conversations import DIRECT_CHAT, GROUP_CHAT, apply_read
+from .log import get_logger
+import os
 from datetime import datetime
 
+# Сколько пропущенных сообщений досылается за одно подключение, остальное - через историю
+OFFLINE_REPLAY_LIMIT = int(os.getenv("OFFLINE_REPLAY_LIMIT", "1000"))
+# Сообщений в одном кадре offline_messages
+OFFLINE_REPLAY_CHUNK = int(os.getenv("OFFLINE_REPLAY_CHUNK", "100"))
+# Пауза перед досылкой при нескольких воркерах: за это время их фоновая запись успевает
+# сбросить в БД сообщения с id меньше выданного при подключении
+OFFLINE_REPLAY_SETTLE_MS = float(os.getenv("OFFLINE_REPLAY_SETTLE_MS", str(MESSAGE_BATCH_INTERVAL_MS * 5 + 200)))
+
+log = get_logger("chat")
+
 #Отправка сообщения в бд
-async def handle_message(message_data: dict, sender_id: int, db: Session, user_connections: dict):
+async def handle_message(message_data: dict, sender_id: int, db: Session, hub: ConnectionHub):
     receiver_id = message_data["receiver_id"]
     content = message_data["content"]
     is_group = message_data.get("is_group", False)
     group_id = message_data.get("group_id")
     
-    # Create message in database
-    new_message = Message(
-        sender_id=sender_id,
-        receiver_id=receiver_id,
-        content=content,
-        is_group=is_group,
-        group_id=group_id
-    )
-    db.add(new_message)
-    db.commit()
-    db.refresh(new_message)
+    # id и время выдаются сразу, запись в БД идет пакетами в фоне
+    message_row = build_message_row(sender_id, receiver_id, content, is_group, group_id)
+    if is_group and group_id:
+        return await deliver_group_message(message_row, db, hub)
     
-    # Check if receiver is online
-    if receiver_id in user_connections:
+    # Офлайн получатель получит сообщение из messages при подключении (DeliveryCursor)
+    if hub.is_online(receiver_id):
         # Send message directly
         message_json = {
             "type": "message",
-            "message_id": new_message.id,
+            "message_id": message_row["id"],
             "sender_id": sender_id,
             "content": content,
-            "created_at": new_message.created_at.isoformat(),
+            "created_at": message_row["created_at"].isoformat(),
             "is_group": is_group,
             "group_id": group_id
         }
-        await user_connections[receiver_id].send_json(message_json)
-    else:
-        offline_msg = OfflineMessage(
-            sender_id=sender_id,
-            receiver_id=receiver_id,
-            content=content
-        )
-        db.add(offline_msg)
+        await hub.send_to_user(receiver_id, message_json)
+    
+    return await message_writer.submit(messages=[message_row])
+
+async def deliver_group_message(message_row: dict, db: Session, hub: ConnectionHub):
+    """Рассылка сообщения всем участникам группы.
+
+    Кадр кодируется один раз на протокол (JSON, MessagePack) и ставится в очереди отправки всех сессий онлайн участников,
+    офлайн участники получат сообщение при подключении.
+    """
+    group_id = message_row["group_id"]
+    sender_id = message_row["sender_id"]
+    members = await membership_index.members(group_id, db)
+    if sender_id not in members:
+        log.warning("group_message_rejected", sender_id=sender_id, group_id=group_id, reason="not a member")
+        return None
+    
+    frame = OutgoingFrame({
+        "type": "message",
+        "message_id": message_row["id"],
+        "sender_id": sender_id,
+        "content": message_row["content"],
+        "created_at": message_row["created_at"].isoformat(),
+        "is_group": True,
+        "group_id": group_id
+    }, "message", message_row["id"])
+    
+    online = [user_id for user_id in members if user_id != sender_id and hub.is_online(user_id)]
+    for user_id in online:
+        hub.send_frame_to_user(user_id, frame)
+    return await message_writer.submit(messages=[message_row])
+
+def missed_messages(db: Session, user_id: int, after_id: int, before_id: int, limit: int):
+    """Личные и групповые сообщения пользователю с after_id < id < before_id по возрастанию id.
+
+    Два запроса по индексам (receiver_id, id) и (group_id, id), каждый с limit + 1,
+    чтобы понять, остались ли сообщения сверх limit.
+    """
+    direct = db.query(Message).filter(
+        Message.receiver_id == user_id,
+        Message.is_group == False,
+        Message.id > after_id,
+        Message.id < before_id
+    ).order_by(Message.id).limit(limit + 1).all()
+    group_ids = select(GroupMember.group_id).where(GroupMember.user_id == user_id)
+    grouped = db.query(Message).filter(
+        Message.group_id.in_(group_ids),
+        Message.sender_id != user_id,
+        Message.id > after_id,
+        Message.id < before_id
+    ).order_by(Message.id).limit(limit + 1).all()
+    rows = sorted(direct + grouped, key=lambda msg: msg.id)
+    return rows[:limit], len(rows) > limit
+
+def advance_delivery_cursors(db: Session, delivered: Dict[int, int]):
+    """Сдвинуть курсоры доставки вперед до delivered[user_id] одним commit (назад не сдвигаются)"""
+    if not delivered:
+        return
+    cursors = {
+        cursor.user_id: cursor
+        for cursor in db.query(DeliveryCursor).filter(DeliveryCursor.user_id.in_(list(delivered)))
+    }
+    now = datetime.utcnow()
+    for user_id, message_id in delivered.items():
+        cursor = cursors.get(user_id)
+        if cursor is None:
+            db.add(DeliveryCursor(user_id=user_id, last_message_id=message_id, updated_at=now))
+        elif message_id > cursor.last_message_id:
+            cursor.last_message_id = message_id
+            cursor.updated_at = now
+    db.commit()
+
+async def deliver_offline_messages(connection: Connection, db: Session, upto_id: int,
+                                   limit: int = OFFLINE_REPLAY_LIMIT, chunk_size: int = OFFLINE_REPLAY_CHUNK):
+    """Досылка сообщений, пришедших, пока пользователь был не в сети.
+
+    Берутся сообщения из messages между курсором доставки и upto_id (id, выданный
+    при подключении - все, что новее, приходит обычной доставкой). Отправляются
+    кадрами offline_messages по chunk_size, за подключение не больше limit;
+    если осталось больше, в последнем кадре truncated=True и остаток клиент
+    догружает через историю. Курсор здесь не сдвигается: при отключении он встает
+    на последнее сообщение, кадр которого действительно ушел в сокет (Connection.delivered_id);
+    живые кадры учитываются в нем только после записи последнего кадра досылки.
+    """
+    user_id = connection.user_id
+
+    def load():
+        cursor = db.get(DeliveryCursor, user_id)
+        after_id = cursor.last_message_id if cursor else 0
+        return missed_messages(db, user_id, after_id, upto_id, limit)
+
+    rows, truncated = await run_db(load)
+    connection.end_replay(rows[-1].id if rows else None)
+    if rows:
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            final = start + chunk_size >= len(rows)
+            await connection.send_json({
+                "type": "offline_messages",
+                "messages": [
+                    {
+                        "message_id": msg.id,
+                        "sender_id": msg.sender_id,
+                        "content": msg.content,
+                        "created_at": msg.created_at.isoformat(),
+                        "is_group": msg.is_group,
+                        "group_id": msg.group_id
+                    }
+                    for msg in chunk
+                ],
+                "final": final,
+                "truncated": truncated and final
+            })
+    return len(rows)
+
+def advance_read_watermark(db: Session, user_id: int, chat_type: str, chat_id: int, message_id: int) -> bool:
+    """Сдвинуть отметку прочтения вперед одним UPDATE.
+
+    Отметка только растет: False, если она уже не меньше message_id.
+    """
+    updated = db.query(ReadWatermark).filter(
+        ReadWatermark.user_id == user_id,
+        ReadWatermark.chat_type == chat_type,
+        ReadWatermark.chat_id == chat_id,
+        ReadWatermark.last_read_id < message_id
+    ).update({
+        ReadWatermark.last_read_id: message_id,
+        ReadWatermark.updated_at: datetime.utcnow()
+    }, synchronize_session=False)
+    if updated:
+        apply_read(db, user_id, chat_type, chat_id, message_id)
+        db.commit()
+        return True
+    exists = db.query(ReadWatermark.user_id).filter(
+        ReadWatermark.user_id == user_id,
+        ReadWatermark.chat_type == chat_type,
+        ReadWatermark.chat_id == chat_id
+    ).first() is not None
+    if exists:
         db.commit()
-        new_message.is_read = False
+        return False
+    db.add(ReadWatermark(user_id=user_id, chat_type=chat_type, chat_id=chat_id, last_read_id=message_id))
+    apply_read(db, user_id, chat_type, chat_id, message_id)
+    try:
         db.commit()
+    except IntegrityError:
+        # Отметку успел создать параллельный запрос - пробуем сдвинуть еще раз
+        db.rollback()
+        return advance_read_watermark(db, user_id, chat_type, chat_id, message_id)
+    return True
+
+def shares_direct_chat(db: Session, user_id: int, peer_id: int) -> bool:
+    """Есть ли у пользователей переписка (строка в списке чатов) или дружба"""
+    if db.query(ConversationSummary.user_id).filter(
+        ConversationSummary.user_id == user_id,
+        ConversationSummary.chat_type == DIRECT_CHAT,
+        ConversationSummary.chat_id == peer_id
+    ).first() is not None:
+        return True
+    return db.query(Friendship.id).filter(
+        ((Friendship.user_id == user_id) & (Friendship.friend_id == peer_id)) |
+        ((Friendship.user_id == peer_id) & (Friendship.friend_id == user_id)),
+        Friendship.status == "accepted"
+    ).first() is not None
 
-async def deliver_offline_messages(user_id: int, websocket, db: Session):
-    """Сообщение об отключение от сети"""
-    offline_messages = db.query(OfflineMessage).filter(
-        OfflineMessage.receiver_id == user_id,
-        OfflineMessage.delivered == False
+def direct_watermarks(db: Session, user_id: int, peer_id: int) -> Tuple[int, int]:
+    """Отметки прочтения переписки: (моя, собеседника)"""
+    rows = db.query(ReadWatermark.user_id, ReadWatermark.last_read_id).filter(
+        ((ReadWatermark.user_id == user_id) & (ReadWatermark.chat_id == peer_id)) |
+        ((ReadWatermark.user_id == peer_id) & (ReadWatermark.chat_id == user_id)),
+        ReadWatermark.chat_type == DIRECT_CHAT
     ).all()
-    
-    for msg in offline_messages:
-        message_data = {
-            "type": "message",
-            "sender_id": msg.sender_id,
-            "content": msg.content,
-            "created_at": msg.created_at.isoformat(),
-            "is_offline": True
-        }
-        await websocket.send_json(message_data)
-        msg.delivered = True
-        db.commit()
+    marks = dict(rows)
+    return marks.get(user_id, 0), marks.get(peer_id, 0)
+
+def group_watermarks(db: Session, group_id: int) -> Dict[int, int]:
+    """Отметки прочтения всех участников группы: user_id -> last_read_id"""
+    rows = db.query(ReadWatermark.user_id, ReadWatermark.last_read_id).filter(
+        ReadWatermark.chat_type == GROUP_CHAT,
+        ReadWatermark.chat_id == group_id
+    ).all()
+    return dict(rows)
 
+async def send_read_receipt(hub: ConnectionHub, reader_id: int, message_id: int,
+                            peer_id: Optional[int] = None, group_id: Optional[int] = None, db: Session = None):
+    """Уведомить собеседника (или участников группы), что reader_id прочитал все до message_id"""
+    receipt = {
+        "type": "read_receipt",
+        "reader_id": reader_id,
+        "message_id": message_id,
+        "group_id": group_id
+    }
+    if group_id is None:
+        await hub.send_to_user(peer_id, receipt)
+        return
+    frame = OutgoingFrame(receipt, "read_receipt")
+    for user_id in await membership_index.members(group_id, db):
+        if user_id != reader_id and hub.is_online(user_id):
+            hub.send_frame_to_user(user_id, frame)
@@ -0,0 +1,287 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Dict, List, Optional, Union
+from fastapi import WebSocket, WebSocketDisconnect
+from .broker import broker as default_broker
+from .protocol import json_codec, OutgoingFrame
+from .log import get_logger
+from .metrics import frame_received_at, delivery_latency, ws_frames_dropped
+
+# Максимум кадров в очереди отправки одного соединения
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+# Код закрытия для клиента, который не успевает читать (Try Again Later)
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+# Сигнальные кадры звонков уходят раньше накопившихся сообщений чата
+PRIORITY_TYPES = {
+    "call_initiated",
+    "incoming_call",
+    "call_offer",
+    "call_accepted",
+    "call_declined",
+    "ice_candidate",
+    "call_end",
+}
+# Кадры, которые можно потерять при переполнении очереди
+EPHEMERAL_TYPES = {"typing", "presence", "read_receipt"}
+
+log = get_logger("ws")
+
+
+def delivered_message_id(data: dict) -> Optional[int]:
+    """Наибольший id сообщения, которое доставляет кадр (для курсора доставки)"""
+    frame_type = data.get("type")
+    if frame_type == "message":
+        return data.get("message_id")
+    if frame_type == "offline_messages" and data.get("messages"):
+        return data["messages"][-1]["message_id"]
+    return None
+
+
+class Connection:
+    """WebSocket соединение с собственной очередью отправки.
+
+    Отправители только кладут кадр в очередь и не ждут сокет,
+    очередь разбирает отдельная задача-писатель. Сигнальные кадры
+    идут вне очереди сообщений. При переполнении эфемерные кадры
+    отбрасываются, а медленный клиент отключается.
+    Кадры кодируются протоколом, согласованным при подключении (codec).
+    """
+
+    def __init__(self, websocket: WebSocket, user_id: int, queue_size: int = WS_SEND_QUEUE_SIZE, codec=json_codec):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.codec = codec
+        self.queue_size = queue_size
+        self.closed = False
+        self.dropped = 0
+        # Наибольший id сообщения, кадр которого действительно записан в сокет
+        self.delivered_id = 0
+        # Пока досылка не записана целиком, живые кадры не сдвигают delivered_id:
+        # их id новее всей досылки, и курсор перескочил бы недоставленное
+        self.replaying = True
+        self._replay_end: Optional[int] = None
+        self._live_id = 0
+        self._priority = deque()
+        self._normal = deque()
+        self._ready = asyncio.Event()
+        self._writer: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._writer = asyncio.get_running_loop().create_task(self._write_loop())
+
+    async def send_json(self, data: dict):
+        self._put(self.codec.encode(data), data.get("type"), delivered_message_id(data))
+
+    def end_replay(self, last_id: Optional[int]):
+        """Id сообщения в последнем кадре досылки (None - досылать нечего).
+
+        Вызывается до того, как последний кадр досылки поставлен в очередь.
+        """
+        if last_id is None:
+            self._finish_replay()
+        else:
+            self._replay_end = last_id
+
+    def _finish_replay(self):
+        self.replaying = False
+        if self._live_id > self.delivered_id:
+            self.delivered_id = self._live_id
+
+    async def receive(self) -> dict:
+        """Следующий кадр клиента (текстовый или бинарный, по протоколу соединения)"""
+        message = await self.websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+        payload = message.get("bytes")
+        return self.codec.decode(payload if payload is not None else message["text"])
+
+    def enqueue(self, frame: OutgoingFrame) -> bool:
+        """Положить кадр рассылки в очередь. False, если кадр не принят.
+
+        frame.message_id - id доставляемого сообщения: после записи кадра в сокет
+        он учитывается в delivered_id.
+        """
+        if self.closed:
+            return False
+        return self._put(self.codec.frame_payload(frame), frame.type, frame.message_id)
+
+    def _put(self, payload: Union[str, bytes], frame_type: Optional[str], message_id: Optional[int] = None) -> bool:
+        if self.closed:
+            return False
+        if len(self._priority) + len(self._normal) >= self.queue_size:
+            if frame_type in EPHEMERAL_TYPES:
+                self.dropped += 1
+                ws_frames_dropped.inc()
+                return False
+            log.warning("slow_consumer_disconnected", user_id=self.user_id, queued=self.pending_frames())
+            self._disconnect_slow_consumer()
+            return False
+        # Время приема кадра, из-за которого отправляется этот, - для задержки доставки
+        item = (payload, frame_type, frame_received_at.get(), message_id)
+        if frame_type in PRIORITY_TYPES:
+            self._priority.append(item)
+        else:
+            self._normal.append(item)
+        self._ready.set()
+        return True
+
+    def pending_frames(self) -> int:
+        return len(self._priority) + len(self._normal)
+
+    async def close(self):
+        """Остановить писателя; неотправленные кадры отбрасываются"""
+        self.closed = True
+        self._priority.clear()
+        self._normal.clear()
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+            try:
+                await self._writer
+            except (asyncio.CancelledError, Exception):
+                pass
+
+    def _disconnect_slow_consumer(self):
+        self.closed = True
+        self._priority.clear()
+        self._normal.clear()
+        self._ready.set()
+        asyncio.get_running_loop().create_task(self._close_socket(SLOW_CONSUMER_CLOSE_CODE))
+
+    async def _close_socket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    async def _write_loop(self):
+        while not self.closed:
+            if not self._priority and not self._normal:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            payload, frame_type, received_at, message_id = self._priority.popleft() if self._priority else self._normal.popleft()
+            try:
+                if isinstance(payload, bytes):
+                    await self.websocket.send_bytes(payload)
+                else:
+                    await self.websocket.send_text(payload)
+            except Exception:
+                self.closed = True
+                self._priority.clear()
+                self._normal.clear()
+                continue
+            if message_id is not None:
+                if self.replaying and frame_type != "offline_messages":
+                    self._live_id = max(self._live_id, message_id)
+                elif message_id > self.delivered_id:
+                    self.delivered_id = message_id
+                if self.replaying and frame_type == "offline_messages" and message_id == self._replay_end:
+                    self._finish_replay()
+            if received_at is not None:
+                delivery_latency.observe(time.perf_counter() - received_at, (frame_type or "unknown",))
+
+
+class ConnectionHub:
+    """Реестр живых соединений.
+
+    У пользователя может быть несколько сессий (например, ПК и ноутбук),
+    регистрация и удаление - O(1). Отправка пользователю уходит во все его сессии.
+    Пользователи, подключенные к другим воркерам, доступны через брокер.
+    """
+
+    def __init__(self, broker=None):
+        self.broker = broker or default_broker
+        self._all: Dict[Connection, None] = {}
+        self._by_user: Dict[int, Dict[Connection, None]] = {}
+        # Доставленное уже закрытыми сессиями: user_id -> наибольший id сообщения
+        self._delivered: Dict[int, int] = {}
+
+    def register(self, connection: Connection) -> bool:
+        """Добавить соединение. True, если это первая сессия пользователя."""
+        self._all[connection] = None
+        sessions = self._by_user.setdefault(connection.user_id, {})
+        sessions[connection] = None
+        if len(sessions) == 1:
+            self.broker.set_presence(connection.user_id, True)
+            return True
+        return False
+
+    def unregister(self, connection: Connection) -> bool:
+        """Убрать соединение. True, если у пользователя не осталось сессий."""
+        if connection not in self._all:
+            return False
+        del self._all[connection]
+        if connection.delivered_id > self._delivered.get(connection.user_id, 0):
+            self._delivered[connection.user_id] = connection.delivered_id
+        sessions = self._by_user.get(connection.user_id)
+        if sessions is None:
+            return False
+        sessions.pop(connection, None)
+        if sessions:
+            return False
+        del self._by_user[connection.user_id]
+        self.broker.set_presence(connection.user_id, False)
+        return True
+
+    def is_online(self, user_id: int) -> bool:
+        """Онлайн на этом или любом другом воркере"""
+        return user_id in self._by_user or self.broker.remote_online(user_id)
+
+    def is_local(self, user_id: int) -> bool:
+        return user_id in self._by_user
+
+    def sessions(self, user_id: int) -> List[Connection]:
+        return list(self._by_user.get(user_id, ()))
+
+    def delivered_ids(self) -> Dict[int, int]:
+        """user_id -> наибольший id сообщения, записанный в любую из его сессий на этом воркере"""
+        delivered = dict(self._delivered)
+        for connection in self._all:
+            if connection.delivered_id > delivered.get(connection.user_id, 0):
+                delivered[connection.user_id] = connection.delivered_id
+        return delivered
+
+    def pop_delivered_id(self, user_id: int) -> int:
+        """Наибольший id, доставленный закрытыми сессиями пользователя (после закрытия последней)"""
+        return self._delivered.pop(user_id, 0)
+
+    def local_user_ids(self) -> List[int]:
+        return list(self._by_user)
+
+    def connections(self) -> List[Connection]:
+        return list(self._all)
+
+    def __len__(self) -> int:
+        return len(self._all)
+
+    async def send_to_user(self, user_id: int, data: dict) -> int:
+        """Отправить кадр во все сессии пользователя. Возвращает число принявших воркеров/сессий."""
+        if not self.is_online(user_id):
+            return 0
+        frame = OutgoingFrame(data, data.get("type"), delivered_message_id(data))
+        return self.send_frame_to_user(user_id, frame)
+
+    def send_frame_to_user(self, user_id: int, frame: OutgoingFrame) -> int:
+        """Отправить кадр рассылки во все сессии пользователя, в том числе на других воркерах.
+
+        Один OutgoingFrame на всех получателей: JSON текст и MessagePack кодируются по разу.
+        """
+        sent = self.deliver_local(user_id, frame)
+        if self.broker.remote_online(user_id):
+            self.broker.deliver(user_id, frame.text, frame.type, frame.message_id)
+            sent += 1
+        return sent
+
+    def deliver_local(self, user_id: int, frame: OutgoingFrame) -> int:
+        """Отправить кадр только в сессии этого процесса"""
+        sent = 0
+        for connection in list(self._by_user.get(user_id, ())):
+            if connection.enqueue(frame):
+                sent += 1
+        return sent
+
+
+hub = ConnectionHub()
@@ -0,0 +1,216 @@
+from sqlalchemy import and_, case, func, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from typing import Dict, Iterable, List, Optional, Tuple
+from .models import Message, GroupMember, ConversationSummary, ReadWatermark
+
+# Типы чатов в ReadWatermark и ConversationSummary
+DIRECT_CHAT = "direct"
+GROUP_CHAT = "group"
+# Длина текста последнего сообщения в списке чатов
+PREVIEW_LENGTH = 200
+
+
+def _summary_filter(user_id: int, chat_type: str, chat_id: int):
+    return (
+        ConversationSummary.user_id == user_id,
+        ConversationSummary.chat_type == chat_type,
+        ConversationSummary.chat_id == chat_id,
+    )
+
+
+def apply_messages(db: Session, rows: List[dict]):
+    """Обновить строки списка чатов для пачки новых сообщений (в транзакции записи).
+
+    На каждого затронутого пользователя и чат - один UPDATE: последнее сообщение
+    заменяется, только если оно новее записанного (воркеры пишут вперемешку),
+    а непрочитанные увеличиваются на число входящих в пачке новее отметки прочтения
+    (отметку могут сдвинуть, пока сообщение еще ждет записи в очереди).
+    """
+    group_ids = {row["group_id"] for row in rows if row["is_group"] and row["group_id"]}
+    members: Dict[int, List[int]] = {}
+    if group_ids:
+        for user_id, group_id in db.query(GroupMember.user_id, GroupMember.group_id).filter(
+            GroupMember.group_id.in_(group_ids)
+        ):
+            members.setdefault(group_id, []).append(user_id)
+
+    # Отметки прочтения получателей: личные - по отправителям, групповые - всех участников
+    senders = {row["sender_id"] for row in rows if not (row["is_group"] and row["group_id"])}
+    receivers = {row["receiver_id"] for row in rows if not (row["is_group"] and row["group_id"])}
+    conditions = []
+    if senders:
+        conditions.append(and_(ReadWatermark.chat_type == DIRECT_CHAT, ReadWatermark.chat_id.in_(senders),
+                               ReadWatermark.user_id.in_(receivers)))
+    if group_ids:
+        conditions.append(and_(ReadWatermark.chat_type == GROUP_CHAT, ReadWatermark.chat_id.in_(group_ids)))
+    read_upto: Dict[Tuple[int, str, int], int] = {
+        (user_id, chat_type, chat_id): last_read_id
+        for user_id, chat_type, chat_id, last_read_id in db.query(
+            ReadWatermark.user_id, ReadWatermark.chat_type, ReadWatermark.chat_id, ReadWatermark.last_read_id
+        ).filter(or_(*conditions))
+    }
+
+    def unread(user_id: int, chat_type: str, chat_id: int, row: dict) -> int:
+        return int(user_id != row["sender_id"] and row["id"] > read_upto.get((user_id, chat_type, chat_id), 0))
+
+    updates: Dict[Tuple[int, str, int], list] = {}
+
+    def touch(user_id: int, chat_type: str, chat_id: int, row: dict, unread: int):
+        entry = updates.get((user_id, chat_type, chat_id))
+        if entry is None:
+            updates[(user_id, chat_type, chat_id)] = [row, unread]
+            return
+        if row["id"] > entry[0]["id"]:
+            entry[0] = row
+        entry[1] += unread
+
+    for row in rows:
+        if row["is_group"] and row["group_id"]:
+            for user_id in members.get(row["group_id"], ()):
+                touch(user_id, GROUP_CHAT, row["group_id"], row, unread(user_id, GROUP_CHAT, row["group_id"], row))
+        else:
+            touch(row["sender_id"], DIRECT_CHAT, row["receiver_id"], row, 0)
+            if row["receiver_id"] != row["sender_id"]:
+                touch(row["receiver_id"], DIRECT_CHAT, row["sender_id"], row,
+                      unread(row["receiver_id"], DIRECT_CHAT, row["sender_id"], row))
+
+    for (user_id, chat_type, chat_id), (row, count) in updates.items():
+        preview = row["content"][:PREVIEW_LENGTH]
+        newer = ConversationSummary.last_message_id < row["id"]
+        updated = db.query(ConversationSummary).filter(*_summary_filter(user_id, chat_type, chat_id)).update({
+            ConversationSummary.last_message_id: case((newer, row["id"]), else_=ConversationSummary.last_message_id),
+            ConversationSummary.last_sender_id: case((newer, row["sender_id"]), else_=ConversationSummary.last_sender_id),
+            ConversationSummary.last_message_preview: case((newer, preview), else_=ConversationSummary.last_message_preview),
+            ConversationSummary.last_message_at: case((newer, row["created_at"]), else_=ConversationSummary.last_message_at),
+            ConversationSummary.unread_count: ConversationSummary.unread_count + count,
+        }, synchronize_session=False)
+        if not updated:
+            db.add(ConversationSummary(
+                user_id=user_id,
+                chat_type=chat_type,
+                chat_id=chat_id,
+                last_message_id=row["id"],
+                last_sender_id=row["sender_id"],
+                last_message_preview=preview,
+                last_message_at=row["created_at"],
+                unread_count=count,
+            ))
+
+
+def apply_read(db: Session, user_id: int, chat_type: str, chat_id: int, last_read_id: int):
+    """Пересчитать непрочитанные после сдвига отметки прочтения (в транзакции отметки).
+
+    Обычно прочитано все до последнего сообщения и счетчик просто обнуляется;
+    иначе считаются сообщения между отметкой и последним по индексу чата.
+    """
+    summary = db.query(ConversationSummary).filter(*_summary_filter(user_id, chat_type, chat_id)).first()
+    if summary is None:
+        return
+    if last_read_id >= summary.last_message_id:
+        unread = 0
+    elif chat_type == GROUP_CHAT:
+        unread = db.query(func.count(Message.id)).filter(
+            Message.group_id == chat_id,
+            Message.sender_id != user_id,
+            Message.id > last_read_id,
+            Message.id <= summary.last_message_id
+        ).scalar()
+    else:
+        unread = db.query(func.count(Message.id)).filter(
+            Message.sender_id == chat_id,
+            Message.receiver_id == user_id,
+            Message.id > last_read_id,
+            Message.id <= summary.last_message_id
+        ).scalar()
+    summary.unread_count = unread
+
+
+def remove_group(db: Session, group_id: int, user_ids: Optional[Iterable[int]] = None):
+    """Убрать группу из списка чатов участников (всех, если user_ids не задан)"""
+    for model in (ConversationSummary, ReadWatermark):
+        query = db.query(model).filter(model.chat_type == GROUP_CHAT, model.chat_id == group_id)
+        if user_ids is not None:
+            query = query.filter(model.user_id.in_(list(user_ids)))
+        query.delete(synchronize_session=False)
+
+
+def list_conversations(db: Session, user_id: int, before: Optional[int], limit: int):
+    """Чаты пользователя от последнего сообщения к первому, keyset по last_message_id"""
+    query = db.query(ConversationSummary).filter(ConversationSummary.user_id == user_id)
+    if before is not None:
+        query = query.filter(ConversationSummary.last_message_id < before)
+    rows = query.order_by(ConversationSummary.last_message_id.desc()).limit(limit + 1).all()
+    next_cursor = rows[limit - 1].last_message_id if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def backfill_summaries(db: Session):
+    """Заполнить список чатов по уже существующим сообщениям (один раз, на пустой таблице).
+
+    Непрочитанные личные берутся из старого флага is_read, по нему же ставятся
+    отметки прочтения; в группах старой истории все считается прочитанным.
+    """
+    if db.query(ConversationSummary.user_id).first() is not None:
+        return
+    if db.query(Message.id).first() is None:
+        return
+
+    existing_marks = set(db.query(ReadWatermark.user_id, ReadWatermark.chat_type, ReadWatermark.chat_id).all())
+    last_ids = {}
+    for sender_id, receiver_id, last_id in db.query(
+        Message.sender_id, Message.receiver_id, func.max(Message.id)
+    ).filter(Message.is_group == False).group_by(Message.sender_id, Message.receiver_id):
+        for user_id, peer_id in ((sender_id, receiver_id), (receiver_id, sender_id)):
+            key = (user_id, DIRECT_CHAT, peer_id)
+            last_ids[key] = max(last_ids.get(key, 0), last_id)
+    group_last = dict(db.query(Message.group_id, func.max(Message.id)).filter(
+        Message.is_group == True, Message.group_id != None
+    ).group_by(Message.group_id).all())
+    if group_last:
+        for user_id, group_id in db.query(GroupMember.user_id, GroupMember.group_id).filter(
+            GroupMember.group_id.in_(list(group_last))
+        ):
+            last_ids[(user_id, GROUP_CHAT, group_id)] = group_last[group_id]
+            if (user_id, GROUP_CHAT, group_id) in existing_marks:
+                continue
+            db.add(ReadWatermark(user_id=user_id, chat_type=GROUP_CHAT, chat_id=group_id,
+                                 last_read_id=group_last[group_id]))
+
+    unread = {}
+    read_upto = {}
+    for sender_id, receiver_id, is_read, count, last_id in db.query(
+        Message.sender_id, Message.receiver_id, Message.is_read, func.count(Message.id), func.max(Message.id)
+    ).filter(Message.is_group == False).group_by(Message.sender_id, Message.receiver_id, Message.is_read):
+        key = (receiver_id, DIRECT_CHAT, sender_id)
+        if is_read:
+            read_upto[key] = last_id
+        else:
+            unread[key] = count
+    for (user_id, chat_type, chat_id), last_id in read_upto.items():
+        if (user_id, chat_type, chat_id) in existing_marks:
+            continue
+        db.add(ReadWatermark(user_id=user_id, chat_type=chat_type, chat_id=chat_id, last_read_id=last_id))
+
+    messages = {}
+    message_ids = list(set(last_ids.values()))
+    for start in range(0, len(message_ids), 500):
+        for msg in db.query(Message).filter(Message.id.in_(message_ids[start:start + 500])):
+            messages[msg.id] = msg
+    for (user_id, chat_type, chat_id), last_id in last_ids.items():
+        msg = messages[last_id]
+        db.add(ConversationSummary(
+            user_id=user_id,
+            chat_type=chat_type,
+            chat_id=chat_id,
+            last_message_id=msg.id,
+            last_sender_id=msg.sender_id,
+            last_message_preview=msg.content[:PREVIEW_LENGTH],
+            last_message_at=msg.created_at,
+            unread_count=unread.get((user_id, chat_type, chat_id), 0),
+        ))
+    try:
+        db.commit()
+    except IntegrityError:
+        # Параллельно стартующий воркер уже заполнил таблицу
+        db.rollback()
@@ -0,0 +1,163 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+# Уровень журнала: DEBUG включает каждый входящий кадр WebSocket и каждый ICE кандидат
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# json - одна запись JSON на строку, text - для чтения глазами
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# Доля записей, которая попадает в журнал, по событиям: "ws_recv=0.01,ice_candidate=0.1"
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "")
+# Записи сверх очереди отбрасываются, а не блокируют event loop
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# Поля, которые не пишутся в журнал целиком: SDP, ICE кандидаты и тексты сообщений
+REDACTED_FIELDS = {"sdp", "candidate", "content"}
+
+ROOT_LOGGER = "chat"
+
+
+def _parse_sampling(value: str) -> Dict[str, float]:
+    rates = {}
+    for item in value.split(","):
+        event, _, rate = item.partition("=")
+        if event.strip() and rate.strip():
+            rates[event.strip()] = max(0.0, min(1.0, float(rate)))
+    return rates
+
+
+_sampling = _parse_sampling(LOG_SAMPLING)
+
+
+def redact(value):
+    """Копия полей записи без SDP, кандидатов и текстов (вместо них - длина)"""
+    if isinstance(value, dict):
+        return {
+            key: (f"<{len(item)} chars>" if isinstance(item, str) else "<redacted>") if key in REDACTED_FIELDS else redact(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    return value
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        entry.update(redact(getattr(record, "fields", {})))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        fields = " ".join(f"{key}={value}" for key, value in redact(getattr(record, "fields", {})).items())
+        line = f"{self.formatTime(record)} {record.levelname:<7} {record.getMessage()} {fields}".rstrip()
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Кладет запись в очередь как есть: форматирование и JSON - в потоке журнала"""
+
+    def __init__(self, log_queue: queue.SimpleQueue, max_size: int = LOG_QUEUE_SIZE):
+        super().__init__(log_queue)
+        self.max_size = max_size
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        # SimpleQueue без блокировок на put; размер проверяется приблизительно
+        if self.queue.qsize() >= self.max_size:
+            self.dropped += 1
+            return
+        self.queue.put(record)
+
+
+class EventLogger:
+    """Журнал событий: имя события и поля вместо готовой строки.
+
+    Уровень и выборка проверяются до того, как что-либо сериализуется,
+    запись и вывод выполняет отдельный поток.
+    """
+
+    def __init__(self, name: str):
+        self._logger = logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+    def debug(self, event: str, **fields):
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event: str, **fields):
+        self._log(logging.INFO, event, fields)
+
+    def warning(self, event: str, **fields):
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event: str, exc_info=None, **fields):
+        self._log(logging.ERROR, event, fields, exc_info)
+
+    def _log(self, level: int, event: str, fields: dict, exc_info=None):
+        if not self._logger.isEnabledFor(level):
+            return
+        rate = _sampling.get(event)
+        if rate is not None:
+            if random.random() >= rate:
+                return
+            fields["sample_rate"] = rate
+        if exc_info is True:
+            exc_info = sys.exc_info()
+        # Без findCaller: обход стека стоил бы больше самой записи
+        record = self._logger.makeRecord(self._logger.name, level, "", 0, event, (), exc_info, extra={"fields": fields})
+        self._logger.handle(record)
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_handler: Optional[_DroppingQueueHandler] = None
+
+
+def setup_logging():
+    """Журнал chat.* через очередь в фоновый поток, который пишет в stdout"""
+    global _listener, _handler
+    if _listener is not None:
+        return
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(TextFormatter() if LOG_FORMAT == "text" else JsonFormatter())
+    log_queue = queue.SimpleQueue()
+    _handler = _DroppingQueueHandler(log_queue)
+    root = logging.getLogger(ROOT_LOGGER)
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(_handler)
+    root.propagate = False
+    _listener = logging.handlers.QueueListener(log_queue, output)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Дописать очередь и остановить поток журнала"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+        if _handler.dropped:
+            print(f"⚠️ Журнал: очередь была переполнена, отброшено записей: {_handler.dropped}", file=sys.stderr)
+
+
+def get_logger(name: str) -> EventLogger:
+    return EventLogger(name)
@@ -1,18 +1,50 @@
-from fastapi import FastAPI, Depends, HTTPException, WebSocket, WebSocketDisconnect, status
+from fastapi import FastAPI, Depends, HTTPException, Query, WebSocket, WebSocketDisconnect, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
-from typing import List, Dict
+from sqlalchemy import func, select, union_all
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, aliased
+from typing import Dict, Optional
+import asyncio
 import json
+import time
 from datetime import datetime, timedelta
-from .database import engine, Base, SessionLocal, get_db
-from .models import User, Message, Group, GroupMember, Call, OfflineMessage, Friendship
-from .auth import create_access_token, get_current_user
+from .database import SessionLocal, ReadSessionLocal, engine, get_db, get_read_db, init_db, run_db
+from .models import User, Message, Group, GroupMember, Call, OfflineMessage, Friendship, DeliveryCursor
+from .auth import create_access_token, get_current_user, get_admin_user, Principal, token_cache
 from .schemas import UserCreate, MessageCreate, GroupCreate, GroupMemberAdd, FriendRequest
-from .utils import success_response
+from .utils import success_response, error_response, paginated_response, json_response, json_dumps, paginate_keyset, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, STREAM_CHUNK_SIZE
+from .persistence import message_writer, build_message_row, wants_persist_ack, id_generator, IdsUnavailable
+from .membership import membership_index
+from .usernames import username_index, USER_SEARCH_CANDIDATES, USER_SEARCH_RESULTS
+from .chat import (
+    deliver_group_message, deliver_offline_messages, advance_delivery_cursors, OFFLINE_REPLAY_SETTLE_MS,
+    advance_read_watermark, shares_direct_chat, direct_watermarks, group_watermarks, send_read_receipt, DIRECT_CHAT, GROUP_CHAT
+)
+from .conversations import list_conversations, remove_group, backfill_summaries
+from .changes import (
+    record_change, record_call, record_friendship, record_membership,
+    load_sync, oldest_cursor, current_cursor, prune_change_log
+)
+from .search import create_search_index, search_available, search_messages
+from .connections import Connection, hub
+from .protocol import negotiate, codec_for
+from .broker import broker
+from .passwords import password_hasher
+from .metrics import registry, Counter, Gauge, frame_received_at, ws_frames_received
+from .webrtc import count_active_calls
+from .log import get_logger, setup_logging
+from .profiling import SQL_PROFILING, SQL_PROFILE_WINDOW, SQLProfilingMiddleware, profile, route_stats
 
-# Создаем все таблицы в базе данных
-Base.metadata.create_all(bind=engine)
+# Журнал пишет фоновый поток, обработчики кадров только кладут записи в очередь
+setup_logging()
+ws_log = get_logger("ws")
+call_log = get_logger("calls")
+sync_log = get_logger("sync")
+
+# Создаем все таблицы и индексы в базе данных
+init_db()
 
 app = FastAPI(
     title="Chat Messenger API",
@@ -20,6 +52,22 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# Состав групп меняется на любом воркере - сбрасываем кэш у всех
+membership_index.add_listener(lambda group_id: broker.publish("membership", {"group_id": group_id}))
+broker.subscribe("membership", lambda payload: membership_index.invalidate(payload["group_id"], notify=False))
+# Деактивированный пользователь не должен проходить по закэшированному токену ни на одном воркере
+token_cache.add_listener(lambda user_id: broker.publish("auth", {"user_id": user_id}))
+broker.subscribe("auth", lambda payload: token_cache.invalidate_user(payload["user_id"], notify=False))
+# Новый логин должен находиться поиском на всех воркерах
+username_index.add_listener(lambda user_id, username: broker.publish("usernames", {"user_id": user_id, "username": username}))
+broker.subscribe("usernames", lambda payload: username_index.add(payload["user_id"], payload["username"], notify=False))
+
+@app.exception_handler(IdsUnavailable)
+async def ids_unavailable_handler(request, exc: IdsUnavailable):
+    # Нет связи с брокером: запись с новыми id подождет переподключения
+    return json_response(error_response("Сервис временно недоступен, повторите позже", 503),
+                         status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+
 # Единая настройка CORS
 app.add_middleware(
     CORSMiddleware,
@@ -28,81 +76,165 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Профиль SQL каждого запроса: заголовок Server-Timing и сводка в /admin/sql-profile
+if SQL_PROFILING:
+    app.add_middleware(SQLProfilingMiddleware)
+
+# Метрики, которые считаются в момент выдачи /metrics
+registry.register(Gauge(
+    "chat_ws_connections", "Открытые WebSocket соединения на этом воркере", collect=lambda: {(): len(hub)}
+))
+registry.register(Gauge(
+    "chat_ws_send_queue_depth", "Кадры в очередях отправки соединений этого воркера",
+    collect=lambda: {(): sum(connection.pending_frames() for connection in hub.connections())}
+))
+registry.register(Gauge(
+    "chat_message_write_queue_depth", "Записи сообщений, ожидающие пакетного commit",
+    collect=lambda: {(): message_writer.queue_depth()}
+))
+# Кэш проверенных токенов (auth.TokenCache)
+registry.register(Gauge(
+    "chat_token_cache_entries", "Токены в кэше этого воркера", collect=lambda: {(): token_cache.stats()["size"]}
+))
+def token_cache_lookups():
+    stats = token_cache.stats()
+    return {("hit",): stats["hits"], ("miss",): stats["misses"]}
+
+registry.register(Counter(
+    "chat_token_cache_lookups_total", "Проверки токена по кэшу: hit - без запроса к БД", ["result"],
+    collect=token_cache_lookups
+))
+registry.register(Counter(
+    "chat_token_cache_evictions_total", "Токены, вытесненные из переполненного кэша",
+    collect=lambda: {(): token_cache.stats()["evictions"]}
+))
+# Пул хэширования паролей (passwords.PasswordHasher)
+registry.register(Gauge(
+    "chat_password_hash_tasks", "Хэши паролей: ждут в очереди (pending) и считаются (in_progress)", ["state"],
+    collect=lambda: {("pending",): password_hasher.pending, ("in_progress",): password_hasher.in_progress}
+))
 
-# Хранилище соединений
-active_connections: List[WebSocket] = []
-user_connections: Dict[int, WebSocket] = {}
+def password_hash_operations():
+    stats = password_hasher.stats()
+    return {
+        ("hash",): stats["hashed"],
+        ("verify",): stats["verified"],
+        ("rehash",): stats["rehashed"],
+        ("rejected",): stats["rejected"],
+    }
 
-async def handle_chat_message(message_data: dict, sender_id: int, db: Session):
+registry.register(Counter(
+    "chat_password_hash_operations_total", "Операции bcrypt; rejected - отказы 503 из-за переполненной очереди",
+    ["operation"], collect=password_hash_operations
+))
+registry.register(Counter(
+    "chat_password_hash_queue_wait_seconds_total", "Суммарное ожидание свободного воркера bcrypt",
+    collect=lambda: {(): password_hasher.queue_wait_total}
+))
+registry.register(Counter(
+    "chat_password_hash_work_seconds_total", "Суммарное время самих bcrypt",
+    collect=lambda: {(): password_hasher.work_time_total}
+))
+registry.register(Gauge(
+    "chat_password_hash_queue_wait_max_seconds", "Самое долгое ожидание в очереди bcrypt с запуска воркера",
+    collect=lambda: {(): password_hasher.queue_wait_max}
+))
+active_calls = registry.register(Gauge(
+    "chat_active_calls", "Идущие звонки по статусу (по всей базе, одинаково на всех воркерах)", ["status"]
+))
+
+async def handle_chat_message(message_data: dict, sender_id: int, db: Session, connection: Optional[Connection] = None):
     """Обработка текстового сообщения"""
     receiver_id = message_data["receiver_id"]
     content = message_data["content"]
     is_group = message_data.get("is_group", False)
     group_id = message_data.get("group_id")
     
-    new_message = Message(
-        sender_id=sender_id,
-        receiver_id=receiver_id,
-        content=content,
-        is_group=is_group,
-        group_id=group_id
-    )
-    db.add(new_message)
-    db.commit()
-    db.refresh(new_message)
+    # id и время выдаются сразу, запись в БД идет пакетами в фоне
+    message_row = build_message_row(sender_id, receiver_id, content, is_group, group_id)
+    
+    if is_group and group_id:
+        # Рассылка всем участникам группы
+        persisted = await deliver_group_message(message_row, db, hub)
+        if persisted is not None and wants_persist_ack(message_data):
+            asyncio.create_task(send_persist_ack(persisted, sender_id, message_row, message_data.get("client_id"), connection))
+        return
     
-    # Отправляем сообщение получателю, если он онлайн
-    if receiver_id in user_connections:
+    # Отправляем сообщение получателю, если он онлайн; иначе оно будет дослано при подключении
+    if hub.is_online(receiver_id):
         message_json = {
             "type": "message",
-            "message_id": new_message.id,
+            "message_id": message_row["id"],
             "sender_id": sender_id,
             "content": content,
-            "created_at": new_message.created_at.isoformat(),
+            "created_at": message_row["created_at"].isoformat(),
             "is_group": is_group,
             "group_id": group_id
         }
-        await user_connections[receiver_id].send_json(message_json)
+        await hub.send_to_user(receiver_id, message_json)
+    
+    persisted = await message_writer.submit(messages=[message_row])
+    if wants_persist_ack(message_data):
+        asyncio.create_task(send_persist_ack(persisted, sender_id, message_row, message_data.get("client_id"), connection))
+
+async def send_persist_ack(persisted: asyncio.Future, sender_id: int, message_row: dict, client_id=None,
+                           connection: Optional[Connection] = None):
+    """Подтверждение отправителю после записи сообщения в БД (в ту сессию, откуда пришло сообщение)"""
+    try:
+        await persisted
+        ack = {
+            "type": "message_ack",
+            "message_id": message_row["id"],
+            "client_id": client_id,
+            "created_at": message_row["created_at"].isoformat(),
+            "persisted": True
+        }
+    except Exception:
+        ack = {
+            "type": "message_ack",
+            "message_id": message_row["id"],
+            "client_id": client_id,
+            "persisted": False
+        }
+    if connection is not None:
+        await connection.send_json(ack)
     else:
-        # Сохраняем офлайн сообщение
-        offline_msg = OfflineMessage(
-            sender_id=sender_id,
-            receiver_id=receiver_id,
-            content=content,
-            delivered=False
-        )
-        db.add(offline_msg)
-        db.commit()
-        new_message.is_read = False
-        db.commit()
+        await hub.send_to_user(sender_id, ack)
 
-async def handle_call_initiate(call_data: dict, initiator_id: int, db: Session):
+async def handle_call_initiate(call_data: dict, initiator_id: int, db: Session, connection: Optional[Connection] = None):
     """Обработка инициации звонка"""
     receiver_id = call_data["receiver_id"]
     call_type = call_data.get("call_type", "audio")
     
-    new_call = Call(
-        initiator_id=initiator_id,
-        receiver_id=receiver_id,
-        call_type=call_type,
-        status='pending'
-    )
-    db.add(new_call)
-    db.commit()
-    db.refresh(new_call)
-    
-    initiator = db.query(User).filter(User.id == initiator_id).first()
-    initiator_name = initiator.username if initiator else "Пользователь"
+    def create_call():
+        new_call = Call(
+            initiator_id=initiator_id,
+            receiver_id=receiver_id,
+            call_type=call_type,
+            status='pending'
+        )
+        db.add(new_call)
+        db.flush()
+        record_call(db, new_call)
+        db.commit()
     
-    # Инициатору отправляем call_id для последующей отправки offer
-    if initiator_id in user_connections:
-        await user_connections[initiator_id].send_json({
-            "type": "call_initiated",
-            "call_id": new_call.id,
-            "receiver_id": receiver_id,
-        })
+        initiator = db.query(User).filter(User.id == initiator_id).first()
+        return new_call, initiator.username if initiator else "Пользователь"
+
+    new_call, initiator_name = await run_db(create_call)
+    
+    # Инициатору отправляем call_id для последующей отправки offer (только в сессию, начавшую звонок)
+    call_initiated = {
+        "type": "call_initiated",
+        "call_id": new_call.id,
+        "receiver_id": receiver_id,
+    }
+    if connection is not None:
+        await connection.send_json(call_initiated)
+    else:
+        await hub.send_to_user(initiator_id, call_initiated)
     
-    if receiver_id in user_connections:
+    if hub.is_online(receiver_id):
         notification = {
             "type": "incoming_call",
             "call_id": new_call.id,
@@ -111,78 +243,343 @@ async def handle_call_initiate(call_data: dict, initiator_id: int, db: Session):
             "call_type": call_type,
             "timestamp": datetime.utcnow().isoformat()
         }
-        await user_connections[receiver_id].send_json(notification)
+        await hub.send_to_user(receiver_id, notification)
     else:
-        new_call.status = 'offline'
-        db.commit()
+        def mark_offline():
+            new_call.status = 'offline'
+            record_call(db, new_call)
+            db.commit()
+        await run_db(mark_offline)
 
-async def handle_call_response(response_data: dict, user_id: int, db: Session):
+async def handle_call_offer(offer_data: dict, user_id: int, db: Session, connection: Optional[Connection] = None):
+    """Caller отправляет offer -> пересылаем callee"""
+    cid = offer_data.get("call_id")
+    sdp = offer_data.get("sdp")
+    if not (cid and sdp):
+        return
+
+    call = await run_db(lambda: db.query(Call).filter(Call.id == cid).first())
+    if call and call.initiator_id == user_id:
+        if hub.is_online(call.receiver_id):
+            await hub.send_to_user(call.receiver_id, {
+                "type": "call_offer",
+                "call_id": cid,
+                "sdp": sdp,
+            })
+            call_log.info("offer_forwarded", call_id=cid, sender_id=user_id, receiver_id=call.receiver_id)
+        else:
+            call_log.warning("offer_receiver_offline", call_id=cid, sender_id=user_id, receiver_id=call.receiver_id)
+    else:
+        call_log.warning("offer_rejected", call_id=cid, sender_id=user_id, reason="call not found or not initiator")
+
+async def handle_call_response(response_data: dict, user_id: int, db: Session, connection: Optional[Connection] = None):
     """Обработка ответа на звонок"""
     call_id = response_data["call_id"]
     action = response_data["action"]
     sdp = response_data.get("sdp")
     
-    call = db.query(Call).filter(Call.id == call_id).first()
+    def update_call():
+        call = db.query(Call).filter(Call.id == call_id).first()
+        if not call:
+            return None
+        if action == "decline":
+            call.status = "declined"
+            record_call(db, call)
+            db.commit()
+        elif action == "accept":
+            call.status = "accepted"
+            call.ended_at = None
+            record_call(db, call)
+            db.commit()
+        return call
+
+    call = await run_db(update_call)
     if not call:
         return
     
     if action == "decline":
-        call.status = "declined"
-        db.commit()
-        if call.initiator_id in user_connections:
-            await user_connections[call.initiator_id].send_json({
-                "type": "call_declined",
-                "call_id": call_id
-            })
+        await hub.send_to_user(call.initiator_id, {
+            "type": "call_declined",
+            "call_id": call_id
+        })
     elif action == "accept":
-        call.status = "accepted"
-        call.ended_at = None
-        db.commit()
-        print(f"✅ Call {call_id} принят пользователем {user_id}")
-        if call.initiator_id in user_connections:
-            print(f"📤 Отправляю call_accepted с SDP answer от {user_id} к инициатору {call.initiator_id}")
-            await user_connections[call.initiator_id].send_json({
+        if hub.is_online(call.initiator_id):
+            await hub.send_to_user(call.initiator_id, {
                 "type": "call_accepted",
                 "call_id": call_id,
                 "sdp": sdp
             })
+            call_log.info("call_accepted", call_id=call_id, user_id=user_id, initiator_id=call.initiator_id)
         else:
-            print(f"⚠️ Инициатор {call.initiator_id} офлайн, не могу отправить call_accepted")
+            call_log.warning("call_accepted_initiator_offline", call_id=call_id, user_id=user_id, initiator_id=call.initiator_id)
 
-async def handle_ice_candidate(candidate_data: dict, user_id: int, db: Session):
+async def handle_ice_candidate(candidate_data: dict, user_id: int, db: Session, connection: Optional[Connection] = None):
     """Обработка ICE кандидата для WebRTC"""
     call_id = candidate_data["call_id"]
     candidate = candidate_data["candidate"]
     target_user_id = candidate_data["target_user_id"]
     
-    print(f"📨 Пересылка ICE candidate: {user_id} -> {target_user_id}, call_id: {call_id}")
-    
-    if target_user_id in user_connections:
-        await user_connections[target_user_id].send_json({
+    if hub.is_online(target_user_id):
+        await hub.send_to_user(target_user_id, {
             "type": "ice_candidate",
             "call_id": call_id,
             "candidate": candidate,
             "sender_id": user_id
         })
-        print(f"✅ ICE candidate доставлен к {target_user_id}")
+        call_log.debug("ice_candidate", call_id=call_id, sender_id=user_id, target_user_id=target_user_id)
     else:
-        print(f"⚠️ Пользователь {target_user_id} офлайн, ICE candidate не доставлен")
+        call_log.debug("ice_candidate_target_offline", call_id=call_id, sender_id=user_id, target_user_id=target_user_id)
+
+async def handle_call_end(call_data: dict, user_id: int, db: Session, connection: Optional[Connection] = None):
+    """Завершение звонка - уведомляем второго участника"""
+    cid = call_data.get("call_id")
+    if not cid:
+        return
+    def end_call():
+        call = db.query(Call).filter(Call.id == cid).first()
+        if call and call.status != "completed":
+            call.status = "completed"
+            call.ended_at = datetime.utcnow()
+            record_call(db, call)
+            db.commit()
+        return call
+
+    call = await run_db(end_call)
+    if call:
+        other_id = call.receiver_id if call.initiator_id == user_id else call.initiator_id
+        await hub.send_to_user(other_id, {"type": "call_end", "call_id": cid})
+
+async def handle_ws_friend_request(message_data: dict, user_id: int, db: Session, connection: Optional[Connection] = None):
+    """Обработка запроса в друзья через WebSocket"""
+    target_user_id = message_data.get("target_user_id")
+    if not target_user_id:
+        return
+
+    def create_request():
+        friend = db.query(User).filter(User.id == target_user_id).first()
+        if not friend:
+            return None
+        existing = db.query(Friendship).filter(
+            ((Friendship.user_id == user_id) & (Friendship.friend_id == target_user_id)) |
+            ((Friendship.user_id == target_user_id) & (Friendship.friend_id == user_id))
+        ).first()
+        if existing:
+            return None
+
+        friendship = Friendship(
+            user_id=user_id,
+            friend_id=target_user_id,
+            status='pending'
+        )
+        db.add(friendship)
+        db.flush()
+        record_friendship(db, friendship)
+        db.commit()
+        sender = db.query(User).filter(User.id == user_id).first()
+        return sender.username if sender else "Unknown"
+
+    username = await run_db(create_request)
+    if username is not None:
+        await hub.send_to_user(target_user_id, {
+            "type": "friend_request",
+            "from_user_id": user_id,
+            "from_username": username
+        })
+
+async def handle_ws_group_invite(message_data: dict, user_id: int, db: Session, connection: Optional[Connection] = None):
+    """Приглашение в группу через WebSocket"""
+    group_id = message_data.get("group_id")
+    user_login = message_data.get("user_login")
+    if not (group_id and user_login):
+        return
+
+    def add_member():
+        user = db.query(User).filter(User.username == user_login).first()
+        if not user:
+            return None, None
+        existing = db.query(GroupMember).filter(
+            GroupMember.group_id == group_id,
+            GroupMember.user_id == user.id
+        ).first()
+        if existing:
+            return None, None
+
+        new_member = GroupMember(
+            user_id=user.id,
+            group_id=group_id,
+            is_admin=False
+        )
+        db.add(new_member)
+        record_membership(db, group_id, [user.id], "added")
+        db.commit()
+        group = db.query(Group).filter(Group.id == group_id).first()
+        return user, group
+
+    user, group = await run_db(add_member)
+    if user is None:
+        return
+    membership_index.invalidate(group_id)
+
+    await hub.send_to_user(user.id, {
+        "type": "group_invite",
+        "group_id": group_id,
+        "group_name": group.name,
+        "inviter": user.username if user else "Unknown"
+    })
+
+async def handle_ws_remove_from_group(message_data: dict, user_id: int, db: Session, connection: Optional[Connection] = None):
+    """Удаление участника из группы"""
+    group_id = message_data.get("group_id")
+    target_user_id = message_data.get("user_id")
+    if not (group_id and target_user_id):
+        return
+
+    def remove_member():
+        membership = db.query(GroupMember).filter(
+            GroupMember.group_id == group_id,
+            GroupMember.user_id == target_user_id
+        ).first()
+        if not membership:
+            return False
+        db.delete(membership)
+        remove_group(db, group_id, [target_user_id])
+        record_membership(db, group_id, [target_user_id], "removed")
+        db.commit()
+        return True
+
+    if await run_db(remove_member):
+        membership_index.invalidate(group_id)
+        await hub.send_to_user(target_user_id, {
+            "type": "removed_from_group",
+            "group_id": group_id
+        })
+
+async def handle_ws_leave_group(message_data: dict, user_id: int, db: Session, connection: Optional[Connection] = None):
+    """Выход из группы"""
+    group_id = message_data.get("group_id")
+    if not group_id:
+        return
+
+    def leave():
+        membership = db.query(GroupMember).filter(
+            GroupMember.group_id == group_id,
+            GroupMember.user_id == user_id
+        ).first()
+        if not membership:
+            return False
+        db.delete(membership)
+        remove_group(db, group_id, [user_id])
+        record_membership(db, group_id, [user_id], "left")
+        db.commit()
+        return True
+
+    if await run_db(leave):
+        membership_index.invalidate(group_id)
+
+async def handle_ws_delete_group(message_data: dict, user_id: int, db: Session, connection: Optional[Connection] = None):
+    """Удаление группы"""
+    group_id = message_data.get("group_id")
+    if not group_id:
+        return
+
+    group = await run_db(lambda: db.query(Group).filter(Group.id == group_id).first())
+    if not group or group.creator_id != user_id:
+        return
+    members = await membership_index.members(group_id, db)
+
+    def delete():
+        record_change(db, members, "group_deleted", group_id=group_id, group_name=group.name)
+        db.query(GroupMember).filter(GroupMember.group_id == group_id).delete()
+        remove_group(db, group_id)
+        db.delete(group)
+        db.commit()
+
+    await run_db(delete)
+    membership_index.invalidate(group_id)
+
+    # Уведомляем всех участников
+    for member_id in members:
+        await hub.send_to_user(member_id, {
+            "type": "group_deleted",
+            "group_id": group_id
+        })
+
+# Обработчики кадров WebSocket по типу
+async def handle_mark_read(message_data: dict, user_id: int, db: Session, connection: Optional[Connection] = None):
+    """Отметка о прочтении: все сообщения чата до message_id прочитаны"""
+    message_id = message_data.get("message_id")
+    peer_id = message_data.get("peer_id")
+    group_id = message_data.get("group_id")
+    if not isinstance(message_id, int) or message_id <= 0:
+        return
+    # id из будущего пометил бы прочитанным то, что еще не отправлено
+    message_id = min(message_id, id_generator.next_id())
+
+    if group_id:
+        if user_id not in await membership_index.members(group_id, db):
+            return
+        chat_type, chat_id = GROUP_CHAT, group_id
+    elif peer_id:
+        # Иначе read_receipt можно было бы отправить любому пользователю
+        if not isinstance(peer_id, int) or not await run_db(shares_direct_chat, db, user_id, peer_id):
+            return
+        chat_type, chat_id = DIRECT_CHAT, peer_id
+    else:
+        return
+
+    if await run_db(advance_read_watermark, db, user_id, chat_type, chat_id, message_id):
+        await send_read_receipt(hub, user_id, message_id, peer_id=peer_id, group_id=group_id, db=db)
+
+WS_HANDLERS = {
+    "message": handle_chat_message,
+    "call_initiate": handle_call_initiate,
+    "call_offer": handle_call_offer,
+    "call_response": handle_call_response,
+    "ice_candidate": handle_ice_candidate,
+    "call_end": handle_call_end,
+    "friend_request": handle_ws_friend_request,
+    "group_invite": handle_ws_group_invite,
+    "remove_from_group": handle_ws_remove_from_group,
+    "leave_group": handle_ws_leave_group,
+    "delete_group": handle_ws_delete_group,
+    "mark_read": handle_mark_read,
+}
 
 # авторизация
 @app.post("/register", response_model=dict)
 async def register(user: UserCreate, db: Session = Depends(get_db)):
-    existing_user = db.query(User).filter(User.username == user.username).first()
-    if existing_user:
-        raise HTTPException(
+    def username_taken():
+        return db.query(User.id).filter(User.username == user.username).first() is not None
+
+    def username_taken_error():
+        return HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Username already registered"
         )
+
+    if await run_db(username_taken):
+        raise username_taken_error()
     
-    new_user = User(username=user.username)
-    new_user.set_password(user.password)
-    db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    # bcrypt считается в отдельном пуле, event loop не блокируется
+    hashed_password = await password_hasher.hash(user.password)
+
+    def create_user():
+        new_user = User(username=user.username, hashed_password=hashed_password)
+        db.add(new_user)
+        try:
+            db.flush()
+            # Новому пользователю досылается все, что придет до первого подключения
+            db.add(DeliveryCursor(user_id=new_user.id, last_message_id=0))
+            db.commit()
+        except IntegrityError:
+            # Логин успели занять, пока считался хэш
+            db.rollback()
+            raise username_taken_error()
+        db.refresh(new_user)
+        return new_user
+
+    new_user = await run_db(create_user)
+    username_index.add(new_user.id, new_user.username)
     
     return success_response(
         data={"user_id": new_user.id, "username": new_user.username},
@@ -191,22 +588,30 @@ async def register(user: UserCreate, db: Session = Depends(get_db)):
 
 @app.post("/login", response_model=dict)
 async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.username == form_data.username).first()
-    if not user or not user.verify_password(form_data.password):
+    user = await run_db(lambda: db.query(User).filter(User.username == form_data.username).first())
+    if not user or not await password_hasher.verify(form_data.password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
     
+    # Изменилась BCRYPT_ROUNDS - пересчитываем хэш, пока пароль известен
+    new_hash = await password_hasher.rehash_if_needed(form_data.password, user.hashed_password)
+
+    def activate():
+        if new_hash:
+            user.hashed_password = new_hash
+        user.is_active = True
+        db.commit()
+
+    await run_db(activate)
+    
     access_token_expires = timedelta(minutes=30)
     access_token = create_access_token(
         data={"sub": user.username}, expires_delta=access_token_expires
     )
     
-    user.is_active = True
-    db.commit()
-    
     return success_response(
         data={
             "access_token": access_token,
@@ -217,140 +622,301 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session =
         message="Login successful"
     )
 
+def user_to_dict(user) -> dict:
+    is_online = hub.is_online(user.id)
+    return {
+        "id": user.id,
+        "username": user.username,
+        "is_online": is_online,
+        "status": "online" if is_online else "offline"
+    }
+
 # поиск пользователей 
 @app.get("/users/search", response_model=dict)
 async def search_users(
     q: str,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: Principal = Depends(get_current_user),
+    db: Session = Depends(get_read_db)
 ):
-    """Поиск пользователей по логину"""
+    """Поиск пользователей по логину: точное совпадение, затем по префиксу, затем по подстроке"""
     if not q or len(q) < 2:
         return success_response(data=[])
     
-    users = db.query(User).filter(
-        User.username.ilike(f"%{q}%"),
-        User.id != current_user.id,
-        User.is_active == True
-    ).limit(20).all()
-    
-    users_list = [
-        {
-            "id": user.id,
-            "username": user.username,
-            "is_online": user.id in user_connections,
-            "status": "online" if user.id in user_connections else "offline"
-        }
-        for user in users
-    ]
-    
-    return success_response(data=users_list)
+    # Кандидаты - из индекса в памяти, из БД только is_active по первичному ключу.
+    # Если неактивные отсеяли слишком многих, индекс запрашивается глубже
+    def load_active(ids):
+        rows = []
+        for start in range(0, len(ids), USER_SEARCH_CANDIDATES):
+            chunk = ids[start:start + USER_SEARCH_CANDIDATES]
+            rows += db.query(User).filter(User.id.in_(chunk), User.is_active == True).all()
+        return rows
+    
+    users = []
+    checked = set()
+    limit = USER_SEARCH_CANDIDATES
+    while True:
+        candidate_ids = username_index.search(q, limit=limit, exclude=current_user.id)
+        fresh_ids = [user_id for user_id in candidate_ids if user_id not in checked]
+        if fresh_ids:
+            checked.update(fresh_ids)
+            users += await run_db(load_active, fresh_ids)
+        if len(users) >= USER_SEARCH_RESULTS or len(candidate_ids) < limit:
+            break
+        limit *= 4
+    rank = {user_id: n for n, user_id in enumerate(candidate_ids)}
+    users = sorted(users, key=lambda user: rank[user.id])[:USER_SEARCH_RESULTS]
+    
+    return json_response(success_response(data=[user_to_dict(user) for user in users]))
 
 @app.get("/users", response_model=dict)
 async def get_users(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    after: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    stream: bool = False,
+    current_user: Principal = Depends(get_current_user),
+    db: Session = Depends(get_read_db)
 ):
-    users = db.query(User).filter(
-        User.id != current_user.id,
-        User.is_active == True
-    ).all()
-    
-    users_list = [
-        {
-            "id": user.id,
-            "username": user.username,
-            "is_online": user.id in user_connections,
-            "status": "online" if user.id in user_connections else "offline"
-        }
-        for user in users
-    ]
-    
-    return success_response(data=users_list)
+    """Активные пользователи по возрастанию id, постранично (курсор after).
+
+    stream=true - все пользователи после after одним ответом NDJSON (строка на пользователя),
+    строки читаются серверным курсором порциями STREAM_CHUNK_SIZE.
+    """
+    filters = (User.is_active == True, User.id != current_user.id)
+    if stream:
+        query = select(User.id, User.username).where(*filters, User.id > (after or 0)).order_by(User.id)
+        return StreamingResponse(stream_users(query), media_type="application/x-ndjson")
+
+    users, next_cursor = await run_db(
+        lambda: paginate_keyset(db.query(User.id, User.username).filter(*filters), User.id, None, after or 0, limit)
+    )
+    return json_response(paginated_response([user_to_dict(user) for user in users], next_cursor))
+
+async def stream_users(query):
+    """Строки NDJSON из серверного курсора: в памяти не больше одной порции"""
+    # Своя сессия: зависимость get_read_db закрывается раньше, чем отдается тело ответа
+    db = ReadSessionLocal()
+    try:
+        result = await run_db(lambda: db.execute(
+            query.execution_options(stream_results=True, yield_per=STREAM_CHUNK_SIZE)
+        ))
+        while True:
+            rows = await run_db(result.fetchmany, STREAM_CHUNK_SIZE)
+            if not rows:
+                break
+            yield b"".join(json_dumps(user_to_dict(row)) + b"\n" for row in rows)
+    finally:
+        await run_db(db.close)
+
+def check_page_cursors(before: Optional[int], after: Optional[int]):
+    """before и after взаимоисключающие"""
+    if before is not None and after is not None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Use either before or after, not both"
+        )
+
+def message_to_dict(msg: Message, is_read: Optional[bool] = None) -> dict:
+    """Сообщение для ответа json_response (created_at сериализуется в ISO при кодировании)"""
+    data = {
+        "id": msg.id,
+        "sender_id": msg.sender_id,
+        "receiver_id": msg.receiver_id,
+        "content": msg.content,
+        "is_read": is_read,
+        "created_at": msg.created_at,
+        "is_group": msg.is_group,
+        "group_id": msg.group_id
+    }
+    if is_read is None:
+        # Прочтение не вычислялось (например, в /sync)
+        del data["is_read"]
+    return data
+
+# Объявлен до /messages/{user_id}, иначе "search" разбирается как user_id
+@app.get("/messages/search", response_model=dict)
+async def search_user_messages(
+    q: str,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    current_user: Principal = Depends(get_current_user),
+    db: Session = Depends(get_read_db)
+):
+    """Полнотекстовый поиск по личным перепискам и группам пользователя, от самых релевантных.
+
+    snippet - фрагмент сообщения в HTML (текст экранирован, совпадения в <mark>).
+    """
+    if not search_available():
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Message search is not available"
+        )
+    try:
+        found, next_cursor = await run_db(search_messages, db, current_user.id, q, cursor, limit)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+    return json_response(paginated_response(
+        [{**message_to_dict(msg), "snippet": snippet} for msg, snippet in found],
+        next_cursor
+    ))
 
 @app.get("/messages/{user_id}", response_model=dict)
 async def get_messages(
     user_id: int,
-    current_user: User = Depends(get_current_user),
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    current_user: Principal = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    """история сообщений 1на1"""
-    messages = db.query(Message).filter(
-        ((Message.sender_id == current_user.id) & (Message.receiver_id == user_id)) |
-        ((Message.sender_id == user_id) & (Message.receiver_id == current_user.id))
-    ).order_by(Message.created_at).all()
-    
-    messages_list = [
-        {
-            "id": msg.id,
-            "sender_id": msg.sender_id,
-            "receiver_id": msg.receiver_id,
-            "content": msg.content,
-            "is_read": msg.is_read,
-            "created_at": msg.created_at.isoformat(),
-            "is_group": msg.is_group,
-            "group_id": msg.group_id
-        }
-        for msg in messages
-    ]
+    """история сообщений 1на1, постранично от новых к старым"""
+    check_page_cursors(before, after)
     
-    # помечаем личные входящие сообщения как прочитанные
-    unread = db.query(Message).filter(
-        Message.sender_id == user_id,
-        Message.receiver_id == current_user.id,
-        Message.is_read == False
-    ).all()
-    
-    for msg in unread:
-        msg.is_read = True
-    db.commit()
-    
-    return success_response(data=messages_list)
+    def load_page():
+        query = db.query(Message).filter(
+            ((Message.sender_id == current_user.id) & (Message.receiver_id == user_id)) |
+            ((Message.sender_id == user_id) & (Message.receiver_id == current_user.id))
+        )
+        messages, next_cursor = paginate_keyset(query, Message.id, before, after, limit)
+        my_mark, peer_mark = direct_watermarks(db, current_user.id, user_id)
+        messages_list = [
+            message_to_dict(msg, msg.id <= (peer_mark if msg.sender_id == current_user.id else my_mark))
+            for msg in messages
+        ]
+    
+        # Открыта последняя страница - входящие на ней прочитаны, сдвигаем отметку
+        newest_incoming = max((msg.id for msg in messages if msg.sender_id == user_id), default=0)
+        if before is None and after is None and newest_incoming > my_mark:
+            if advance_read_watermark(db, current_user.id, DIRECT_CHAT, user_id, newest_incoming):
+                return messages_list, next_cursor, newest_incoming
+        return messages_list, next_cursor, None
+    
+    messages_list, next_cursor, read_upto = await run_db(load_page)
+    if read_upto:
+        await send_read_receipt(hub, current_user.id, read_upto, peer_id=user_id)
+    return json_response(paginated_response(messages_list, next_cursor))
 
 
 @app.get("/groups/{group_id}/messages", response_model=dict)
 async def get_group_messages(
     group_id: int,
-    current_user: User = Depends(get_current_user),
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    current_user: Principal = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    #история сообщений в группе
-    membership = db.query(GroupMember).filter(
-        GroupMember.group_id == group_id,
-        GroupMember.user_id == current_user.id
-    ).first()
-    
-    if not membership:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not a member of this group"
-        )
-    
-    group_messages = db.query(Message).filter(
-        Message.group_id == group_id
-    ).order_by(Message.created_at).all()
-    
-    messages_list = [
-        {
-            "id": msg.id,
-            "sender_id": msg.sender_id,
-            "receiver_id": msg.receiver_id,
-            "content": msg.content,
-            "is_read": msg.is_read,
-            "created_at": msg.created_at.isoformat(),
-            "is_group": msg.is_group,
-            "group_id": msg.group_id
-        }
-        for msg in group_messages
-    ]
-    
-    return success_response(data=messages_list)
+    #история сообщений в группе, постранично от новых к старым
+    check_page_cursors(before, after)
+    
+    def load_page():
+        membership = db.query(GroupMember).filter(
+            GroupMember.group_id == group_id,
+            GroupMember.user_id == current_user.id
+        ).first()
+    
+        if not membership:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="You are not a member of this group"
+            )
+    
+        query = db.query(Message).filter(Message.group_id == group_id)
+        group_messages, next_cursor = paginate_keyset(query, Message.id, before, after, limit)
+        marks = group_watermarks(db, group_id)
+        my_mark = marks.get(current_user.id, 0)
+        # Свое сообщение прочитано, когда его прочитали все остальные участники
+        others = [marks.get(member_id, 0) for member_id in members if member_id != current_user.id]
+        others_mark = min(others, default=0)
+        messages_list = [
+            message_to_dict(msg, msg.id <= (others_mark if msg.sender_id == current_user.id else my_mark))
+            for msg in group_messages
+        ]
+    
+        newest_incoming = max((msg.id for msg in group_messages if msg.sender_id != current_user.id), default=0)
+        if before is None and after is None and newest_incoming > my_mark:
+            if advance_read_watermark(db, current_user.id, GROUP_CHAT, group_id, newest_incoming):
+                return messages_list, next_cursor, newest_incoming
+        return messages_list, next_cursor, None
+    
+    members = await membership_index.members(group_id, db)
+    messages_list, next_cursor, read_upto = await run_db(load_page)
+    if read_upto:
+        await send_read_receipt(hub, current_user.id, read_upto, group_id=group_id, db=db)
+    return json_response(paginated_response(messages_list, next_cursor))
+
+@app.get("/conversations", response_model=dict)
+async def get_conversations(
+    before: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    current_user: Principal = Depends(get_current_user),
+    db: Session = Depends(get_read_db)
+):
+    """Список чатов с последним сообщением и числом непрочитанных, от новых к старым"""
+    def load_page():
+        rows, next_cursor = list_conversations(db, current_user.id, before, limit)
+        user_ids = [row.chat_id for row in rows if row.chat_type == DIRECT_CHAT]
+        group_ids = [row.chat_id for row in rows if row.chat_type == GROUP_CHAT]
+        usernames = dict(db.query(User.id, User.username).filter(User.id.in_(user_ids)).all()) if user_ids else {}
+        group_names = dict(db.query(Group.id, Group.name).filter(Group.id.in_(group_ids)).all()) if group_ids else {}
+        return rows, next_cursor, usernames, group_names
+
+    rows, next_cursor, usernames, group_names = await run_db(load_page)
+    conversations = []
+    for row in rows:
+        is_group = row.chat_type == GROUP_CHAT
+        conversations.append({
+            "type": row.chat_type,
+            "id": row.chat_id,
+            "title": group_names.get(row.chat_id) if is_group else usernames.get(row.chat_id),
+            "is_online": None if is_group else hub.is_online(row.chat_id),
+            "last_message": {
+                "id": row.last_message_id,
+                "sender_id": row.last_sender_id,
+                "content": row.last_message_preview,
+                "created_at": row.last_message_at
+            },
+            "unread_count": row.unread_count
+        })
+    return json_response(paginated_response(conversations, next_cursor))
+
+@app.get("/sync", response_model=dict)
+async def sync_changes(
+    since: Optional[int] = None,
+    current_user: Principal = Depends(get_current_user),
+    db: Session = Depends(get_read_db)
+):
+    """Все, что изменилось после курсора since: сообщения, дружба, состав групп, звонки.
+
+    Без since или с курсором старше журнала изменений возвращается reset=true и
+    новый курсор - клиент загружает данные целиком и дальше синхронизируется от него.
+    При has_more=true нужно сразу запросить следующую порцию с новым курсором.
+    """
+    if since is None or since < oldest_cursor():
+        return success_response(data={
+            "cursor": current_cursor(),
+            "reset": True,
+            "has_more": False,
+            "messages": [],
+            "changes": []
+        })
+
+    messages, changes, cursor, has_more = await run_db(load_sync, db, current_user.id, since)
+    return json_response(success_response(data={
+        "cursor": cursor,
+        "reset": False,
+        "has_more": has_more,
+        "messages": [message_to_dict(msg) for msg in messages],
+        "changes": [{"id": change.id, "kind": change.kind, **json.loads(change.payload)} for change in changes]
+    }))
 
 # добавление друзей
 @app.post("/friends/add", response_model=dict)
 async def add_friend(
     friend_data: FriendRequest,
-    current_user: User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """Отправить запрос в друзья"""
@@ -362,214 +928,232 @@ async def add_friend(
             detail="Cannot add yourself as friend"
         )
     
-    friend = db.query(User).filter(User.id == friend_id).first()
-    if not friend:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found"
-        )
-    
-    # запрос на добавление в друзья
-    existing = db.query(Friendship).filter(
-        ((Friendship.user_id == current_user.id) & (Friendship.friend_id == friend_id)) |
-        ((Friendship.user_id == friend_id) & (Friendship.friend_id == current_user.id))
-    ).first()
-    
-    if existing:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Friend request already exists"
+    def create_request():
+        friend = db.query(User).filter(User.id == friend_id).first()
+        if not friend:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="User not found"
+            )
+
+        # запрос на добавление в друзья
+        existing = db.query(Friendship).filter(
+            ((Friendship.user_id == current_user.id) & (Friendship.friend_id == friend_id)) |
+            ((Friendship.user_id == friend_id) & (Friendship.friend_id == current_user.id))
+        ).first()
+
+        if existing:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Friend request already exists"
+            )
+
+        # запрос
+        friendship = Friendship(
+            user_id=current_user.id,
+            friend_id=friend_id,
+            status='pending'
         )
+        db.add(friendship)
+        db.flush()
+        record_friendship(db, friendship)
+        db.commit()
     
-    # запрос
-    friendship = Friendship(
-        user_id=current_user.id,
-        friend_id=friend_id,
-        status='pending'
-    )
-    db.add(friendship)
-    db.commit()
+    await run_db(create_request)
     
     # уведомление через socket
-    if friend_id in user_connections:
-        await user_connections[friend_id].send_json({
-            "type": "friend_request",
-            "from_user_id": current_user.id,
-            "from_username": current_user.username
-        })
+    await hub.send_to_user(friend_id, {
+        "type": "friend_request",
+        "from_user_id": current_user.id,
+        "from_username": current_user.username
+    })
     
     return success_response(message="Friend request sent")
 
 @app.get("/friends", response_model=dict)
 async def get_friends(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: Principal = Depends(get_current_user),
+    db: Session = Depends(get_read_db)
 ):
     """список друзей"""
-    friendships = db.query(Friendship).filter(
-        ((Friendship.user_id == current_user.id) | (Friendship.friend_id == current_user.id)) &
-        (Friendship.status == 'accepted')
-    ).all()
-    
-    friends = []
-    for friendship in friendships:
-        friend_id = friendship.friend_id if friendship.user_id == current_user.id else friendship.user_id
-        friend = db.query(User).filter(User.id == friend_id).first()
-        
-        if friend:
-            friends.append({
-                "id": friend.id,
-                "username": friend.username,
-                "is_online": friend.id in user_connections,
-                "status": "online" if friend.id in user_connections else "offline"
-            })
+    def load_friends():
+        # Дружба хранится в одну сторону: обе половины - по своему индексу, пользователи - одним join
+        outgoing = select(Friendship.id.label("friendship_id"), Friendship.friend_id.label("friend_id")).where(
+            Friendship.user_id == current_user.id, Friendship.status == 'accepted'
+        )
+        incoming = select(Friendship.id, Friendship.user_id).where(
+            Friendship.friend_id == current_user.id, Friendship.status == 'accepted'
+        )
+        pairs = union_all(outgoing, incoming).subquery()
+        return db.query(User.id, User.username).join(pairs, User.id == pairs.c.friend_id).order_by(
+            pairs.c.friendship_id
+        ).all()
     
-    return success_response(data=friends)
+    return json_response(success_response(data=[user_to_dict(friend) for friend in await run_db(load_friends)]))
 
 @app.get("/friends/requests", response_model=dict)
 async def get_friend_requests(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: Principal = Depends(get_current_user),
+    db: Session = Depends(get_read_db)
 ):
     """получение запросов в друзья"""
-    requests = db.query(Friendship).filter(
-        Friendship.friend_id == current_user.id,
-        Friendship.status == 'pending'
-    ).all()
-    
-    requests_list = []
-    for req in requests:
-        user = db.query(User).filter(User.id == req.user_id).first()
-        if user:
-            requests_list.append({
-                "friendship_id": req.id,
-                "user_id": user.id,
-                "username": user.username
-            })
-    
-    return success_response(data=requests_list)
+    def load_requests():
+        requests = db.query(Friendship.id, User.id, User.username).join(
+            User, User.id == Friendship.user_id
+        ).filter(
+            Friendship.friend_id == current_user.id,
+            Friendship.status == 'pending'
+        ).order_by(Friendship.id).all()
+    
+        return [
+            {
+                "friendship_id": friendship_id,
+                "user_id": user_id,
+                "username": username
+            }
+            for friendship_id, user_id, username in requests
+        ]
+    
+    return json_response(success_response(data=await run_db(load_requests)))
 
 @app.post("/friends/accept/{friendship_id}", response_model=dict)
 async def accept_friend_request(
     friendship_id: int,
-    current_user: User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """принятие запроса в друзья"""
-    friendship = db.query(Friendship).filter(
-        Friendship.id == friendship_id,
-        Friendship.friend_id == current_user.id,
-        Friendship.status == 'pending'
-    ).first()
-    
-    if not friendship:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Friend request not found"
-        )
-    
-    friendship.status = 'accepted'
-    db.commit()
+    def accept():
+        friendship = db.query(Friendship).filter(
+            Friendship.id == friendship_id,
+            Friendship.friend_id == current_user.id,
+            Friendship.status == 'pending'
+        ).first()
+    
+        if not friendship:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Friend request not found"
+            )
+    
+        friendship.status = 'accepted'
+        record_friendship(db, friendship)
+        db.commit()
+        return friendship
+
+    friendship = await run_db(accept)
     
     # уведомление
-    if friendship.user_id in user_connections:
-        await user_connections[friendship.user_id].send_json({
-            "type": "friend_accepted",
-            "friendship_id": friendship_id,
-            "friend_id": current_user.id,
-            "friend_username": current_user.username
-        })
+    await hub.send_to_user(friendship.user_id, {
+        "type": "friend_accepted",
+        "friendship_id": friendship_id,
+        "friend_id": current_user.id,
+        "friend_username": current_user.username
+    })
     
     return success_response(message="Friend added")
 
 @app.delete("/friends/{friend_id}", response_model=dict)
 async def remove_friend(
     friend_id: int,
-    current_user: User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """удаление друга"""
-    friendship = db.query(Friendship).filter(
-        ((Friendship.user_id == current_user.id) & (Friendship.friend_id == friend_id)) |
-        ((Friendship.user_id == friend_id) & (Friendship.friend_id == current_user.id))
-    ).first()
-    
-    if not friendship:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Friendship not found"
-        )
-    
-    db.delete(friendship)
-    db.commit()
+    def remove():
+        friendship = db.query(Friendship).filter(
+            ((Friendship.user_id == current_user.id) & (Friendship.friend_id == friend_id)) |
+            ((Friendship.user_id == friend_id) & (Friendship.friend_id == current_user.id))
+        ).first()
+    
+        if not friendship:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Friendship not found"
+            )
+    
+        record_friendship(db, friendship, "removed")
+        db.delete(friendship)
+        db.commit()
+
+    await run_db(remove)
     
     return success_response(message="Friend removed")
 
 # группы
 @app.get("/groups", response_model=dict)
 async def get_user_groups(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: Principal = Depends(get_current_user),
+    db: Session = Depends(get_read_db)
 ):
     """список групп"""
-    memberships = db.query(GroupMember).filter(
-        GroupMember.user_id == current_user.id
-    ).all()
-    
-    groups = []
-    for membership in memberships:
-        group = db.query(Group).filter(Group.id == membership.group_id).first()
-        if group:
-            members_count = db.query(GroupMember).filter(
-                GroupMember.group_id == group.id
-            ).count()
-            
-            groups.append({
+    def load_groups():
+        # Число участников - коррелированный подзапрос по индексу (group_id, user_id) для каждой группы
+        counted = aliased(GroupMember)
+        members_count = select(func.count(counted.id)).where(counted.group_id == Group.id).scalar_subquery()
+        rows = db.query(Group, GroupMember.is_admin, members_count).join(
+            GroupMember, GroupMember.group_id == Group.id
+        ).filter(
+            GroupMember.user_id == current_user.id
+        ).order_by(GroupMember.group_id).all()
+    
+        return [
+            {
                 "id": group.id,
                 "name": group.name,
                 "creator_id": group.creator_id,
-                "is_admin": membership.is_admin,
-                "members_count": members_count,
+                "is_admin": is_admin,
+                "members_count": count,
                 "created_at": group.created_at.isoformat()
-            })
+            }
+            for group, is_admin, count in rows
+        ]
     
-    return success_response(data=groups)
+    return json_response(success_response(data=await run_db(load_groups)))
 
 @app.post("/groups/create", response_model=dict)
 async def create_group(
     group: GroupCreate,
-    current_user: User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """создать группу с участниками"""
-    new_group = Group(name=group.name, creator_id=current_user.id)
-    db.add(new_group)
-    db.commit()
-    db.refresh(new_group)
-    
-    # создатель админ
-    member = GroupMember(user_id=current_user.id, group_id=new_group.id, is_admin=True)
-    db.add(member)
-    db.commit()
-    
-    # добавление пользователей
-    if group.members:
-        for username in group.members:
-            user = db.query(User).filter(User.username == username).first()
-            if user and user.id != current_user.id:
-                new_member = GroupMember(user_id=user.id, group_id=new_group.id, is_admin=False)
-                db.add(new_member)
+    def create():
+        new_group = Group(name=group.name, creator_id=current_user.id)
+        db.add(new_group)
+        db.commit()
+        db.refresh(new_group)
+    
+        # создатель админ
+        member = GroupMember(user_id=current_user.id, group_id=new_group.id, is_admin=True)
+        db.add(member)
+        db.commit()
+    
+        # добавление пользователей
+        invited = []
+        if group.members:
+            for username in group.members:
+                user = db.query(User).filter(User.username == username).first()
+                if user and user.id != current_user.id:
+                    new_member = GroupMember(user_id=user.id, group_id=new_group.id, is_admin=False)
+                    db.add(new_member)
+                    invited.append(user.id)
                 
-                # уведомление группа
-                if user.id in user_connections:
-                    await user_connections[user.id].send_json({
-                        "type": "group_invite",
-                        "group_id": new_group.id,
-                        "group_name": new_group.name,
-                        "inviter": current_user.username
-                    })
-        
+        record_membership(db, new_group.id, [current_user.id] + invited, "added", new_group.name)
         db.commit()
+        return new_group, invited
+        
+    new_group, invited = await run_db(create)
+    membership_index.invalidate(new_group.id)
+
+    # уведомление группа
+    for invited_id in invited:
+        await hub.send_to_user(invited_id, {
+            "type": "group_invite",
+            "group_id": new_group.id,
+            "group_name": new_group.name,
+            "inviter": current_user.username
+        })
     
     return success_response(
         data={"group_id": new_group.id, "name": new_group.name},
@@ -579,134 +1163,140 @@ async def create_group(
 @app.get("/groups/{group_id}", response_model=dict)
 async def get_group_info(
     group_id: int,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: Principal = Depends(get_current_user),
+    db: Session = Depends(get_read_db)
 ):
     """инфа о группе"""
-    membership = db.query(GroupMember).filter(
-        GroupMember.group_id == group_id,
-        GroupMember.user_id == current_user.id
-    ).first()
-    
-    if not membership:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not a member of this group"
-        )
+    def load_group():
+        membership = db.query(GroupMember).filter(
+            GroupMember.group_id == group_id,
+            GroupMember.user_id == current_user.id
+        ).first()
+    
+        if not membership:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="You are not a member of this group"
+            )
     
-    group = db.query(Group).filter(Group.id == group_id).first()
-    members_count = db.query(GroupMember).filter(
-        GroupMember.group_id == group_id
-    ).count()
-    
-    return success_response(data={
-        "id": group.id,
-        "name": group.name,
-        "creator_id": group.creator_id,
-        "is_admin": membership.is_admin,
-        "members_count": members_count,
-        "created_at": group.created_at.isoformat()
-    })
+        group = db.query(Group).filter(Group.id == group_id).first()
+        members_count = db.query(GroupMember).filter(
+            GroupMember.group_id == group_id
+        ).count()
+    
+        return {
+            "id": group.id,
+            "name": group.name,
+            "creator_id": group.creator_id,
+            "is_admin": membership.is_admin,
+            "members_count": members_count,
+            "created_at": group.created_at.isoformat()
+        }
+
+    return success_response(data=await run_db(load_group))
 
 @app.get("/groups/{group_id}/members", response_model=dict)
 async def get_group_members(
     group_id: int,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: Principal = Depends(get_current_user),
+    db: Session = Depends(get_read_db)
 ):
     """Получить участников группы"""
-    membership = db.query(GroupMember).filter(
-        GroupMember.group_id == group_id,
-        GroupMember.user_id == current_user.id
-    ).first()
-    
-    if not membership:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not a member of this group"
-        )
-    
-    members = db.query(GroupMember).filter(
-        GroupMember.group_id == group_id
-    ).all()
-    
-    members_list = []
-    for member in members:
-        user = db.query(User).filter(User.id == member.user_id).first()
-        if user:
-            members_list.append({
-                "id": user.id,
-                "username": user.username,
-                "is_admin": member.is_admin,
-                "is_online": user.id in user_connections,
-                "status": "online" if user.id in user_connections else "offline",
-                "joined_at": member.joined_at.isoformat()
-            })
+    def load_members():
+        # Участники вместе с пользователями одним запросом, членство проверяется по нему же
+        rows = db.query(GroupMember, User).join(User, User.id == GroupMember.user_id).filter(
+            GroupMember.group_id == group_id
+        ).order_by(GroupMember.user_id).all()
+    
+        if not any(member.user_id == current_user.id for member, user in rows):
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="You are not a member of this group"
+            )
+        return rows
+
+    members_list = [
+        {
+            "id": user.id,
+            "username": user.username,
+            "is_admin": member.is_admin,
+            "is_online": hub.is_online(user.id),
+            "status": "online" if hub.is_online(user.id) else "offline",
+            "joined_at": member.joined_at.isoformat()
+        }
+        for member, user in await run_db(load_members)
+    ]
     
-    return success_response(data=members_list)
+    return json_response(success_response(data=members_list))
 
 @app.post("/groups/{group_id}/members", response_model=dict)
 async def add_group_member(
     group_id: int,
     member_data: GroupMemberAdd,
-    current_user: User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """Добавить участника в группу (только для админов)"""
-    admin_membership = db.query(GroupMember).filter(
-        GroupMember.group_id == group_id,
-        GroupMember.user_id == current_user.id,
-        GroupMember.is_admin == True
-    ).first()
-    
-    if not admin_membership:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Only admins can add members"
-        )
-    
-    user_login = member_data.user_login
-    user_id = member_data.user_id
-    
-    if user_login:
-        user = db.query(User).filter(User.username == user_login).first()
-    elif user_id:
-        user = db.query(User).filter(User.id == user_id).first()
-    else:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="user_login or user_id is required"
-        )
-    
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found"
-        )
-    
-    existing = db.query(GroupMember).filter(
-        GroupMember.group_id == group_id,
-        GroupMember.user_id == user.id
-    ).first()
-    
-    if existing:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="User is already a member"
+    def add_member():
+        admin_membership = db.query(GroupMember).filter(
+            GroupMember.group_id == group_id,
+            GroupMember.user_id == current_user.id,
+            GroupMember.is_admin == True
+        ).first()
+    
+        if not admin_membership:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Only admins can add members"
+            )
+
+        user_login = member_data.user_login
+        user_id = member_data.user_id
+
+        if user_login:
+            user = db.query(User).filter(User.username == user_login).first()
+        elif user_id:
+            user = db.query(User).filter(User.id == user_id).first()
+        else:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="user_login or user_id is required"
+            )
+
+        if not user:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="User not found"
+            )
+
+        existing = db.query(GroupMember).filter(
+            GroupMember.group_id == group_id,
+            GroupMember.user_id == user.id
+        ).first()
+
+        if existing:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="User is already a member"
+            )
+
+        new_member = GroupMember(
+            user_id=user.id,
+            group_id=group_id,
+            is_admin=False
         )
+        db.add(new_member)
+        record_membership(db, group_id, [user.id], "added")
+        db.commit()
+        return user.id
     
-    new_member = GroupMember(
-        user_id=user.id,
-        group_id=group_id,
-        is_admin=False
-    )
-    db.add(new_member)
-    db.commit()
+    user_id = await run_db(add_member)
+    membership_index.invalidate(group_id)
     
     # уведомление через socket
-    if user.id in user_connections:
-        group = db.query(Group).filter(Group.id == group_id).first()
-        await user_connections[user.id].send_json({
+    if hub.is_online(user_id):
+        group = await run_db(lambda: db.query(Group).filter(Group.id == group_id).first())
+        await hub.send_to_user(user_id, {
             "type": "group_invite",
             "group_id": group_id,
             "group_name": group.name,
@@ -719,91 +1309,103 @@ async def add_group_member(
 async def remove_group_member(
     group_id: int,
     user_id: int,
-    current_user: User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """Удалить участника из группы (только для админов)"""
-    admin_membership = db.query(GroupMember).filter(
-        GroupMember.group_id == group_id,
-        GroupMember.user_id == current_user.id,
-        GroupMember.is_admin == True
-    ).first()
-    
-    if not admin_membership:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Only admins can remove members"
-        )
-    
-    group = db.query(Group).filter(Group.id == group_id).first()
-    if group.creator_id == user_id:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Cannot remove group creator"
-        )
-    
-    membership = db.query(GroupMember).filter(
-        GroupMember.group_id == group_id,
-        GroupMember.user_id == user_id
-    ).first()
+    def remove_member():
+        admin_membership = db.query(GroupMember).filter(
+            GroupMember.group_id == group_id,
+            GroupMember.user_id == current_user.id,
+            GroupMember.is_admin == True
+        ).first()
+    
+        if not admin_membership:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Only admins can remove members"
+            )
     
-    if not membership:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Member not found"
-        )
-    
-    db.delete(membership)
-    db.commit()
+        group = db.query(Group).filter(Group.id == group_id).first()
+        if group.creator_id == user_id:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Cannot remove group creator"
+            )
+    
+        membership = db.query(GroupMember).filter(
+            GroupMember.group_id == group_id,
+            GroupMember.user_id == user_id
+        ).first()
+    
+        if not membership:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Member not found"
+            )
+    
+        db.delete(membership)
+        remove_group(db, group_id, [user_id])
+        record_membership(db, group_id, [user_id], "removed", group.name)
+        db.commit()
+        return group
+
+    group = await run_db(remove_member)
+    membership_index.invalidate(group_id)
     
     # Уведомляем участника
-    if user_id in user_connections:
-        await user_connections[user_id].send_json({
-            "type": "removed_from_group",
-            "group_id": group_id,
-            "group_name": group.name
-        })
+    await hub.send_to_user(user_id, {
+        "type": "removed_from_group",
+        "group_id": group_id,
+        "group_name": group.name
+    })
     
     return success_response(message="Member removed")
 
 @app.post("/groups/{group_id}/leave", response_model=dict)
 async def leave_group(
     group_id: int,
-    current_user: User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """Выйти из группы"""
-    membership = db.query(GroupMember).filter(
-        GroupMember.group_id == group_id,
-        GroupMember.user_id == current_user.id
-    ).first()
+    def leave():
+        membership = db.query(GroupMember).filter(
+            GroupMember.group_id == group_id,
+            GroupMember.user_id == current_user.id
+        ).first()
+    
+        if not membership:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="You are not a member of this group"
+            )
     
-    if not membership:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="You are not a member of this group"
-        )
-    
-    group = db.query(Group).filter(Group.id == group_id).first()
-    if group.creator_id == current_user.id:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Creator cannot leave group. Delete the group instead."
-        )
-    
-    db.delete(membership)
-    db.commit()
+        group = db.query(Group).filter(Group.id == group_id).first()
+        if group.creator_id == current_user.id:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Creator cannot leave group. Delete the group instead."
+            )
+    
+        db.delete(membership)
+        remove_group(db, group_id, [current_user.id])
+        record_membership(db, group_id, [current_user.id], "left", group.name)
+        db.commit()
+
+    await run_db(leave)
+    membership_index.invalidate(group_id)
     
     return success_response(message="Left group successfully")
 
 @app.delete("/groups/{group_id}", response_model=dict)
 async def delete_group(
     group_id: int,
-    current_user: User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """Удалить группу (только создатель)"""
-    group = db.query(Group).filter(Group.id == group_id).first()
+    group = await run_db(lambda: db.query(Group).filter(Group.id == group_id).first())
     
     if not group:
         raise HTTPException(
@@ -817,242 +1419,218 @@ async def delete_group(
             detail="Only group creator can delete the group"
         )
     
-    # Удаляем всех участников
-    db.query(GroupMember).filter(
-        GroupMember.group_id == group_id
-    ).delete()
+    members = await membership_index.members(group_id, db)
+    
+    def delete():
+        record_change(db, members, "group_deleted", group_id=group_id, group_name=group.name)
+        # Удаляем всех участников
+        db.query(GroupMember).filter(
+            GroupMember.group_id == group_id
+        ).delete()
+        remove_group(db, group_id)
     
-    # Удаляем группу
-    db.delete(group)
-    db.commit()
+        # Удаляем группу
+        db.delete(group)
+        db.commit()
+
+    await run_db(delete)
+    membership_index.invalidate(group_id)
     
     # Уведомляем всех участников
-    for conn_user_id, websocket in user_connections.items():
-        try:
-            await websocket.send_json({
-                "type": "group_deleted",
-                "group_id": group_id,
-                "group_name": group.name
-            })
-        except:
-            pass
+    for member_id in members:
+        await hub.send_to_user(member_id, {
+            "type": "group_deleted",
+            "group_id": group_id,
+            "group_name": group.name
+        })
     
     return success_response(message="Group deleted")
 
-# ==================== WEBSOCKET ====================
-@app.websocket("/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: int):
-    await websocket.accept()
-    user_connections[user_id] = websocket
-    active_connections.append(websocket)
-    
+# ==================== METRICS ====================
+def read_active_calls():
+    db = ReadSessionLocal()
+    try:
+        return count_active_calls(db)
+    finally:
+        db.close()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Метрики этого воркера в текстовом формате Prometheus"""
+    for call_status, count in (await run_db(read_active_calls)).items():
+        active_calls.set(count, (call_status,))
+    # Воркеры за одним портом отдают каждый свои значения - различаются по метке worker
+    registry.const_labels["worker"] = str(broker.worker_id)
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# ==================== ADMIN ====================
+@app.get("/admin/sql-profile", response_model=dict)
+async def get_sql_profile(reset: bool = False, current_user: Principal = Depends(get_admin_user)):
+    """Сводка SQL по маршрутам этого воркера: число запросов, время в БД, самый медленный запрос"""
+    routes = route_stats.summary()
+    if reset:
+        route_stats.clear()
+    return success_response(data={"enabled": SQL_PROFILING, "window": SQL_PROFILE_WINDOW, "routes": routes})
+
+@app.on_event("startup")
+async def startup_event():
+    # Подключение к брокеру (для нескольких воркеров)
+    await broker.start(hub)
+    # Индекс логинов для поиска пользователей
+    await username_index.load()
+    # Полнотекстовый индекс до начала записи сообщений
+    await run_db(create_search_index, engine)
+    # Фоновая пакетная запись сообщений
+    message_writer.start()
+    await run_db(backfill_conversations)
+    await run_db(prune_changes)
+
+def prune_changes():
+    """Журнал изменений старше CHANGE_LOG_RETENTION_DAYS больше не нужен /sync"""
+    db = SessionLocal()
+    try:
+        deleted = prune_change_log(db)
+        if deleted:
+            sync_log.info("change_log_pruned", deleted=deleted)
+    finally:
+        db.close()
+
+def backfill_conversations():
+    """Список чатов для истории, записанной до появления conversation_summaries"""
+    db = SessionLocal()
+    try:
+        backfill_summaries(db)
+    finally:
+        db.close()
+
+def set_user_active(user_id: int, is_active: bool):
+    """Обновить is_active пользователя (вызывается в пуле потоков БД)"""
     db = SessionLocal()
     try:
         user = db.query(User).filter(User.id == user_id).first()
         if user:
-            user.is_active = True
+            user.is_active = is_active
             db.commit()
     finally:
         db.close()
+
+def save_delivery_cursors(delivered: Dict[int, int]):
+    """Курсоры доставки - до последних сообщений, действительно записанных в сокеты.
+
+    Кадры, которые остались в очереди (медленный клиент, ошибка отправки), будут досланы при подключении.
+    """
+    db = SessionLocal()
+    try:
+        advance_delivery_cursors(db, delivered)
+    finally:
+        db.close()
+
+def set_user_offline(user_id: int, delivered_id: int):
+    """Закрыта последняя сессия пользователя"""
+    set_user_active(user_id, False)
+    if delivered_id:
+        save_delivery_cursors({user_id: delivered_id})
+
+# ==================== WEBSOCKET ====================
+@app.websocket("/ws/{user_id}")
+async def websocket_endpoint(websocket: WebSocket, user_id: int):
+    # JSON по умолчанию; MessagePack, если клиент предложил его в Sec-WebSocket-Protocol
+    subprotocol = negotiate(websocket.scope.get("subprotocols", []))
+    await websocket.accept(subprotocol=subprotocol)
+    connection = Connection(websocket, user_id, codec=codec_for(subprotocol))
+    connection.start()
+    hub.register(connection)
+    
+    await run_db(set_user_active, user_id, True)
     
     try:
+        # Все, что получит id позже upto_id, придет обычной доставкой - досылаем только более раннее
+        try:
+            upto_id = id_generator.next_id()
+        except IdsUnavailable:
+            await websocket.close(code=1013)
+            return
+        await message_writer.flush()
+        if broker.distributed:
+            # Очереди записи других воркеров этот flush не трогает - ждем, пока выданное до upto_id дойдет до БД
+            await asyncio.sleep(OFFLINE_REPLAY_SETTLE_MS / 1000)
+        db = SessionLocal()
+        try:
+            await deliver_offline_messages(connection, db, upto_id)
+        finally:
+            db.close()
+        
         while True:
-            data = await websocket.receive_text()
-            message_data = json.loads(data)
+            message_data = await connection.receive()
+            received_at = time.perf_counter()
             message_type = message_data.get("type")
+            handler = WS_HANDLERS.get(message_type)
+            ws_frames_received.inc(labels=(message_type if handler is not None else "unknown",))
+            if handler is None:
+                continue
 
-            # Сырые входящие запросы (как вы просили — без "обёрток")
-            if message_type in {
-                "message",
-                "call_initiate",
-                "call_offer",
-                "call_response",
-                "ice_candidate",
-                "call_end",
-                "friend_request",
-                "group_invite",
-                "remove_from_group",
-                "leave_group",
-                "delete_group",
-            }:
-                try:
-                    print("WS_RECV:", json.dumps(message_data, ensure_ascii=False))
-                except Exception:
-                    print("WS_RECV:", message_data)
+            # Входящий кадр целиком (SDP, кандидаты и тексты скрыты) - только на уровне DEBUG
+            ws_log.debug("ws_recv", user_id=user_id, frame=message_data)
             
             db = SessionLocal()
+            received = frame_received_at.set(received_at)
             try:
-                if message_type == "message":
-                    await handle_chat_message(message_data, user_id, db)
-                elif message_type == "call_initiate":
-                    await handle_call_initiate(message_data, user_id, db)
-                elif message_type == "call_offer":
-                    # Caller отправляет offer -> пересылаем callee
-                    cid = message_data.get("call_id")
-                    sdp = message_data.get("sdp")
-                    print(f"📤 Caller {user_id} отправил offer для call {cid}")
-                    if cid and sdp:
-                        call = db.query(Call).filter(Call.id == cid).first()
-                        if call and call.initiator_id == user_id:
-                            if call.receiver_id in user_connections:
-                                print(f"✅ Пересылаю offer от {user_id} к {call.receiver_id}")
-                                await user_connections[call.receiver_id].send_json({
-                                    "type": "call_offer",
-                                    "call_id": cid,
-                                    "sdp": sdp,
-                                })
-                            else:
-                                print(f"⚠️ Получатель {call.receiver_id} офлайн, не могу переслать offer")
-                        else:
-                            print(f"⚠️ Call {cid} не найден или пользователь {user_id} не инициатор")
-                elif message_type == "call_response":
-                    await handle_call_response(message_data, user_id, db)
-                elif message_type == "ice_candidate":
-                    target_id = message_data.get("target_user_id")
-                    print(f"🧊 ICE candidate от {user_id} к {target_id}")
-                    await handle_ice_candidate(message_data, user_id, db)
-                elif message_type == "call_end":
-                    cid = message_data.get("call_id")
-                    if cid:
-                        call = db.query(Call).filter(Call.id == cid).first()
-                        if call:
-                            other_id = call.receiver_id if call.initiator_id == user_id else call.initiator_id
-                            if other_id in user_connections:
-                                await user_connections[other_id].send_json({"type": "call_end", "call_id": cid})
-                elif message_type == "friend_request":
-                    # Обработка запроса в друзья через WebSocket
-                    target_user_id = message_data.get("target_user_id")
-                    if target_user_id:
-                        friend = db.query(User).filter(User.id == target_user_id).first()
-                        if friend:
-                            existing = db.query(Friendship).filter(
-                                ((Friendship.user_id == user_id) & (Friendship.friend_id == target_user_id)) |
-                                ((Friendship.user_id == target_user_id) & (Friendship.friend_id == user_id))
-                            ).first()
-                            
-                            if not existing:
-                                friendship = Friendship(
-                                    user_id=user_id,
-                                    friend_id=target_user_id,
-                                    status='pending'
-                                )
-                                db.add(friendship)
-                                db.commit()
-                                
-                                if target_user_id in user_connections:
-                                    await user_connections[target_user_id].send_json({
-                                        "type": "friend_request",
-                                        "from_user_id": user_id,
-                                        "from_username": user.username if user else "Unknown"
-                                    })
-                elif message_type == "group_invite":
-                    # Приглашение в группу через WebSocket
-                    group_id = message_data.get("group_id")
-                    user_login = message_data.get("user_login")
-                    if group_id and user_login:
-                        user = db.query(User).filter(User.username == user_login).first()
-                        if user:
-                            existing = db.query(GroupMember).filter(
-                                GroupMember.group_id == group_id,
-                                GroupMember.user_id == user.id
-                            ).first()
-                            
-                            if not existing:
-                                new_member = GroupMember(
-                                    user_id=user.id,
-                                    group_id=group_id,
-                                    is_admin=False
-                                )
-                                db.add(new_member)
-                                db.commit()
-                                
-                                group = db.query(Group).filter(Group.id == group_id).first()
-                                if user.id in user_connections:
-                                    await user_connections[user.id].send_json({
-                                        "type": "group_invite",
-                                        "group_id": group_id,
-                                        "group_name": group.name,
-                                        "inviter": user.username if user else "Unknown"
-                                    })
-                elif message_type == "remove_from_group":
-                    # Удаление участника из группы
-                    group_id = message_data.get("group_id")
-                    target_user_id = message_data.get("user_id")
-                    if group_id and target_user_id:
-                        membership = db.query(GroupMember).filter(
-                            GroupMember.group_id == group_id,
-                            GroupMember.user_id == target_user_id
-                        ).first()
-                        if membership:
-                            db.delete(membership)
-                            db.commit()
-                            
-                            if target_user_id in user_connections:
-                                await user_connections[target_user_id].send_json({
-                                    "type": "removed_from_group",
-                                    "group_id": group_id
-                                })
-                elif message_type == "leave_group":
-                    # Выход из группы
-                    group_id = message_data.get("group_id")
-                    if group_id:
-                        membership = db.query(GroupMember).filter(
-                            GroupMember.group_id == group_id,
-                            GroupMember.user_id == user_id
-                        ).first()
-                        if membership:
-                            db.delete(membership)
-                            db.commit()
-                elif message_type == "delete_group":
-                    # Удаление группы
-                    group_id = message_data.get("group_id")
-                    if group_id:
-                        group = db.query(Group).filter(Group.id == group_id).first()
-                        if group and group.creator_id == user_id:
-                            db.query(GroupMember).filter(GroupMember.group_id == group_id).delete()
-                            db.delete(group)
-                            db.commit()
-                            
-                            # Уведомляем всех
-                            for conn_id, ws in user_connections.items():
-                                try:
-                                    await ws.send_json({
-                                        "type": "group_deleted",
-                                        "group_id": group_id
-                                    })
-                                except:
-                                    pass
+                with profile(f"WS {message_type}"):
+                    await handler(message_data, user_id, db, connection)
+            except IdsUnavailable:
+                # Без подтверждения (message_ack) клиент повторит кадр после переподключения воркера к брокеру
+                ws_log.warning("frame_rejected", user_id=user_id, type=message_type, reason="ids unavailable")
             finally:
+                frame_received_at.reset(received)
                 db.close()
     except WebSocketDisconnect:
-        if user_id in user_connections:
-            del user_connections[user_id]
-        if websocket in active_connections:
-            active_connections.remove(websocket)
-        
-        db = SessionLocal()
-        try:
-            user = db.query(User).filter(User.id == user_id).first()
-            if user:
-                user.is_active = False
-                db.commit()
-        finally:
-            db.close()
+        pass
+    finally:
+        await connection.close()
+        # Пользователь офлайн, только когда закрыта последняя его сессия на всех воркерах
+        if hub.unregister(connection):
+            # Максимум по всем закрытым сессиям пользователя на этом воркере
+            delivered_id = hub.pop_delivered_id(user_id)
+            if not hub.is_online(user_id):
+                token_cache.invalidate_user(user_id)
+                await run_db(set_user_offline, user_id, delivered_id)
+            elif delivered_id:
+                await run_db(save_delivery_cursors, {user_id: delivered_id})
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    for websocket in active_connections:
+    # Пользователи, которые были онлайн только на этом воркере
+    local_user_ids = [user_id for user_id in hub.local_user_ids() if not broker.remote_online(user_id)]
+    delivered = hub.delivered_ids()
+    delivered = {user_id: delivered[user_id] for user_id in local_user_ids if user_id in delivered}
+    for connection in hub.connections():
+        await connection.close()
         try:
-            await websocket.close()
+            await connection.websocket.close()
         except:
             pass
     
-    db = SessionLocal()
-    try:
-        db.query(User).update({User.is_active: False})
-        db.commit()
-    finally:
-        db.close()
+    # Дописываем в БД все, что еще лежит в очереди
+    await message_writer.stop()
+    
+    def reset_active():
+        db = SessionLocal()
+        try:
+            if broker.distributed:
+                # Остальные воркеры продолжают работать - сбрасываем только своих
+                db.query(User).filter(User.id.in_(local_user_ids)).update({User.is_active: False}, synchronize_session=False)
+            else:
+                db.query(User).update({User.is_active: False})
+            db.commit()
+        finally:
+            db.close()
+    
+    await run_db(reset_active)
+    await run_db(save_delivery_cursors, delivered)
+    for user_id in local_user_ids:
+        token_cache.invalidate_user(user_id)
+    await broker.stop()
+    password_hasher.shutdown()
 
 if __name__ == "__main__":
     import uvicorn
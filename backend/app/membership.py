@@ -0,0 +1,67 @@
+from typing import Callable, Dict, FrozenSet, List, Optional
+from sqlalchemy.orm import Session
+from .database import ReadSessionLocal, run_db
+from .models import GroupMember
+
+
+class MembershipIndex:
+    """Кэш участников групп в памяти: group_id -> множество user_id.
+
+    Заполняется при первом обращении к группе и сбрасывается
+    при любом изменении состава (добавление, удаление, выход, удаление группы).
+    """
+
+    def __init__(self, session_factory=ReadSessionLocal):
+        self.session_factory = session_factory
+        self._members: Dict[int, FrozenSet[int]] = {}
+        self._listeners: List[Callable[[int], None]] = []
+        # Растет при каждом сбросе - загрузка, начатая до сброса, не попадает в кэш
+        self._version = 0
+
+    def add_listener(self, listener: Callable[[int], None]):
+        """Вызывается при каждом сбросе группы (например, для оповещения других воркеров)"""
+        self._listeners.append(listener)
+
+    def get_members(self, group_id: int, db: Optional[Session] = None) -> FrozenSet[int]:
+        members = self._members.get(group_id)
+        if members is None:
+            members = self._load(group_id, db)
+            self._members[group_id] = members
+        return members
+
+    async def members(self, group_id: int, db: Optional[Session] = None) -> FrozenSet[int]:
+        """То же, что get_members, но загрузка из БД идет в пуле потоков"""
+        members = self._members.get(group_id)
+        if members is None:
+            version = self._version
+            members = await run_db(self._load, group_id, db)
+            if version == self._version:
+                self._members[group_id] = members
+        return members
+
+    def is_member(self, group_id: int, user_id: int, db: Optional[Session] = None) -> bool:
+        return user_id in self.get_members(group_id, db)
+
+    def invalidate(self, group_id: int, notify: bool = True):
+        self._members.pop(group_id, None)
+        self._version += 1
+        if notify:
+            for listener in self._listeners:
+                listener(group_id)
+
+    def clear(self):
+        self._members.clear()
+        self._version += 1
+
+    def _load(self, group_id: int, db: Optional[Session]) -> FrozenSet[int]:
+        own_session = db is None
+        db = db or self.session_factory()
+        try:
+            rows = db.query(GroupMember.user_id).filter(GroupMember.group_id == group_id).all()
+            return frozenset(user_id for (user_id,) in rows)
+        finally:
+            if own_session:
+                db.close()
+
+
+membership_index = MembershipIndex()
@@ -0,0 +1,175 @@
+import bisect
+import contextvars
+import os
+import threading
+from collections import deque
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Наблюдения гистограмм копятся в очереди и раскладываются по корзинам при выдаче /metrics;
+# если метрики долго не забирают, очередь разбирается при достижении этого размера
+METRICS_PENDING_MAX = int(os.getenv("METRICS_PENDING_MAX", "100000"))
+
+# Границы корзин задержек (секунды)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Время приема текущего кадра WebSocket (perf_counter): кадры, отправленные при его обработке,
+# дают задержку доставки от приема до отправки в сокет получателя
+frame_received_at: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("frame_received_at", default=None)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Iterable) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Счетчик. Увеличивается только из event loop, поэтому без блокировок.
+
+    collect - для счетчиков, которые уже ведет сам компонент: значения читаются при выдаче метрик.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 collect: Optional[Callable[[], Dict[Labels, float]]] = None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.collect = collect
+        # Счетчик без меток виден с нуля, а не с первого события
+        self._values: Dict[Labels, float] = {} if self.labels else {(): 0}
+
+    def inc(self, amount: float = 1, labels: Labels = ()):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        values = self.collect() if self.collect is not None else dict(self._values)
+        for labels, value in values.items():
+            yield self.name, self.labels, labels, value
+
+
+class Gauge:
+    """Текущее значение: задается через set или вычисляется collect в момент выдачи метрик"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 collect: Optional[Callable[[], Dict[Labels, float]]] = None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.collect = collect
+        self._values: Dict[Labels, float] = {}
+
+    def set(self, value: float, labels: Labels = ()):
+        self._values[labels] = value
+
+    def samples(self):
+        values = self.collect() if self.collect is not None else dict(self._values)
+        for labels, value in values.items():
+            yield self.name, self.labels, labels, value
+
+
+class Histogram:
+    """Гистограмма. observe только добавляет пару в очередь (можно из любого потока),
+    корзины считаются при выдаче метрик."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._pending = deque()
+        self._lock = threading.Lock()
+        # labels -> (счетчики корзин без накопления, сумма, количество)
+        self._folded: Dict[Labels, Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, labels: Labels = ()):
+        self._pending.append((labels, value))
+        if len(self._pending) > METRICS_PENDING_MAX:
+            self._fold()
+
+    def _fold(self):
+        with self._lock:
+            pending = self._pending
+            while True:
+                try:
+                    labels, value = pending.popleft()
+                except IndexError:
+                    break
+                state = self._folded.get(labels)
+                if state is None:
+                    state = self._folded[labels] = ([0] * (len(self.buckets) + 1), 0.0, 0)
+                counts, total, count = state
+                counts[bisect.bisect_left(self.buckets, value)] += 1
+                self._folded[labels] = (counts, total + value, count + 1)
+
+    def samples(self):
+        self._fold()
+        with self._lock:
+            folded = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._folded.items()]
+        names = self.labels + ("le",)
+        for labels, counts, total, count in folded:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket
+                yield f"{self.name}_bucket", names, labels + (_format_value(bound),), cumulative
+            yield f"{self.name}_sum", self.labels, labels, total
+            yield f"{self.name}_count", self.labels, labels, count
+
+
+class Registry:
+    """Набор метрик процесса в текстовом формате Prometheus"""
+
+    def __init__(self, const_labels: Optional[Dict[str, str]] = None):
+        self.const_labels = const_labels or {}
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        const_names = tuple(self.const_labels)
+        const_values = tuple(self.const_labels.values())
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, label_names, label_values, value in metric.samples():
+                labels = _format_labels(const_names + label_names, const_values + tuple(label_values))
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+ws_frames_received = registry.register(Counter(
+    "chat_ws_frames_received_total", "Кадры WebSocket, принятые от клиентов, по типу", ["type"]
+))
+ws_frames_dropped = registry.register(Counter(
+    "chat_ws_frames_dropped_total", "Эфемерные кадры, отброшенные из-за переполненной очереди отправки"
+))
+messages_persisted = registry.register(Counter(
+    "chat_messages_persisted_total", "Сообщения, записанные в БД (rate() - сообщений в секунду)"
+))
+delivery_latency = registry.register(Histogram(
+    "chat_delivery_latency_seconds", "От приема кадра до отправки вызванного им кадра в сокет получателя", ["type"]
+))
+db_commit_latency = registry.register(Histogram(
+    "chat_db_commit_seconds", "Время commit транзакций сессий (flush и COMMIT)"
+))
@@ -1,11 +1,19 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text
+from sqlalchemy import BigInteger, Column, Integer, String, Boolean, DateTime, ForeignKey, Text, Index
 from sqlalchemy.orm import relationship
 from .database import Base
 from datetime import datetime
-import bcrypt
+from .passwords import hash_password, check_password
+
+# id сообщений выдает IdGenerator и они не помещаются в 32 бита;
+# в SQLite оставляем INTEGER, чтобы колонка была псевдонимом rowid
+MessageId = BigInteger().with_variant(Integer, "sqlite")
 
 class User(Base):
     __tablename__ = "users"
+    __table_args__ = (
+        # Список активных пользователей по id (GET /users, keyset и поток)
+        Index("ix_users_is_active_id", "is_active", "id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     username = Column(String(50), unique=True, index=True, nullable=False)
@@ -22,14 +30,20 @@ class User(Base):
     friendships_initiated = relationship("Friendship", foreign_keys="Friendship.user_id", back_populates="user")
     friendships_received = relationship("Friendship", foreign_keys="Friendship.friend_id", back_populates="friend")
     
+    # Синхронные варианты для скриптов; обработчики используют passwords.password_hasher
     def verify_password(self, password: str) -> bool:
-        return bcrypt.checkpw(password.encode('utf-8'), self.hashed_password.encode('utf-8'))
+        return check_password(password, self.hashed_password)
     
     def set_password(self, password: str):
-        self.hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        self.hashed_password = hash_password(password)
 
 class Friendship(Base):
     __tablename__ = "friendships"
+    __table_args__ = (
+        # Поиск дружбы в обе стороны: (user_id, friend_id) и (friend_id, user_id)
+        Index("ix_friendships_user_friend", "user_id", "friend_id"),
+        Index("ix_friendships_friend_user", "friend_id", "user_id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -43,11 +57,22 @@ class Friendship(Base):
 
 class Message(Base):
     __tablename__ = "messages"
-    
-    id = Column(Integer, primary_key=True, index=True)
+    __table_args__ = (
+        # Личная переписка: (sender_id, receiver_id) в обе стороны с сортировкой по id
+        Index("ix_messages_sender_receiver_id", "sender_id", "receiver_id", "id"),
+        # Входящие пользователя по id - досылка пропущенных при подключении
+        Index("ix_messages_receiver_id_id", "receiver_id", "id"),
+        # Отправленные пользователем по id - /sync для других его устройств
+        Index("ix_messages_sender_id_id", "sender_id", "id"),
+        # История группы с сортировкой по id
+        Index("ix_messages_group_id_id", "group_id", "id"),
+    )
+    
+    id = Column(MessageId, primary_key=True, index=True)
     sender_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     receiver_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     content = Column(Text, nullable=False)
+    # Не обновляется: прочтение хранится в ReadWatermark
     is_read = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     is_group = Column(Boolean, default=False)
@@ -73,6 +98,12 @@ class Group(Base):
 
 class GroupMember(Base):
     __tablename__ = "group_members"
+    __table_args__ = (
+        # Проверка членства и список участников группы
+        Index("ix_group_members_group_user", "group_id", "user_id"),
+        # Список групп пользователя
+        Index("ix_group_members_user_group", "user_id", "group_id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -91,7 +122,7 @@ class Call(Base):
     initiator_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     receiver_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     call_type = Column(String(20), nullable=False)  # 'video' or 'audio'
-    status = Column(String(20), default='pending')  # 'pending', 'accepted', 'declined', 'ended'
+    status = Column(String(20), default='pending', index=True)  # 'pending', 'accepted', 'declined', 'ended'
     created_at = Column(DateTime, default=datetime.utcnow)
     ended_at = Column(DateTime, nullable=True)
     
@@ -99,8 +130,80 @@ class Call(Base):
     initiator = relationship("User", foreign_keys=[initiator_id], back_populates="calls_initiated")
     receiver = relationship("User", foreign_keys=[receiver_id], back_populates="calls_received")
 
+class DeliveryCursor(Base):
+    """Последнее сообщение, которое пользователь уже получил (все с меньшим id доставлены)"""
+    __tablename__ = "delivery_cursors"
+    
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    last_message_id = Column(MessageId, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ReadWatermark(Base):
+    """Последнее прочитанное сообщение пользователя в переписке или группе.
+
+    Все сообщения переписки с id <= last_read_id считаются прочитанными,
+    поэтому отметка о прочтении - одна строка на (пользователь, чат).
+    """
+    __tablename__ = "read_watermarks"
+    __table_args__ = (
+        # Отметки всех участников группы
+        Index("ix_read_watermarks_chat", "chat_type", "chat_id"),
+    )
+    
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    chat_type = Column(String(10), primary_key=True)  # 'direct' (chat_id - собеседник) или 'group'
+    chat_id = Column(Integer, primary_key=True)
+    last_read_id = Column(MessageId, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ConversationSummary(Base):
+    """Строка списка чатов пользователя: последнее сообщение и число непрочитанных.
+
+    Обновляется при записи сообщений и при сдвиге отметки прочтения,
+    поэтому список чатов строится без обращения к messages.
+    """
+    __tablename__ = "conversation_summaries"
+    __table_args__ = (
+        # Список чатов пользователя от новых к старым
+        Index("ix_conversation_summaries_user_last", "user_id", "last_message_id"),
+        # Все строки группы (удаление группы)
+        Index("ix_conversation_summaries_chat", "chat_type", "chat_id"),
+    )
+    
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    chat_type = Column(String(10), primary_key=True)  # как в ReadWatermark
+    chat_id = Column(Integer, primary_key=True)
+    last_message_id = Column(MessageId, nullable=False, default=0)
+    last_sender_id = Column(Integer, nullable=True)
+    last_message_preview = Column(String(200), nullable=True)
+    last_message_at = Column(DateTime, nullable=True)
+    unread_count = Column(Integer, nullable=False, default=0)
+
+class ChangeLog(Base):
+    """Журнал изменений для /sync: дружба, состав групп, звонки.
+
+    id выдает тот же IdGenerator, что и для сообщений, поэтому один курсор
+    упорядочивает и сообщения, и изменения.
+    """
+    __tablename__ = "change_log"
+    __table_args__ = (
+        # Изменения пользователя после курсора
+        Index("ix_change_log_user_id", "user_id", "id"),
+    )
+    
+    id = Column(MessageId, primary_key=True, autoincrement=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    kind = Column(String(30), nullable=False)  # 'friendship', 'group_member', 'group_deleted', 'call'
+    payload = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+# Устаревшая таблица: пропущенные сообщения теперь досылаются по DeliveryCursor из messages
 class OfflineMessage(Base):
     __tablename__ = "offline_messages"
+    __table_args__ = (
+        # Недоставленные сообщения получателя
+        Index("ix_offline_messages_receiver_delivered", "receiver_id", "delivered"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     sender_id = Column(Integer, ForeignKey("users.id"), nullable=False)
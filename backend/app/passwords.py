@@ -0,0 +1,148 @@
+import asyncio
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+import bcrypt
+from fastapi import HTTPException, status
+
+# Стоимость bcrypt (2^rounds итераций); при изменении старые хэши пересчитываются при входе
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# thread - bcrypt отпускает GIL, потоков достаточно; process - отдельные процессы
+PASSWORD_HASH_POOL = os.getenv("PASSWORD_HASH_POOL", "thread")
+# Сколько хэшей считается одновременно
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 2)))
+# Сколько запросов может ждать своей очереди, остальным 503
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "256"))
+
+
+def hash_password(password: str, rounds: int = BCRYPT_ROUNDS) -> str:
+    """Синхронный хэш пароля (выполняется в пуле)"""
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def check_password(password: str, hashed_password: str) -> bool:
+    """Синхронная проверка пароля (выполняется в пуле)"""
+    return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+
+def hash_rounds(hashed_password: str) -> Optional[int]:
+    """Стоимость из хэша вида $2b$12$..."""
+    try:
+        return int(hashed_password.split("$")[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    """Хэширование паролей вне event loop.
+
+    bcrypt занимает сотни миллисекунд, поэтому работа уходит в пул потоков
+    или процессов. Одновременно считается не больше workers хэшей, остальные
+    ждут; если ожидающих больше max_pending, запрос отклоняется с 503.
+    Время ожидания в очереди копится в счетчиках stats(), они выдаются в /metrics.
+    """
+
+    def __init__(self, rounds: int = BCRYPT_ROUNDS, workers: int = PASSWORD_HASH_WORKERS,
+                 pool: str = PASSWORD_HASH_POOL, max_pending: int = PASSWORD_HASH_MAX_PENDING):
+        self.rounds = rounds
+        self.workers = max(1, workers)
+        self.pool = pool
+        self.max_pending = max_pending
+        self._executor: Optional[Executor] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.pending = 0
+        self.in_progress = 0
+        self.hashed = 0
+        self.verified = 0
+        self.rehashed = 0
+        self.rejected = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.work_time_total = 0.0
+
+    def _get_executor(self) -> Executor:
+        # Пул создается при первом обращении, а не при импорте (важно для процессов uvicorn)
+        if self._executor is None:
+            if self.pool == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        return self._executor
+
+    async def _run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many login attempts, try again later",
+                headers={"Retry-After": "1"},
+            )
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.workers)
+        self.pending += 1
+        queued_at = time.perf_counter()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.pending -= 1
+        try:
+            waited = time.perf_counter() - queued_at
+            self.queue_wait_total += waited
+            self.queue_wait_max = max(self.queue_wait_max, waited)
+            self.in_progress += 1
+            started = time.perf_counter()
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self._get_executor(), fn, *args)
+            finally:
+                self.in_progress -= 1
+                self.work_time_total += time.perf_counter() - started
+        finally:
+            self._semaphore.release()
+
+    async def hash(self, password: str) -> str:
+        hashed_password = await self._run(hash_password, password, self.rounds)
+        self.hashed += 1
+        return hashed_password
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        result = await self._run(check_password, password, hashed_password)
+        self.verified += 1
+        return result
+
+    def needs_rehash(self, hashed_password: str) -> bool:
+        """Хэш посчитан с другой стоимостью, чем BCRYPT_ROUNDS"""
+        return hash_rounds(hashed_password) != self.rounds
+
+    async def rehash_if_needed(self, password: str, hashed_password: str) -> Optional[str]:
+        """Новый хэш после успешного входа, если изменилась стоимость"""
+        if not self.needs_rehash(hashed_password):
+            return None
+        new_hash = await self.hash(password)
+        self.rehashed += 1
+        return new_hash
+
+    def stats(self) -> dict:
+        operations = self.hashed + self.verified
+        return {
+            "rounds": self.rounds,
+            "workers": self.workers,
+            "pool": self.pool,
+            "pending": self.pending,
+            "in_progress": self.in_progress,
+            "hashed": self.hashed,
+            "verified": self.verified,
+            "rehashed": self.rehashed,
+            "rejected": self.rejected,
+            "queue_wait_avg_ms": self.queue_wait_total / operations * 1000 if operations else 0.0,
+            "queue_wait_max_ms": self.queue_wait_max * 1000,
+            "work_avg_ms": self.work_time_total / operations * 1000 if operations else 0.0,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,232 @@
+import asyncio
+import os
+import threading
+import time
+from datetime import datetime
+from typing import List, Optional
+from sqlalchemy import insert
+from .database import SessionLocal
+from .models import Message
+from .conversations import apply_messages
+from .metrics import messages_persisted
+from .log import get_logger
+
+# Настройки пакетной записи сообщений
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "200"))
+MESSAGE_BATCH_INTERVAL_MS = float(os.getenv("MESSAGE_BATCH_INTERVAL_MS", "20"))
+MESSAGE_QUEUE_MAX = int(os.getenv("MESSAGE_QUEUE_MAX", "10000"))
+# Подтверждать сообщение отправителю только после записи в БД
+MESSAGE_ACK_AFTER_PERSIST = os.getenv("MESSAGE_ACK_AFTER_PERSIST", "false").lower() in ("1", "true", "yes")
+
+# Эпоха идентификаторов: 2024-01-01 UTC в миллисекундах
+ID_EPOCH_MS = 1704067200000
+WORKER_BITS = 4
+SEQUENCE_BITS = 8
+
+log = get_logger("persistence")
+
+
+class IdsUnavailable(RuntimeError):
+    """Номер воркера не подтвержден брокером: выданный id мог бы совпасть с id другого воркера"""
+
+
+class IdGenerator:
+    """Монотонные идентификаторы сообщений, выдаваемые до записи в БД.
+
+    Формат: миллисекунды от ID_EPOCH_MS << 12 | worker << 8 | sequence.
+    Значение укладывается в 2^53, поэтому безопасно для JavaScript клиента.
+    Пока номер воркера приостановлен (suspend), next_id бросает IdsUnavailable.
+    """
+
+    def __init__(self, worker_id: int = 0):
+        self.worker_id = worker_id
+        self.suspended = False
+        self._last_ms = 0
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def set_worker_id(self, worker_id: int):
+        with self._lock:
+            self.worker_id = worker_id % (1 << WORKER_BITS)
+            self.suspended = False
+
+    def suspend(self):
+        """Перестать выдавать id до следующего set_worker_id (связь с брокером потеряна)"""
+        with self._lock:
+            self.suspended = True
+
+    def next_id(self) -> int:
+        with self._lock:
+            if self.suspended:
+                raise IdsUnavailable("worker id is not confirmed by the broker")
+            now_ms = max(int(time.time() * 1000) - ID_EPOCH_MS, self._last_ms)
+            if now_ms == self._last_ms:
+                self._sequence += 1
+                if self._sequence >= (1 << SEQUENCE_BITS):
+                    # Последовательность исчерпана - переходим на следующую миллисекунду
+                    now_ms += 1
+                    self._sequence = 0
+            else:
+                self._sequence = 0
+            self._last_ms = now_ms
+            return (now_ms << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self._sequence
+
+
+class _PendingWrite:
+    __slots__ = ("messages", "future")
+
+    def __init__(self, messages: List[dict], future: asyncio.Future):
+        self.messages = messages
+        self.future = future
+
+
+class MessageWriter:
+    """Фоновая пакетная запись сообщений (group commit).
+
+    Строки накапливаются в очереди и записываются одной транзакцией,
+    когда набирается MESSAGE_BATCH_SIZE записей или истекает MESSAGE_BATCH_INTERVAL_MS.
+    """
+
+    def __init__(self, session_factory=SessionLocal, batch_size: int = MESSAGE_BATCH_SIZE,
+                 interval_ms: float = MESSAGE_BATCH_INTERVAL_MS, queue_max: int = MESSAGE_QUEUE_MAX):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.interval = interval_ms / 1000
+        self.queue_max = queue_max
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Запуск фоновой задачи записи в текущем event loop"""
+        if self._task is not None and not self._task.done():
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_max)
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def queue_depth(self) -> int:
+        """Записей в очереди, еще не переданных в commit"""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def submit(self, messages: List[dict] = None) -> asyncio.Future:
+        """Поставить строки в очередь записи. Future завершается после commit."""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_PendingWrite(messages or [], future))
+        return future
+
+    async def flush(self):
+        """Дождаться записи всего, что уже поставлено в очередь"""
+        if self._task is None or self._task.done():
+            return
+        future = await self.submit()
+        await future
+
+    async def stop(self):
+        """Записать остаток очереди и остановить фоновую задачу"""
+        if self._task is None:
+            return
+        if not self._task.done():
+            await self._queue.put(None)
+            await self._task
+        self._task = None
+        self._queue = None
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            rows = len(item.messages)
+            deadline = time.monotonic() + self.interval
+            while rows < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+                rows += len(item.messages)
+            await self._commit(batch)
+
+    async def _commit(self, batch: List[_PendingWrite]):
+        try:
+            await asyncio.to_thread(self._write_batch, batch)
+        except Exception as e:
+            log.warning("message_batch_failed", items=len(batch), error=str(e))
+            # Пишем по одной, чтобы одна плохая строка не потеряла весь пакет
+            for item in batch:
+                try:
+                    await asyncio.to_thread(self._write_batch, [item])
+                except Exception as item_error:
+                    log.error("message_write_failed", message_ids=[row["id"] for row in item.messages],
+                              error=str(item_error))
+                    if not item.future.done():
+                        item.future.set_exception(item_error)
+                        # Без подтверждения после записи future никто не ждет - помечаем ошибку прочитанной,
+                        # чтобы asyncio не писал "Future exception was never retrieved"; await ее все равно получит
+                        item.future.exception()
+                else:
+                    messages_persisted.inc(len(item.messages))
+                    if not item.future.done():
+                        item.future.set_result(None)
+            return
+        messages_persisted.inc(sum(len(item.messages) for item in batch))
+        for item in batch:
+            if not item.future.done():
+                item.future.set_result(None)
+
+    def _write_batch(self, batch: List[_PendingWrite]):
+        messages = [row for item in batch for row in item.messages]
+        if not messages:
+            return
+        db = self.session_factory()
+        try:
+            db.execute(insert(Message), messages)
+            # Список чатов обновляется в той же транзакции
+            apply_messages(db, messages)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+
+def id_for_time(timestamp: float) -> int:
+    """Наименьший id, который IdGenerator мог выдать в момент timestamp (секунды unix)"""
+    return max(0, int(timestamp * 1000) - ID_EPOCH_MS) << (WORKER_BITS + SEQUENCE_BITS)
+
+
+id_generator = IdGenerator(int(os.getenv("WORKER_ID", "0")))
+message_writer = MessageWriter()
+
+
+def build_message_row(sender_id: int, receiver_id: int, content: str,
+                      is_group: bool = False, group_id: Optional[int] = None) -> dict:
+    """Строка таблицы messages с заранее выданными id и временем"""
+    if is_group and group_id:
+        # Клиент присылает в receiver_id id группы, а колонка ссылается на users.id
+        # (PostgreSQL проверяет внешние ключи) - у групповых сообщений получатель сам отправитель
+        receiver_id = sender_id
+    return {
+        "id": id_generator.next_id(),
+        "sender_id": sender_id,
+        "receiver_id": receiver_id,
+        "content": content,
+        "is_read": False,
+        "created_at": datetime.utcnow(),
+        "is_group": is_group,
+        "group_id": group_id,
+    }
+
+
+def wants_persist_ack(message_data: dict) -> bool:
+    """Нужно ли подтверждение после записи для этого кадра"""
+    return MESSAGE_ACK_AFTER_PERSIST or message_data.get("ack") == "persist"
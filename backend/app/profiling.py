@@ -0,0 +1,148 @@
+import contextvars
+import os
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, List, Optional, Tuple
+from starlette.datastructures import MutableHeaders
+
+# Профилирование SQL по запросам (выключено по умолчанию: хуки на каждый запрос к БД)
+SQL_PROFILING = os.getenv("SQL_PROFILING", "false").lower() in ("1", "true", "yes")
+# Сколько последних запросов каждого маршрута учитывается в сводке
+SQL_PROFILE_WINDOW = int(os.getenv("SQL_PROFILE_WINDOW", "1000"))
+# Длина текста самого медленного запроса в сводке
+SQL_PROFILE_STATEMENT_LENGTH = 300
+
+
+class QueryProfile:
+    """SQL одного HTTP запроса или одного кадра WebSocket"""
+
+    __slots__ = ("count", "total", "slowest", "slowest_statement")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.slowest = 0.0
+        self.slowest_statement: Optional[str] = None
+
+    def add(self, statement: str, duration: float):
+        self.count += 1
+        self.total += duration
+        if duration >= self.slowest:
+            self.slowest = duration
+            self.slowest_statement = statement
+
+    def server_timing(self) -> str:
+        """Значение заголовка Server-Timing (длительности в мс)"""
+        return (
+            f'db;dur={self.total * 1000:.2f};desc="{self.count} queries", '
+            f"db-slowest;dur={self.slowest * 1000:.2f}"
+        )
+
+
+_current: contextvars.ContextVar[Optional[QueryProfile]] = contextvars.ContextVar("query_profile", default=None)
+
+
+def record_statement(statement: str, duration: float):
+    """Вызывается из событий движков SQLAlchemy (в потоке, где выполнялся запрос)"""
+    profile = _current.get()
+    if profile is not None:
+        profile.add(statement, duration)
+
+
+class RouteStats:
+    """Скользящая сводка по маршрутам: последние SQL_PROFILE_WINDOW запросов каждого"""
+
+    def __init__(self, window: int = SQL_PROFILE_WINDOW):
+        self.window = window
+        self._routes: Dict[str, Deque[Tuple[int, float, float, Optional[str]]]] = {}
+
+    def add(self, route: str, profile: QueryProfile):
+        samples = self._routes.get(route)
+        if samples is None:
+            samples = self._routes[route] = deque(maxlen=self.window)
+        samples.append((profile.count, profile.total, profile.slowest, profile.slowest_statement))
+
+    def clear(self):
+        self._routes.clear()
+
+    def summary(self) -> List[dict]:
+        """Маршруты по суммарному времени в БД, самые нагружающие первыми"""
+        rows = []
+        for route, samples in list(self._routes.items()):
+            samples = list(samples)
+            counts = [sample[0] for sample in samples]
+            totals = sorted(sample[1] for sample in samples)
+            slowest = max(samples, key=lambda sample: sample[2])
+            statement = slowest[3]
+            rows.append({
+                "route": route,
+                "requests": len(samples),
+                "queries_avg": round(sum(counts) / len(samples), 2),
+                "queries_max": max(counts),
+                "db_ms_total": round(sum(totals) * 1000, 2),
+                "db_ms_avg": round(sum(totals) / len(samples) * 1000, 3),
+                "db_ms_p95": round(totals[min(len(totals) - 1, int(0.95 * len(totals)))] * 1000, 3),
+                "slowest_ms": round(slowest[2] * 1000, 3),
+                "slowest_statement": " ".join(statement.split())[:SQL_PROFILE_STATEMENT_LENGTH] if statement else None,
+            })
+        rows.sort(key=lambda row: row["db_ms_total"], reverse=True)
+        return rows
+
+
+route_stats = RouteStats()
+
+
+@contextmanager
+def profile(route: str):
+    """Считать SQL внутри блока (и в вызовах run_db из него) под именем route"""
+    if not SQL_PROFILING:
+        yield None
+        return
+    current = QueryProfile()
+    token = _current.set(current)
+    try:
+        yield current
+    finally:
+        _current.reset(token)
+        route_stats.add(route, current)
+
+
+def _route_name(scope) -> Optional[str]:
+    route = scope.get("route")
+    path = getattr(route, "path", None)
+    return f"{scope['method']} {path}" if path else None
+
+
+class SQLProfilingMiddleware:
+    """Профиль SQL каждого HTTP запроса: заголовок Server-Timing и сводка по маршруту.
+
+    Заголовок отправляется до тела ответа, поэтому у потоковых ответов в нем
+    только запросы до начала потока; в сводку попадает весь ответ.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        current = QueryProfile()
+        token = _current.set(current)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing", current.server_timing())
+                # Иначе фронтенд с другого origin не увидит заголовок в Resource Timing
+                headers.append("Timing-Allow-Origin", "*")
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                route = _route_name(scope)
+                if route is not None:
+                    route_stats.add(route, current)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
@@ -0,0 +1,236 @@
+import json
+import os
+from typing import Dict, List, Optional, Union
+from .utils import json_dumps, orjson
+
+try:
+    import msgpack
+except ImportError:  # без msgpack сервер просто не предлагает бинарный протокол
+    msgpack = None
+
+# Подпротоколы WebSocket (заголовок Sec-WebSocket-Protocol). Без заголовка - JSON, как раньше
+JSON_PROTOCOL = "chat.json"
+MSGPACK_PROTOCOL = "chat.msgpack.v1"
+# Можно отключить MessagePack, не трогая клиентов: они получат JSON
+WS_MSGPACK = os.getenv("WS_MSGPACK", "true").lower() in ("1", "true", "yes")
+
+# Коды типов кадров в MessagePack. Таблица только дополняется: изменение кода - новая версия протокола
+TYPE_CODES: Dict[str, int] = {
+    "message": 1,
+    "message_ack": 2,
+    "offline_messages": 3,
+    "read_receipt": 4,
+    "mark_read": 5,
+    "typing": 6,
+    "presence": 7,
+    "call_initiate": 10,
+    "call_initiated": 11,
+    "incoming_call": 12,
+    "call_offer": 13,
+    "call_response": 14,
+    "call_accepted": 15,
+    "call_declined": 16,
+    "ice_candidate": 17,
+    "call_end": 18,
+    "friend_request": 20,
+    "friend_accepted": 21,
+    "group_invite": 22,
+    "remove_from_group": 23,
+    "removed_from_group": 24,
+    "leave_group": 25,
+    "delete_group": 26,
+    "group_deleted": 27,
+}
+# Коды ключей на любом уровне вложенности; неизвестные ключи передаются строками
+KEY_CODES: Dict[str, int] = {
+    "type": 0,
+    "id": 1,
+    "message_id": 2,
+    "client_id": 3,
+    "sender_id": 4,
+    "receiver_id": 5,
+    "content": 6,
+    "created_at": 7,
+    "is_group": 8,
+    "group_id": 9,
+    "persisted": 10,
+    "ack": 11,
+    "messages": 12,
+    "final": 13,
+    "truncated": 14,
+    "peer_id": 15,
+    "reader_id": 16,
+    "call_id": 17,
+    "call_type": 18,
+    "sdp": 19,
+    "candidate": 20,
+    "sdpMid": 21,
+    "sdpMLineIndex": 22,
+    "usernameFragment": 23,
+    "target_user_id": 24,
+    "initiator_id": 25,
+    "initiator_name": 26,
+    "action": 27,
+    "timestamp": 28,
+    "user_id": 29,
+    "username": 30,
+    "group_name": 31,
+    "inviter": 32,
+    "from_user_id": 33,
+    "from_username": 34,
+    "friendship_id": 35,
+    "is_read": 36,
+}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+KEY_NAMES = {code: name for name, code in KEY_CODES.items()}
+
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+
+def negotiate(requested: List[str]) -> Optional[str]:
+    """Подпротокол для ответа на рукопожатие: первый поддерживаемый из предложенных клиентом.
+
+    None - заголовок не отправляется, соединение работает в JSON.
+    """
+    for name in requested:
+        if name == MSGPACK_PROTOCOL and msgpack is not None and WS_MSGPACK:
+            return name
+        if name == JSON_PROTOCOL:
+            return name
+    return None
+
+
+def _compact(value):
+    # Вглубь только для словарей и списков: вызов функции на каждое значение дороже самой замены ключа
+    if isinstance(value, dict):
+        return {KEY_CODES.get(key, key): _compact(item) if isinstance(item, (dict, list)) else item
+                for key, item in value.items()}
+    return [_compact(item) if isinstance(item, (dict, list)) else item for item in value]
+
+
+def _expand(value):
+    if isinstance(value, dict):
+        return {KEY_NAMES.get(key, key) if isinstance(key, int) else key:
+                _expand(item) if isinstance(item, (dict, list)) else item
+                for key, item in value.items()}
+    return [_expand(item) if isinstance(item, (dict, list)) else item for item in value]
+
+
+def _msgpack_default(value):
+    isoformat = getattr(value, "isoformat", None)
+    if isoformat is not None:
+        return isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not MessagePack serializable")
+
+
+# Один упаковщик на процесс: кадры кодируются только в event loop
+_packer = msgpack.Packer(use_bin_type=True, default=_msgpack_default) if msgpack is not None else None
+
+
+def pack_frame(data: dict) -> bytes:
+    """Кадр в MessagePack: коды вместо ключей и типа кадра"""
+    frame = _compact(data)
+    code = TYPE_CODES.get(data.get("type"))
+    if code is not None:
+        frame[0] = code
+    return _packer.pack(frame)
+
+
+def unpack_frame(payload: bytes) -> dict:
+    """Обратно к кадру с именами ключей и типа, как у JSON"""
+    frame = msgpack.unpackb(payload, raw=False, strict_map_key=False)
+    if not isinstance(frame, dict):
+        raise ValueError("MessagePack frame must be a map")
+    data = _expand(frame)
+    frame_type = data.get("type")
+    if isinstance(frame_type, int):
+        data["type"] = TYPE_NAMES.get(frame_type, frame_type)
+    return data
+
+
+class JsonCodec:
+    """Текстовые кадры JSON - протокол по умолчанию"""
+
+    protocol = JSON_PROTOCOL
+
+    @staticmethod
+    def encode(data: dict) -> str:
+        return json_dumps(data).decode()
+
+    @staticmethod
+    def frame_payload(frame: "OutgoingFrame") -> str:
+        return frame.text
+
+    @staticmethod
+    def decode(payload: Union[str, bytes]) -> dict:
+        return _json_loads(payload)
+
+
+class MsgpackCodec:
+    """Бинарные кадры MessagePack"""
+
+    protocol = MSGPACK_PROTOCOL
+
+    @staticmethod
+    def encode(data: dict) -> bytes:
+        return pack_frame(data)
+
+    @staticmethod
+    def frame_payload(frame: "OutgoingFrame") -> bytes:
+        return frame.packed
+
+    @staticmethod
+    def decode(payload: Union[str, bytes]) -> dict:
+        # Текстовый кадр от клиента с MessagePack тоже принимается
+        if isinstance(payload, str):
+            return _json_loads(payload)
+        return unpack_frame(payload)
+
+
+class OutgoingFrame:
+    """Кадр рассылки: словарь и его представления, закодированные по первому требованию.
+
+    JSON текст нужен JSON соединениям и брокеру, MessagePack упаковывается прямо из словаря;
+    каждое представление кодируется один раз на всех получателей. Кадр от брокера
+    приходит текстом, и словарь из него разбирается, только если есть соединения с MessagePack.
+    """
+
+    __slots__ = ("type", "message_id", "_data", "_text", "_packed")
+
+    def __init__(self, data: Optional[dict], frame_type: Optional[str] = None,
+                 message_id: Optional[int] = None, text: Optional[str] = None):
+        self.type = frame_type
+        self.message_id = message_id
+        self._data = data
+        self._text = text
+        self._packed: Optional[bytes] = None
+
+    @classmethod
+    def from_text(cls, text: str, frame_type: Optional[str] = None, message_id: Optional[int] = None):
+        return cls(None, frame_type, message_id, text=text)
+
+    @property
+    def data(self) -> dict:
+        if self._data is None:
+            self._data = _json_loads(self._text)
+        return self._data
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = JsonCodec.encode(self._data)
+        return self._text
+
+    @property
+    def packed(self) -> bytes:
+        if self._packed is None:
+            self._packed = pack_frame(self.data)
+        return self._packed
+
+
+json_codec = JsonCodec()
+msgpack_codec = MsgpackCodec() if msgpack is not None else None
+
+
+def codec_for(protocol: Optional[str]):
+    return msgpack_codec if protocol == MSGPACK_PROTOCOL else json_codec
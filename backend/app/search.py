@@ -0,0 +1,229 @@
+import html
+import os
+import re
+import time
+from typing import List, Optional, Tuple
+from sqlalchemy import Float, and_, cast, column, func, inspect, literal_column, or_, select, table, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from .models import Message, GroupMember
+from .conversations import PREVIEW_LENGTH
+from .log import get_logger
+
+# Сколько слов запроса учитывается, остальные отбрасываются
+SEARCH_MAX_TERMS = int(os.getenv("SEARCH_MAX_TERMS", "8"))
+# Ранжируются только столько самых свежих совпадений из чатов пользователя:
+# частое слово иначе потребовало бы оценить все его вхождения в базе
+SEARCH_CANDIDATES = int(os.getenv("SEARCH_CANDIDATES", "500"))
+# Последнее слово ищется по префиксу (набор на ходу), если в нем не меньше букв
+SEARCH_MIN_PREFIX = int(os.getenv("SEARCH_MIN_PREFIX", "2"))
+# Длина фрагмента с подсветкой (в словах)
+SEARCH_SNIPPET_WORDS = int(os.getenv("SEARCH_SNIPPET_WORDS", "12"))
+# Попытки создать индекс, если база занята другим воркером, который стартует одновременно
+SEARCH_INDEX_ATTEMPTS = 5
+
+log = get_logger("search")
+
+_TERM_RE = re.compile(r"\w+", re.UNICODE)
+
+# Полнотекстовый индекс SQLite: таблица FTS5 без копии текста (content='').
+# Колонка chats - токены чатов сообщения: u<id> отправителя и получателя для личных,
+# g<id> для групповых. Права проверяются пересечением списков внутри индекса,
+# а не чтением каждого совпадения из messages. Индекс ведут триггеры.
+_SQLITE_CHATS = (
+    "CASE WHEN {row}.is_group THEN 'g' || {row}.group_id "
+    "ELSE 'u' || {row}.sender_id || ' u' || {row}.receiver_id END"
+)
+_SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+    "content, chats, content='', tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN "
+    "INSERT INTO messages_fts(rowid, content, chats) VALUES (new.id, new.content, {new}); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, content, chats) VALUES ('delete', old.id, old.content, {old}); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content, is_group, group_id ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, content, chats) VALUES ('delete', old.id, old.content, {old}); "
+    "INSERT INTO messages_fts(rowid, content, chats) VALUES (new.id, new.content, {new}); END",
+]
+_SQLITE_BACKFILL = (
+    "INSERT INTO messages_fts(rowid, content, chats) "
+    f"SELECT m.id, m.content, {_SQLITE_CHATS.format(row='m')} FROM messages m"
+)
+# В PostgreSQL - GIN индекс по выражению, его же использует запрос поиска
+_POSTGRES_DDL = [
+    "CREATE INDEX IF NOT EXISTS ix_messages_content_fts ON messages USING gin (to_tsvector('simple', content))",
+]
+
+_fts = table("messages_fts", column("rowid"))
+_fts_table = literal_column("messages_fts")
+
+# False, если в сборке SQLite нет FTS5 - тогда поиск отключен
+_search_available = True
+
+
+def _create_sqlite_index(bind):
+    # BEGIN IMMEDIATE берет блокировку записи до проверки: воркеры, стартующие одновременно,
+    # создают таблицу и заполняют ее строго по очереди (иначе заполнили бы дважды)
+    with bind.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+        try:
+            exists = inspect(conn).has_table("messages_fts")
+            for statement in _SQLITE_DDL:
+                conn.exec_driver_sql(statement.format(
+                    new=_SQLITE_CHATS.format(row="new"), old=_SQLITE_CHATS.format(row="old")
+                ))
+            if not exists:
+                conn.exec_driver_sql(_SQLITE_BACKFILL)
+            conn.exec_driver_sql("COMMIT")
+        except BaseException:
+            conn.exec_driver_sql("ROLLBACK")
+            raise
+
+
+def create_search_index(bind):
+    """Создать полнотекстовый индекс сообщений, если его еще нет.
+
+    Для уже существующей базы индекс FTS5 заполняется по всем сообщениям один раз,
+    в той же транзакции, что и создание таблицы. Поиск отключается, только если
+    в сборке SQLite нет FTS5; занятая база - повод повторить, а не отключать поиск.
+    """
+    global _search_available
+    if bind.dialect.name != "sqlite":
+        with bind.begin() as conn:
+            for statement in _POSTGRES_DDL:
+                conn.execute(text(statement))
+        return
+    for attempt in range(SEARCH_INDEX_ATTEMPTS):
+        try:
+            _create_sqlite_index(bind)
+            return
+        except OperationalError as e:
+            if "no such module" in str(e):
+                _search_available = False
+                log.warning("search_disabled", reason="fts5 unavailable", error=str(e))
+                return
+            if attempt == SEARCH_INDEX_ATTEMPTS - 1:
+                raise
+            log.info("search_index_retry", attempt=attempt + 1, error=str(e))
+            time.sleep(0.2 * (attempt + 1))
+
+
+def search_available() -> bool:
+    return _search_available
+
+
+def search_terms(q: str) -> List[str]:
+    """Слова запроса без операторов и кавычек"""
+    return _TERM_RE.findall(q.lower())[:SEARCH_MAX_TERMS]
+
+
+def encode_cursor(score: float, message_id: int) -> str:
+    return f"{score!r}:{message_id}"
+
+
+def decode_cursor(cursor: str) -> Tuple[float, int]:
+    """Курсор - (оценка, id) последнего результата страницы; ValueError, если испорчен"""
+    score, _, message_id = cursor.rpartition(":")
+    return float(score), int(message_id)
+
+
+def _is_prefix(term: str) -> bool:
+    # Префикс из одной буквы совпадает с огромной частью словаря
+    return len(term) >= SEARCH_MIN_PREFIX
+
+
+def _fts_query(terms: List[str], chats: List[str]) -> str:
+    # Каждое слово - отдельная фраза в кавычках (без операторов FTS5), последнее - по префиксу
+    words = " ".join(f'"{term}"' for term in terms) + ("*" if _is_prefix(terms[-1]) else "")
+    return f"content : ({words}) AND chats : ({' OR '.join(chats)})"
+
+
+def _ts_query(terms: List[str]):
+    last = f"{terms[-1]}:*" if _is_prefix(terms[-1]) else terms[-1]
+    return func.to_tsquery("simple", " & ".join(terms[:-1] + [last]))
+
+
+def _candidates(db: Session, user_id: int, terms: List[str]):
+    """id и оценка совпадений из чатов пользователя (меньше - релевантнее), от свежих к старым"""
+    if db.get_bind().dialect.name == "sqlite":
+        group_ids = [row[0] for row in db.query(GroupMember.group_id).filter(GroupMember.user_id == user_id)]
+        chats = [f"u{user_id}"] + [f"g{group_id}" for group_id in group_ids]
+        return (
+            # Вес колонки chats - 0: на релевантность влияют только слова
+            select(_fts.c.rowid.label("id"), func.bm25(_fts_table, 1.0, 0.0).label("score"))
+            .where(_fts_table.op("MATCH")(_fts_query(terms, chats)))
+            # Порядок rowid отдает сам индекс FTS5 - свежие совпадения читаются без сортировки всех
+            .order_by(_fts.c.rowid.desc())
+        )
+    document = func.to_tsvector("simple", Message.content)
+    query = _ts_query(terms)
+    group_ids = select(GroupMember.group_id).where(GroupMember.user_id == user_id)
+    # ts_rank_cd - чем больше, тем лучше; оценка со знаком минус сортируется как bm25.
+    # real приводится к double, иначе курсор из ответа не совпадет с оценкой при сравнении
+    score = -cast(func.ts_rank_cd(document, query), Float)
+    return (
+        select(Message.id, score.label("score"))
+        .where(document.op("@@")(query), or_(
+            and_(Message.is_group == False, or_(Message.sender_id == user_id, Message.receiver_id == user_id)),
+            and_(Message.is_group == True, Message.group_id.in_(group_ids)),
+        ))
+        .order_by(Message.id.desc())
+    )
+
+
+def snippet(content: str, terms: List[str]) -> str:
+    """Фрагмент сообщения вокруг первого совпадения в HTML: текст экранирован, совпадения в <mark>.
+
+    Строится по тексту, уже загруженному со страницей, - повторный запрос к индексу
+    для каждого сообщения обходился бы дороже самого поиска.
+    """
+    prefix = terms[-1] if _is_prefix(terms[-1]) else None
+    words = list(_TERM_RE.finditer(content))
+
+    def matches(word: str) -> bool:
+        word = word.lower()
+        return word in terms or (prefix is not None and word.startswith(prefix))
+
+    first = next((n for n, word in enumerate(words) if matches(word.group())), 0)
+    start = max(0, first - SEARCH_SNIPPET_WORDS // 3)
+    window = words[start:start + SEARCH_SNIPPET_WORDS]
+    if not window:
+        return html.escape(content[:PREVIEW_LENGTH])
+    begin = 0 if start == 0 else window[0].start()
+    end = len(content) if start + SEARCH_SNIPPET_WORDS >= len(words) else window[-1].end()
+
+    parts = ["" if begin == 0 else "…"]
+    position = begin
+    for word in window:
+        parts.append(html.escape(content[position:word.start()]))
+        escaped = html.escape(word.group())
+        parts.append(f"<mark>{escaped}</mark>" if matches(word.group()) else escaped)
+        position = word.end()
+    parts.append(html.escape(content[position:end]))
+    parts.append("" if end == len(content) else "…")
+    return "".join(parts)
+
+
+def search_messages(db: Session, user_id: int, q: str, cursor: Optional[str], limit: int):
+    """Сообщения из чатов пользователя по словам запроса, от самых релевантных.
+
+    Учитываются личные переписки пользователя и группы, в которых он состоит,
+    ранжируются SEARCH_CANDIDATES самых свежих совпадений.
+    Страницы - keyset по (оценка, id). Возвращает ([(сообщение, фрагмент)], курсор).
+    """
+    terms = search_terms(q)
+    if not terms:
+        return [], None
+    candidates = _candidates(db, user_id, terms).limit(SEARCH_CANDIDATES).subquery()
+
+    query = db.query(Message, candidates.c.score).join(candidates, Message.id == candidates.c.id)
+    if cursor is not None:
+        score, message_id = decode_cursor(cursor)
+        query = query.filter(or_(
+            candidates.c.score > score,
+            and_(candidates.c.score == score, candidates.c.id > message_id)
+        ))
+    rows = query.order_by(candidates.c.score, candidates.c.id).limit(limit + 1).all()
+
+    next_cursor = encode_cursor(rows[limit - 1].score, rows[limit - 1][0].id) if len(rows) > limit else None
+    return [(msg, snippet(msg.content, terms)) for msg, score in rows[:limit]], next_cursor
@@ -0,0 +1,151 @@
+import bisect
+import os
+from array import array
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from .database import ReadSessionLocal, run_db
+from .models import User
+
+# Сколько кандидатов отдает индекс на один запрос (часть может отсеяться по is_active)
+USER_SEARCH_CANDIDATES = int(os.getenv("USER_SEARCH_CANDIDATES", "100"))
+# Сколько пользователей возвращает поиск
+USER_SEARCH_RESULTS = 20
+
+# Длины n-грамм: запрос из 2 символов берется из списка биграмм целиком,
+# длиннее - из самого короткого списка его триграмм с проверкой подстроки
+_GRAM_SIZES = (2, 3)
+
+
+def _grams(name: str):
+    return {name[i:i + size] for size in _GRAM_SIZES for i in range(len(name) - size + 1)}
+
+
+class UsernameIndex:
+    """Индекс логинов в памяти для поиска пользователей без прохода по таблице users.
+
+    Хранит логины в нижнем регистре: словарь id -> логин, отсортированный список
+    (точное совпадение и префикс через bisect) и списки id по 2- и 3-граммам
+    (вхождение подстроки). Загружается при старте, пополняется при регистрации.
+    """
+
+    def __init__(self, session_factory=ReadSessionLocal):
+        self.session_factory = session_factory
+        self._listeners: List[Callable[[int, str], None]] = []
+        self._pending: Optional[List[Tuple[int, str]]] = None
+        self._reset()
+
+    def _reset(self):
+        self._names: Dict[int, str] = {}
+        self._sorted_names: List[str] = []
+        self._sorted_ids = array("i")
+        self._grams: Dict[str, array] = {}
+
+    def add_listener(self, listener: Callable[[int, str], None]):
+        """Вызывается при каждом новом пользователе (например, для оповещения других воркеров)"""
+        self._listeners.append(listener)
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, user_id: int, username: str, notify: bool = True):
+        if self._pending is not None:
+            # Идет загрузка: добавим после замены индекса
+            self._pending.append((user_id, username))
+        else:
+            self._insert(user_id, username)
+        if notify:
+            for listener in self._listeners:
+                listener(user_id, username)
+
+    def _insert(self, user_id: int, username: str):
+        name = username.lower()
+        if user_id in self._names:
+            return
+        self._names[user_id] = name
+        position = bisect.bisect_right(self._sorted_names, name)
+        self._sorted_names.insert(position, name)
+        self._sorted_ids.insert(position, user_id)
+        for gram in _grams(name):
+            ids = self._grams.get(gram)
+            if ids is None:
+                ids = self._grams[gram] = array("i")
+            ids.append(user_id)
+
+    def build(self, rows: Iterable[Tuple[int, str]]):
+        """Заполнить индекс заново из пар (id, логин)"""
+        self._reset()
+        rows = sorted((username.lower(), user_id) for user_id, username in rows)
+        for name, user_id in rows:
+            self._names[user_id] = name
+            self._sorted_names.append(name)
+            self._sorted_ids.append(user_id)
+        # Списки n-грамм - по возрастанию id, как при добавлении новых пользователей
+        for user_id in sorted(self._names):
+            for gram in _grams(self._names[user_id]):
+                ids = self._grams.get(gram)
+                if ids is None:
+                    ids = self._grams[gram] = array("i")
+                ids.append(user_id)
+
+    async def load(self):
+        """Загрузить всех пользователей из БД (в пуле потоков)"""
+        self._pending = []
+        fresh = UsernameIndex(self.session_factory)
+        try:
+            # Строится отдельный индекс, текущий продолжает отвечать до замены
+            await run_db(lambda: fresh.build(self._read_all()))
+            self._take_over(fresh)
+        finally:
+            pending, self._pending = self._pending, None
+        for user_id, username in pending:
+            self._insert(user_id, username)
+
+    def _take_over(self, other: "UsernameIndex"):
+        self._names = other._names
+        self._sorted_names, self._sorted_ids = other._sorted_names, other._sorted_ids
+        self._grams = other._grams
+
+    def _read_all(self):
+        db = self.session_factory()
+        try:
+            return db.query(User.id, User.username).all()
+        finally:
+            db.close()
+
+    def search(self, q: str, limit: int = USER_SEARCH_CANDIDATES, exclude: Optional[int] = None) -> List[int]:
+        """id пользователей, чей логин содержит q (без учета регистра).
+
+        Сначала точное совпадение, затем начинающиеся с q по алфавиту,
+        затем содержащие q в середине по порядку регистрации.
+        """
+        q = q.lower()
+        found: List[int] = []
+        seen = set() if exclude is None else {exclude}
+
+        # Точное совпадение стоит первым среди начинающихся с q
+        position = bisect.bisect_left(self._sorted_names, q)
+        end = bisect.bisect_left(self._sorted_names, q + "\U0010ffff", position)
+        for user_id in self._sorted_ids[position:min(end, position + limit + 1)]:
+            if user_id not in seen:
+                seen.add(user_id)
+                found.append(user_id)
+        if len(found) >= limit or len(q) < _GRAM_SIZES[0]:
+            return found[:limit]
+
+        if len(q) in _GRAM_SIZES:
+            candidates = self._grams.get(q, ())
+        else:
+            lists = [self._grams.get(q[i:i + 3]) for i in range(len(q) - 2)]
+            if any(ids is None for ids in lists):
+                return found
+            names = self._names
+            candidates = [user_id for user_id in min(lists, key=len) if q in names[user_id]]
+        for user_id in candidates:
+            if user_id not in seen:
+                seen.add(user_id)
+                found.append(user_id)
+                if len(found) >= limit:
+                    break
+        return found
+
+
+username_index = UsernameIndex()
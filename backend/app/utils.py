@@ -1,5 +1,33 @@
-from datetime import datetime
-from typing import List, Dict, Any
+from datetime import date, datetime
+from typing import List, Dict, Any, Optional, Tuple
+from fastapi.responses import JSONResponse
+import json
+
+try:
+    import orjson
+except ImportError:  # без orjson работает медленнее, но с тем же результатом
+    orjson = None
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def json_dumps(data: Any) -> bytes:
+    """JSON в UTF-8 без пробелов; datetime - строкой ISO, как isoformat()"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=_json_default).encode()
+
+class FastJSONResponse(JSONResponse):
+    """Ответ, сериализованный одним проходом через orjson (без проверки response_model и jsonable_encoder)"""
+
+    def render(self, content: Any) -> bytes:
+        return json_dumps(content)
+
+def json_response(content: Dict[str, Any], status_code: int = 200) -> FastJSONResponse:
+    """Готовый ответ для больших списков: FastAPI вернет его как есть"""
+    return FastJSONResponse(content, status_code=status_code)
 
 def format_datetime(dt: datetime) -> str:
     """Форматирование даты и времени в строку ISO"""
@@ -21,7 +49,41 @@ def error_response(message: str, status_code: int = 400) -> Dict[str, Any]:
         "status_code": status_code
     }
 
-def paginate_query(query, page: int = 1, page_size: int = 20):
-    """Пагинация запроса к базе данных"""
-    offset = (page - 1) * page_size
-    return query.offset(offset).limit(page_size)
\ No newline at end of file
+# Размер страницы для keyset-пагинации
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+# Порция строк серверного курсора в потоковых ответах
+STREAM_CHUNK_SIZE = 1000
+
+def paginated_response(data: List[Any], next_cursor: Optional[int], message: str = "Success") -> Dict[str, Any]:
+    """Успешный ответ со страницей данных и курсором следующей страницы"""
+    response = success_response(data=data, message=message)
+    response["next_cursor"] = next_cursor
+    return response
+
+def paginate_keyset(query, id_column, before: Optional[int] = None, after: Optional[int] = None,
+                    limit: int = DEFAULT_PAGE_SIZE) -> Tuple[list, Optional[int]]:
+    """Keyset-пагинация по возрастающему id.
+
+    Без курсора и с before страницы идут от новых к старым, с after - от старых к новым.
+    Внутри страницы строки всегда в хронологическом порядке.
+    Возвращает (строки, курсор следующей страницы или None).
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    if after is not None:
+        rows = query.filter(id_column > after).order_by(id_column.asc()).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+    else:
+        if before is not None:
+            query = query.filter(id_column < before)
+        rows = query.order_by(id_column.desc()).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+    
+    next_cursor = None
+    if has_more and rows:
+        edge = rows[-1] if after is not None else rows[0]
+        next_cursor = getattr(edge, id_column.key)
+    return rows, next_cursor
@@ -1,26 +1,57 @@
 # webrtc.py
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 from .models import Call
+from .database import run_db
+from .connections import ConnectionHub
+from .changes import record_call
+from .log import get_logger
 import json
 from datetime import datetime
 
-async def handle_call_initiate(call_data: dict, initiator_id: int, db: Session, user_connections: dict):
+# Статусы звонков, которые еще идут (ожидают ответа или соединены)
+ACTIVE_CALL_STATUSES = ("pending", "accepted")
+
+log = get_logger("calls")
+
+def _get_call(db: Session, call_id: int):
+    return db.query(Call).filter(Call.id == call_id).first()
+
+def _update_call(db: Session, call: Call, **fields):
+    for name, value in fields.items():
+        setattr(call, name, value)
+    record_call(db, call)
+    db.commit()
+
+def count_active_calls(db: Session) -> dict:
+    """Число идущих звонков по статусам (по индексу ix_calls_status)"""
+    counts = dict.fromkeys(ACTIVE_CALL_STATUSES, 0)
+    rows = db.query(Call.status, func.count()).filter(Call.status.in_(ACTIVE_CALL_STATUSES)).group_by(Call.status)
+    counts.update(rows.all())
+    return counts
+
+async def handle_call_initiate(call_data: dict, initiator_id: int, db: Session, hub: ConnectionHub):
     receiver_id = call_data["receiver_id"]
     call_type = call_data.get("call_type", "audio")
 
-    new_call = Call(
-        initiator_id=initiator_id,
-        receiver_id=receiver_id,
-        call_type=call_type,
-        status='pending'
-    )
-    db.add(new_call)
-    db.commit()
-    db.refresh(new_call)
+    def create_call():
+        new_call = Call(
+            initiator_id=initiator_id,
+            receiver_id=receiver_id,
+            call_type=call_type,
+            status='pending'
+        )
+        db.add(new_call)
+        db.flush()
+        record_call(db, new_call)
+        db.commit()
+        return new_call
+
+    new_call = await run_db(create_call)
     
-    print(f"Call initiated: {new_call.id} from {initiator_id} to {receiver_id}")
+    log.info("call_initiated", call_id=new_call.id, initiator_id=initiator_id, receiver_id=receiver_id)
     
-    if receiver_id in user_connections:
+    if hub.is_online(receiver_id):
         notification = {
             "type": "incoming_call",
             "call_id": new_call.id,
@@ -28,98 +59,89 @@ async def handle_call_initiate(call_data: dict, initiator_id: int, db: Session,
             "call_type": call_type,
             "timestamp": datetime.utcnow().isoformat()
         }
-        await user_connections[receiver_id].send_json(notification)
+        await hub.send_to_user(receiver_id, notification)
     else:
-        new_call.status = 'missed'
-        db.commit()
+        await run_db(_update_call, db, new_call, status='missed')
 
-async def handle_call_offer(offer_data: dict, user_id: int, db: Session, user_connections: dict):
+async def handle_call_offer(offer_data: dict, user_id: int, db: Session, hub: ConnectionHub):
     call_id = offer_data["call_id"]
     sdp = offer_data["sdp"]
 
-    call = db.query(Call).filter(Call.id == call_id).first()
+    call = await run_db(_get_call, db, call_id)
     if not call:
-        print(f"⚠️ Call {call_id} not found for offer")
+        log.warning("offer_rejected", call_id=call_id, sender_id=user_id, reason="call not found")
         return
     
     receiver_id = call.receiver_id
 
-    if receiver_id in user_connections:
-        print(f"📤 Forwarding OFFER to user {receiver_id}")
-        await user_connections[receiver_id].send_json({
+    if hub.is_online(receiver_id):
+        await hub.send_to_user(receiver_id, {
             "type": "call_offer",
             "call_id": call_id,
             "sdp": sdp,
             "initiator_id": user_id
         })
+        log.info("offer_forwarded", call_id=call_id, sender_id=user_id, receiver_id=receiver_id)
     else:
-        print(f"Receiver {receiver_id} is offline, cannot send offer")
+        log.warning("offer_receiver_offline", call_id=call_id, sender_id=user_id, receiver_id=receiver_id)
 
-async def handle_call_response(response_data: dict, user_id: int, db: Session, user_connections: dict):
+async def handle_call_response(response_data: dict, user_id: int, db: Session, hub: ConnectionHub):
     call_id = response_data["call_id"]
     action = response_data["action"]  # 'accept' or 'decline'
     sdp = response_data.get("sdp")  # SDP answer если принято
     
-    call = db.query(Call).filter(Call.id == call_id).first()
+    call = await run_db(_get_call, db, call_id)
     if not call:
-        print(f"Call {call_id} not found for response")
+        log.warning("call_response_rejected", call_id=call_id, user_id=user_id, reason="call not found")
         return
     
     if action == "decline":
-        call.status = "declined"
-        db.commit()
-        print(f"Call {call_id} declined")
+        await run_db(_update_call, db, call, status="declined")
+        log.info("call_declined", call_id=call_id, user_id=user_id)
         
         # Уведомляем инициатора
-        if call.initiator_id in user_connections:
-            await user_connections[call.initiator_id].send_json({
-                "type": "call_declined",
-                "call_id": call_id
-            })
+        await hub.send_to_user(call.initiator_id, {
+            "type": "call_declined",
+            "call_id": call_id
+        })
             
     elif action == "accept":
-        call.status = "accepted"
-        call.ended_at = None
-        db.commit()
-        print(f"Call {call_id} accepted")
+        await run_db(_update_call, db, call, status="accepted", ended_at=None)
+        log.info("call_accepted", call_id=call_id, user_id=user_id, initiator_id=call.initiator_id)
         
         # Отправляем SDP Answer инициатору
-        if call.initiator_id in user_connections:
-            await user_connections[call.initiator_id].send_json({
-                "type": "call_accepted",
-                "call_id": call_id,
-                "sdp": sdp
-            })
+        await hub.send_to_user(call.initiator_id, {
+            "type": "call_accepted",
+            "call_id": call_id,
+            "sdp": sdp
+        })
 
-async def handle_ice_candidate(candidate_data: dict, user_id: int, db: Session, user_connections: dict):
+async def handle_ice_candidate(candidate_data: dict, user_id: int, db: Session, hub: ConnectionHub):
     """Пересылка ICE кандидатов"""
     call_id = candidate_data["call_id"]
     candidate = candidate_data["candidate"]
     target_user_id = candidate_data["target_user_id"]
     
-    if target_user_id in user_connections:
-        await user_connections[target_user_id].send_json({
+    if hub.is_online(target_user_id):
+        await hub.send_to_user(target_user_id, {
             "type": "ice_candidate",
             "call_id": call_id,
             "candidate": candidate,
             "sender_id": user_id
         })
     else:
-        print(f"Target user {target_user_id} not found for ICE candidate")
+        log.debug("ice_candidate_target_offline", call_id=call_id, sender_id=user_id, target_user_id=target_user_id)
 
-async def handle_call_end(call_data: dict, user_id: int, db: Session, user_connections: dict):
+async def handle_call_end(call_data: dict, user_id: int, db: Session, hub: ConnectionHub):
     call_id = call_data["call_id"]
     
-    call = db.query(Call).filter(Call.id == call_id).first()
+    call = await run_db(_get_call, db, call_id)
     if call:
-        call.status = "completed"
-        call.ended_at = datetime.utcnow()
-        db.commit()
+        await run_db(_update_call, db, call, status="completed", ended_at=datetime.utcnow())
         
         other_user_id = call.receiver_id if call.initiator_id == user_id else call.initiator_id
         
-        if other_user_id in user_connections:
-            await user_connections[other_user_id].send_json({
-                "type": "call_end",
-                "call_id": call_id
-            })
\ No newline at end of file
+        await hub.send_to_user(other_user_id, {
+            "type": "call_end",
+            "call_id": call_id
+        })
\ No newline at end of file
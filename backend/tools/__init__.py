@@ -0,0 +1 @@
+#Служебные скрипты: проверки и бенчмарки
\ No newline at end of file
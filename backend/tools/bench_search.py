@@ -0,0 +1,136 @@
+"""Бенчмарк поиска по сообщениям: индекс FTS5 против LIKE '%q%'.
+
+Запуск из каталога backend:
+    python -m tools.bench_search --messages 2000000
+
+Во временном каталоге создается SQLite база, заполняется перепиской
+(слова с частотой по закону Ципфа, личные чаты и группы), затем строится
+полнотекстовый индекс и для случайных пользователей выполняются запросы
+с редким, средним и частым словом - через search_messages и через LIKE
+по тем же чатам. Выводится время построения индекса и задержки p50/p99.
+"""
+import argparse
+import itertools
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+os.environ["DATABASE_URL"] = "sqlite:///./chat.db"
+os.chdir(tempfile.mkdtemp(prefix="chat-search-"))
+
+from sqlalchemy import and_, insert, or_, select
+from app.database import engine, ReadSessionLocal, init_db
+from app.models import User, Group, GroupMember, Message
+from app.search import create_search_index, search_messages
+
+VOCABULARY = 20000
+
+
+def make_words(rng):
+    letters = "абвгдежзиклмнопрстуфхэюя"
+    words = set()
+    while len(words) < VOCABULARY:
+        words.add("".join(rng.choice(letters) for _ in range(rng.randint(3, 9))))
+    return sorted(words)
+
+
+def seed(args, rng, words):
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(words))))
+    with engine.begin() as conn:
+        conn.execute(insert(User), [{"id": i, "username": f"user{i}", "hashed_password": "x"} for i in range(1, args.users + 1)])
+        conn.execute(insert(Group), [{"id": g, "name": f"group{g}", "creator_id": g} for g in range(1, args.groups + 1)])
+        conn.execute(insert(GroupMember), [
+            {"user_id": user_id, "group_id": g}
+            for g in range(1, args.groups + 1)
+            for user_id in rng.sample(range(1, args.users + 1), args.group_size)
+        ])
+    batch = []
+    for message_id in range(1, args.messages + 1):
+        sender = rng.randint(1, args.users)
+        is_group = rng.random() < 0.3
+        batch.append({
+            "id": message_id,
+            "sender_id": sender,
+            "receiver_id": rng.randint(1, args.users),
+            "content": " ".join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(3, 20))),
+            "is_group": is_group,
+            "group_id": rng.randint(1, args.groups) if is_group else None,
+        })
+        if len(batch) == 50000:
+            with engine.begin() as conn:
+                conn.execute(insert(Message), batch)
+            batch = []
+    if batch:
+        with engine.begin() as conn:
+            conn.execute(insert(Message), batch)
+
+
+def like_search(db, user_id, q, limit):
+    """Наивный поиск: подстрока по всем сообщениям пользователя"""
+    group_ids = select(GroupMember.group_id).where(GroupMember.user_id == user_id)
+    return db.query(Message).filter(
+        Message.content.like(f"%{q}%"),
+        or_(
+            and_(Message.is_group == False, or_(Message.sender_id == user_id, Message.receiver_id == user_id)),
+            and_(Message.is_group == True, Message.group_id.in_(group_ids)),
+        )
+    ).order_by(Message.id.desc()).limit(limit).all()
+
+
+def measure(fn, queries):
+    samples = []
+    for user_id, q in queries:
+        db = ReadSessionLocal()
+        try:
+            started = time.perf_counter()
+            fn(db, user_id, q)
+            samples.append((time.perf_counter() - started) * 1000)
+        finally:
+            db.close()
+    ordered = sorted(samples)
+    return statistics.median(ordered), ordered[min(len(ordered) - 1, int(0.99 * len(ordered)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2000000, help="сообщений в базе")
+    parser.add_argument("--users", type=int, default=5000, help="пользователей")
+    parser.add_argument("--groups", type=int, default=200, help="групп")
+    parser.add_argument("--group-size", type=int, default=30, help="участников в группе")
+    parser.add_argument("--queries", type=int, default=50, help="запросов каждого вида")
+    parser.add_argument("--limit", type=int, default=50, help="результатов на странице")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    words = make_words(rng)
+    init_db()
+
+    started = time.perf_counter()
+    seed(args, rng, words)
+    print(f"Заполнение: {args.messages} сообщений за {time.perf_counter() - started:.1f} с")
+    started = time.perf_counter()
+    create_search_index(engine)
+    print(f"Построение индекса FTS5: {time.perf_counter() - started:.1f} с")
+
+    kinds = {
+        "частое слово": words[:10],
+        "среднее слово": words[200:300],
+        "редкое слово": words[-1000:],
+        "два слова": [f"{a} {b}" for a, b in zip(words[:50], words[50:100])],
+    }
+    print(f"\n{'запрос':<16}{'FTS p50':>12}{'FTS p99':>12}{'LIKE p50':>12}{'LIKE p99':>12}")
+    for kind, terms in kinds.items():
+        queries = [(rng.randint(1, args.users), rng.choice(terms)) for _ in range(args.queries)]
+        fts = measure(lambda db, user_id, q: search_messages(db, user_id, q, None, args.limit), queries)
+        # LIKE ищет подстроку целиком, для двух слов берется первое
+        like = measure(lambda db, user_id, q: like_search(db, user_id, q.split()[0], args.limit), queries)
+        print(f"{kind:<16}{fts[0]:>10.1f}мс{fts[1]:>10.1f}мс{like[0]:>10.1f}мс{like[1]:>10.1f}мс")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Бенчмарк сериализации страницы истории: прежний путь FastAPI против json_response.
+
+Запуск из каталога backend:
+    python -m tools.bench_serialization --messages 10000
+
+Страница из --messages сообщений (объекты Message без БД) превращается в тело
+ответа тремя способами: как раньше (isoformat в message_to_dict, затем проверка
+response_model=dict и сериализация FastAPI), через stdlib json и через json_response
+(orjson, если установлен). Отдельно - JSON текст кадров WebSocket, как его строит
+рассылка (OutgoingFrame.text), против json.dumps. Выводятся задержки p50/p99.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+os.environ["DATABASE_URL"] = "sqlite:///./chat.db"
+os.chdir(tempfile.mkdtemp(prefix="chat-serialization-"))
+
+from fastapi.routing import serialize_response
+from fastapi.utils import create_model_field
+from app.main import message_to_dict
+from app.models import Message
+from app.protocol import OutgoingFrame
+from app.utils import paginated_response, json_response, orjson
+
+
+def make_messages(count):
+    started = datetime(2025, 1, 1)
+    return [
+        Message(id=(1 << 40) + i, sender_id=1 + i % 2, receiver_id=2 - i % 2,
+                content=f"Сообщение {i}: привет, как дела? Встречаемся в {i % 24}:00",
+                created_at=started + timedelta(seconds=i, microseconds=i), is_group=False, group_id=None)
+        for i in range(count)
+    ]
+
+
+def legacy_message_to_dict(msg, is_read):
+    """message_to_dict до json_response: время строкой isoformat"""
+    data = message_to_dict(msg, is_read)
+    data["created_at"] = msg.created_at.isoformat()
+    return data
+
+
+def measure(fn, runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    ordered = sorted(samples)
+    return statistics.median(ordered), ordered[min(len(ordered) - 1, int(0.99 * len(ordered)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=10000, help="сообщений на странице")
+    parser.add_argument("--runs", type=int, default=50, help="повторов каждого способа")
+    args = parser.parse_args()
+
+    messages = make_messages(args.messages)
+    field = create_model_field(name="Response", type_=dict, mode="serialization")
+    loop = asyncio.new_event_loop()
+
+    def fastapi_default():
+        content = paginated_response([legacy_message_to_dict(msg, True) for msg in messages], None)
+        return loop.run_until_complete(serialize_response(field=field, response_content=content, dump_json=True))
+
+    def stdlib_json():
+        content = paginated_response([legacy_message_to_dict(msg, True) for msg in messages], None)
+        return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+
+    def fast_path():
+        return json_response(paginated_response([message_to_dict(msg, True) for msg in messages], None)).body
+
+    assert json.loads(fastapi_default()) == json.loads(fast_path()), "ответы различаются"
+    print(f"Сериализатор json_response: {'orjson ' + orjson.__version__ if orjson else 'stdlib json'}")
+    print(f"\n{'история, ' + str(args.messages) + ' сообщений':<34}{'p50':>10}{'p99':>10}")
+    for name, fn in [
+        ("FastAPI response_model=dict", fastapi_default),
+        ("stdlib json.dumps", stdlib_json),
+        ("json_response", fast_path),
+    ]:
+        p50, p99 = measure(fn, args.runs)
+        print(f"{name:<34}{p50:>8.1f}мс{p99:>8.1f}мс")
+
+    frames = [
+        {"type": "message", "message_id": msg.id, "sender_id": msg.sender_id, "content": msg.content,
+         "created_at": msg.created_at.isoformat(), "is_group": False, "group_id": None}
+        for msg in messages
+    ]
+    print(f"\n{'кадры WebSocket, ' + str(len(frames)) + ' шт.':<34}{'p50':>10}{'p99':>10}")
+    for name, fn in [
+        ("json.dumps", lambda: [json.dumps(frame, separators=(",", ":"), ensure_ascii=False) for frame in frames]),
+        ("OutgoingFrame.text", lambda: [OutgoingFrame(frame).text for frame in frames]),
+    ]:
+        p50, p99 = measure(fn, args.runs)
+        print(f"{name:<34}{p50:>8.1f}мс{p99:>8.1f}мс")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""Бенчмарк SQLite: смешанная нагрузка чтения истории и записи сообщений.
+
+Запуск из каталога backend:
+    python -m tools.bench_sqlite_profile
+
+Для каждого профиля (SQLITE_PROFILE=compat - как было раньше, production - WAL,
+pragma и отдельный пул читателей) в отдельном процессе создается временная база,
+заполняется перепиской, а затем несколько потоков одновременно читают страницы
+истории и пишут новые сообщения. Выводится число операций в секунду, задержка
+чтения и количество ошибок "database is locked".
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_child(args):
+    """Один прогон в текущем каталоге с профилем из окружения"""
+    sys.path.insert(0, BACKEND_DIR)
+    from sqlalchemy import insert
+    from sqlalchemy.exc import OperationalError
+    from app.database import SessionLocal, ReadSessionLocal, init_db, SQLITE_PROFILE
+    from app.models import Message
+    from app.utils import paginate_keyset
+
+    init_db()
+    pairs = [(i, i + 1) for i in range(1, args.pairs * 2, 2)]
+    db = SessionLocal()
+    try:
+        db.execute(insert(Message), [
+            {"sender_id": a if n % 2 else b, "receiver_id": b if n % 2 else a,
+             "content": f"seed {n}", "is_read": True, "is_group": False}
+            for a, b in pairs for n in range(args.seed)
+        ])
+        db.commit()
+    finally:
+        db.close()
+
+    stop = threading.Event()
+    lock = threading.Lock()
+    result = {"reads": 0, "writes": 0, "read_errors": 0, "write_errors": 0, "read_ms": [], "write_ms": []}
+
+    def reader():
+        rng = random.Random()
+        while not stop.is_set():
+            a, b = rng.choice(pairs)
+            started = time.perf_counter()
+            session = ReadSessionLocal()
+            try:
+                query = session.query(Message).filter(
+                    ((Message.sender_id == a) & (Message.receiver_id == b)) |
+                    ((Message.sender_id == b) & (Message.receiver_id == a))
+                )
+                rows, _ = paginate_keyset(query, Message.id, None, None, 50)
+                [(row.id, row.content, row.created_at) for row in rows]
+                ok = True
+            except OperationalError:
+                ok = False
+            finally:
+                session.close()
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                if ok:
+                    result["reads"] += 1
+                    result["read_ms"].append(elapsed)
+                else:
+                    result["read_errors"] += 1
+
+    def writer():
+        rng = random.Random()
+        while not stop.is_set():
+            a, b = rng.choice(pairs)
+            started = time.perf_counter()
+            session = SessionLocal()
+            try:
+                session.add(Message(sender_id=a, receiver_id=b, content="bench", is_group=False))
+                session.commit()
+                ok = True
+            except OperationalError:
+                session.rollback()
+                ok = False
+            finally:
+                session.close()
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                if ok:
+                    result["writes"] += 1
+                    result["write_ms"].append(elapsed)
+                else:
+                    result["write_errors"] += 1
+
+    threads = [threading.Thread(target=reader) for _ in range(args.readers)]
+    threads += [threading.Thread(target=writer) for _ in range(args.writers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    def percentile(samples, q):
+        if not samples:
+            return 0.0
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    print(json.dumps({
+        "profile": SQLITE_PROFILE,
+        "reads_per_s": result["reads"] / args.seconds,
+        "writes_per_s": result["writes"] / args.seconds,
+        "read_p50_ms": statistics.median(result["read_ms"]) if result["read_ms"] else 0.0,
+        "read_p99_ms": percentile(result["read_ms"], 0.99),
+        "write_p99_ms": percentile(result["write_ms"], 0.99),
+        "errors": result["read_errors"] + result["write_errors"],
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=5, help="длительность нагрузки")
+    parser.add_argument("--readers", type=int, default=8, help="потоков чтения истории")
+    parser.add_argument("--writers", type=int, default=4, help="потоков записи сообщений")
+    parser.add_argument("--pairs", type=int, default=50, help="число переписок")
+    parser.add_argument("--seed", type=int, default=2000, help="сообщений в каждой переписке")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+
+    rows = []
+    for profile in ("compat", "production"):
+        print(f"Прогон: SQLITE_PROFILE={profile}")
+        workdir = tempfile.mkdtemp(prefix=f"chat-sqlite-{profile}-")
+        env = dict(os.environ, SQLITE_PROFILE=profile, PYTHONPATH=BACKEND_DIR)
+        output = subprocess.run(
+            [sys.executable, "-m", "tools.bench_sqlite_profile", "--child"] + sys.argv[1:],
+            cwd=workdir, env=env, capture_output=True, text=True, check=True,
+        ).stdout
+        rows.append(json.loads(output.strip().splitlines()[-1]))
+
+    columns = ["reads_per_s", "writes_per_s", "read_p50_ms", "read_p99_ms", "write_p99_ms", "errors"]
+    print(f"\n{'профиль':<12}" + "".join(f"{name:>14}" for name in columns))
+    for row in rows:
+        print(f"{row['profile']:<12}" + "".join(f"{row[name]:>14.1f}" for name in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Бенчмарк поиска пользователей: индекс логинов в памяти против ilike '%q%'.
+
+Запуск из каталога backend:
+    python -m tools.bench_user_search --users 1000000
+
+Во временном каталоге создается SQLite база с пользователями, по ней строится
+UsernameIndex (как при старте сервера), затем для разных видов запросов
+(точный логин, короткий и длинный префикс, подстрока, промах) измеряется
+задержка поиска по индексу и прежнего запроса ilike с LIMIT 20.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+os.environ["DATABASE_URL"] = "sqlite:///./chat.db"
+os.chdir(tempfile.mkdtemp(prefix="chat-users-"))
+
+from sqlalchemy import insert
+from app.database import engine, ReadSessionLocal, init_db
+from app.models import User
+from app.usernames import UsernameIndex
+
+SYLLABLES = ["al", "ex", "ma", "ri", "ko", "na", "dim", "ser", "gey", "an", "ton", "vi", "ka", "ole", "g", "lu", "pe", "tr"]
+
+
+def make_usernames(rng, count):
+    names = set()
+    while len(names) < count:
+        name = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+        if rng.random() < 0.6:
+            name += str(rng.randint(0, 9999))
+        names.add(name)
+    return list(names)
+
+
+def percentiles(samples):
+    ordered = sorted(samples)
+    return statistics.median(ordered), ordered[min(len(ordered) - 1, int(0.99 * len(ordered)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000000, help="пользователей в базе")
+    parser.add_argument("--queries", type=int, default=200, help="запросов каждого вида")
+    parser.add_argument("--like-queries", type=int, default=10, help="запросов ilike каждого вида")
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    usernames = make_usernames(rng, args.users)
+    init_db()
+    with engine.begin() as conn:
+        for start in range(0, len(usernames), 50000):
+            conn.execute(insert(User), [
+                {"username": name, "hashed_password": "x", "is_active": True}
+                for name in usernames[start:start + 50000]
+            ])
+
+    index = UsernameIndex()
+    started = time.perf_counter()
+    index.build(index._read_all())
+    print(f"Индекс: {len(index)} логинов за {time.perf_counter() - started:.1f} с")
+
+    kinds = {
+        "точный логин": lambda: rng.choice(usernames),
+        "префикс 2": lambda: rng.choice(usernames)[:2],
+        "префикс 5": lambda: rng.choice(usernames)[:5],
+        "подстрока 3": lambda: (lambda name: name[1:4])(rng.choice(usernames)),
+        "подстрока 6": lambda: (lambda name: name[2:8])(rng.choice(usernames)),
+        "нет совпадений": lambda: "zzq" + str(rng.randint(0, 999)),
+    }
+    print(f"\n{'запрос':<16}{'индекс p50':>14}{'индекс p99':>14}{'ilike p50':>14}{'ilike p99':>14}")
+    for kind, make_query in kinds.items():
+        queries = [make_query() for _ in range(args.queries)]
+        samples = []
+        for q in queries:
+            started = time.perf_counter()
+            index.search(q)
+            samples.append((time.perf_counter() - started) * 1000)
+        indexed = percentiles(samples)
+
+        samples = []
+        for q in queries[:args.like_queries]:
+            db = ReadSessionLocal()
+            try:
+                started = time.perf_counter()
+                db.query(User).filter(User.username.ilike(f"%{q}%"), User.is_active == True).limit(20).all()
+                samples.append((time.perf_counter() - started) * 1000)
+            finally:
+                db.close()
+        like = percentiles(samples)
+        print(f"{kind:<16}{indexed[0]:>12.3f}мс{indexed[1]:>12.3f}мс{like[0]:>12.1f}мс{like[1]:>12.1f}мс")
+
+
+if __name__ == "__main__":
+    main()
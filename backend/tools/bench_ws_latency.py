@@ -0,0 +1,227 @@
+"""Бенчмарк: задержка доставки сообщений по WebSocket во время медленных запросов истории.
+
+Запуск из каталога backend:
+    python -m tools.bench_ws_latency
+
+Скрипт заполняет временную базу, поднимает uvicorn отдельным процессом и меряет,
+сколько идет сообщение alice -> bob через WebSocket: сначала без нагрузки, затем
+пока параллельно выполняются тяжелые GET /messages/{id} (история с большим числом
+непрочитанных, которые помечаются прочитанными). Прогон делается дважды:
+DB_EXECUTOR_WORKERS=0 (запросы прямо в event loop, как было раньше) и с пулом потоков БД.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+
+import websockets
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def seed(path, readers, backlog):
+    """Пользователи alice, bob, peer, reader0..N и по backlog непрочитанных от peer каждому reader"""
+    env_cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        sys.path.insert(0, BACKEND_DIR)
+        from app.database import SessionLocal, init_db
+        from app.models import User
+
+        init_db()
+        db = SessionLocal()
+        try:
+            names = ["alice", "bob", "peer"] + [f"reader{i}" for i in range(readers)]
+            users = {}
+            for name in names:
+                user = User(username=name)
+                user.set_password("pw")
+                users[name] = user
+            db.add_all(users.values())
+            db.commit()
+            ids = {name: user.id for name, user in users.items()}
+        finally:
+            db.close()
+    finally:
+        os.chdir(env_cwd)
+
+    # Массовая вставка напрямую, ORM здесь только замедлит подготовку
+    conn = sqlite3.connect(os.path.join(path, "chat.db"))
+    with conn:
+        for i in range(readers):
+            conn.executemany(
+                "INSERT INTO messages (sender_id, receiver_id, content, is_read, created_at, is_group) "
+                "VALUES (?, ?, ?, 0, datetime('now'), 0)",
+                ((ids["peer"], ids[f"reader{i}"], f"backlog {n}") for n in range(backlog)),
+            )
+    conn.close()
+    return ids
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def http(method, url, data=None, token=None, form=False):
+    body = None
+    headers = {}
+    if data is not None:
+        if form:
+            body = urllib.parse.urlencode(data).encode()
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        else:
+            body = json.dumps(data).encode()
+            headers["Content-Type"] = "application/json"
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    request = urllib.request.Request(url, data=body, headers=headers, method=method)
+    with urllib.request.urlopen(request, timeout=120) as response:
+        return json.loads(response.read())
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server on port {port} did not start")
+
+
+def summary(samples):
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {
+        "p50": statistics.median(ordered),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "max": ordered[-1],
+    }
+
+
+async def measure_latency(base_ws, ids, count, interval):
+    """Задержка от отправки alice до получения bob, мс"""
+    samples = []
+    async with websockets.connect(f"{base_ws}/ws/{ids['alice']}") as alice, \
+            websockets.connect(f"{base_ws}/ws/{ids['bob']}") as bob:
+        for n in range(count):
+            started = time.perf_counter()
+            await alice.send(json.dumps({"type": "message", "receiver_id": ids["bob"], "content": f"ping {n}"}))
+            while True:
+                frame = json.loads(await bob.recv())
+                if frame.get("type") == "message" and frame.get("content") == f"ping {n}":
+                    break
+            samples.append((time.perf_counter() - started) * 1000)
+            await asyncio.sleep(interval)
+    return samples
+
+
+async def history_load(base_http, db_path, ids, tokens, stop):
+    """Тяжелые запросы истории: каждый раз заново делаем backlog непрочитанным"""
+    durations = []
+
+    def rearm(reader_id):
+        conn = sqlite3.connect(db_path, timeout=30)
+        with conn:
+            conn.execute("UPDATE messages SET is_read = 0 WHERE receiver_id = ?", (reader_id,))
+        conn.close()
+
+    async def worker(name):
+        while not stop.is_set():
+            await asyncio.to_thread(rearm, ids[name])
+            started = time.perf_counter()
+            await asyncio.to_thread(http, "GET", f"{base_http}/messages/{ids['peer']}?limit=50", token=tokens[name])
+            durations.append((time.perf_counter() - started) * 1000)
+
+    await asyncio.gather(*(worker(name) for name in tokens))
+    return durations
+
+
+async def run_mode(workdir, template, ids, readers, executor_workers, count, interval):
+    db_dir = tempfile.mkdtemp(prefix="bench-run-", dir=workdir)
+    db_path = os.path.join(db_dir, "chat.db")
+    shutil.copy(template, db_path)
+    port = free_port()
+    env = dict(os.environ, DB_EXECUTOR_WORKERS=str(executor_workers), PYTHONPATH=BACKEND_DIR)
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=db_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        await asyncio.to_thread(wait_for_port, port)
+        base_http = f"http://127.0.0.1:{port}"
+        base_ws = f"ws://127.0.0.1:{port}"
+        tokens = {}
+        for i in range(readers):
+            name = f"reader{i}"
+            data = await asyncio.to_thread(
+                http, "POST", f"{base_http}/login", {"username": name, "password": "pw"}, None, True
+            )
+            tokens[name] = data["data"]["access_token"]
+
+        idle = await measure_latency(base_ws, ids, count, interval)
+
+        stop = asyncio.Event()
+        load = asyncio.create_task(history_load(base_http, db_path, ids, tokens, stop))
+        await asyncio.sleep(0.5)
+        loaded = await measure_latency(base_ws, ids, count, interval)
+        stop.set()
+        durations = await load
+        return idle, loaded, durations
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=100, help="сообщений на замер")
+    parser.add_argument("--interval-ms", type=float, default=10, help="пауза между сообщениями")
+    parser.add_argument("--readers", type=int, default=2, help="параллельных запросов истории")
+    parser.add_argument("--backlog", type=int, default=10000, help="непрочитанных сообщений у каждого читателя")
+    parser.add_argument("--pool", type=int, default=int(os.getenv("DB_EXECUTOR_WORKERS", "8")),
+                        help="размер пула потоков БД для второго прогона")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="chat-bench-")
+    try:
+        seed_dir = os.path.join(workdir, "seed")
+        os.mkdir(seed_dir)
+        print(f"Заполнение базы: {args.readers} x {args.backlog} непрочитанных...")
+        ids = seed(seed_dir, args.readers, args.backlog)
+        template = os.path.join(seed_dir, "chat.db")
+
+        rows = []
+        for label, workers in (("без пула (в event loop)", 0), (f"пул потоков БД ({args.pool})", args.pool)):
+            print(f"Прогон: {label}")
+            idle, loaded, durations = asyncio.run(
+                run_mode(workdir, template, ids, args.readers, workers, args.messages, args.interval_ms / 1000)
+            )
+            rows.append((label, "без нагрузки", summary(idle)))
+            rows.append((label, "с историей", summary(loaded)))
+            if durations:
+                print(f"  запросов истории: {len(durations)}, среднее {statistics.mean(durations):.1f} мс")
+
+        print(f"\n{'режим':<28} {'нагрузка':<14} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}  (мс)")
+        for label, load, stats in rows:
+            print(f"{label:<28} {load:<14} " + " ".join(f"{stats[k]:>8.1f}" for k in ("p50", "p95", "p99", "max")))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""Бенчмарк подпротоколов WebSocket: JSON против MessagePack.
+
+Запуск из каталога backend:
+    python -m tools.bench_ws_protocol --messages 1000
+
+Два сценария из кадров в том виде, в каком их шлют клиент и сервер:
+установка звонка (call_initiate, incoming_call, SDP offer и answer, по 20 ICE
+кандидатов в каждую сторону, call_end) и пачка сообщений чата (--messages
+сообщений, каждому отвечает message_ack). Для каждого протокола выводятся
+байты на проводе (полезная нагрузка кадров), время кодирования и разбора всех
+кадров сценария (p50). Для MessagePack отдельно - перекодирование JSON кадра,
+пришедшего от брокера с другого воркера (локальная рассылка упаковывает словарь).
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from app.protocol import json_codec, msgpack, MsgpackCodec, OutgoingFrame
+
+
+def make_sdp(kind):
+    """SDP аудио и видео в духе браузерного offer/answer (~3 КБ)"""
+    lines = [
+        "v=0", "o=- 4611731400430051336 2 IN IP4 127.0.0.1", "s=-", "t=0 0",
+        "a=group:BUNDLE 0 1", "a=extmap-allow-mixed", "a=msid-semantic: WMS stream",
+    ]
+    for mid, media, codecs in (("0", "audio", (111, 63, 9, 0, 8, 13, 110, 126)),
+                               ("1", "video", (96, 97, 102, 103, 104, 105, 106, 107, 108, 109))):
+        lines += [
+            f"m={media} 9 UDP/TLS/RTP/SAVPF {' '.join(map(str, codecs))}",
+            "c=IN IP4 0.0.0.0", "a=rtcp:9 IN IP4 0.0.0.0",
+            "a=ice-ufrag:Xk3v", "a=ice-pwd:9dOqN4dYl1bW7nWf4a1Xg2Zr",
+            "a=ice-options:trickle",
+            "a=fingerprint:sha-256 4F:2A:9C:11:7B:DE:03:55:AA:10:6C:E2:91:3D:48:77:"
+            "B0:5E:C4:12:8F:6A:D3:29:71:0B:E8:44:93:5C:2F:A1",
+            f"a=setup:{'actpass' if kind == 'offer' else 'active'}", f"a=mid:{mid}",
+            "a=extmap:1 urn:ietf:params:rtp-hdrext:ssrc-audio-level",
+            "a=extmap:2 http://www.webrtc.org/experiments/rtp-hdrext/abs-send-time",
+            "a=extmap:3 http://www.ietf.org/id/draft-holmer-rmcat-transport-wide-cc-extensions-01",
+            "a=sendrecv", "a=msid:stream track-" + media, "a=rtcp-mux",
+        ]
+        for codec in codecs:
+            name = "opus/48000/2" if media == "audio" and codec == 111 else f"codec{codec}/90000"
+            lines += [f"a=rtpmap:{codec} {name}", f"a=rtcp-fb:{codec} transport-cc",
+                      f"a=fmtp:{codec} minptime=10;useinbandfec=1"]
+        lines.append(f"a=ssrc:{1000 + int(mid)} cname:4TOk42mSjXCkVIa6")
+    return {"type": kind, "sdp": "\r\n".join(lines) + "\r\n"}
+
+
+def make_candidate(n):
+    return {
+        "candidate": f"candidate:{842163049 + n} 1 udp {2122260223 - n} 192.168.1.{10 + n % 200} {50000 + n} "
+                     f"typ {'host' if n % 3 else 'srflx'} generation 0 ufrag Xk3v network-id 1",
+        "sdpMid": str(n % 2),
+        "sdpMLineIndex": n % 2,
+        "usernameFragment": "Xk3v",
+    }
+
+
+def call_setup_frames():
+    caller, callee, call_id = 101, 202, 5001
+    frames = [
+        {"type": "call_initiate", "receiver_id": callee, "call_type": "video"},
+        {"type": "call_initiated", "call_id": call_id, "receiver_id": callee, "call_type": "video"},
+        {"type": "incoming_call", "call_id": call_id, "initiator_id": caller, "initiator_name": "alice",
+         "call_type": "video", "timestamp": "2025-01-01T12:00:00.000123"},
+        {"type": "call_offer", "call_id": call_id, "target_user_id": callee, "sdp": make_sdp("offer")},
+        {"type": "call_offer", "call_id": call_id, "sender_id": caller, "sdp": make_sdp("offer")},
+        {"type": "call_response", "call_id": call_id, "action": "accept", "sdp": make_sdp("answer")},
+        {"type": "call_accepted", "call_id": call_id, "sdp": make_sdp("answer")},
+    ]
+    for n in range(20):
+        for sender, target in ((caller, callee), (callee, caller)):
+            frames.append({"type": "ice_candidate", "call_id": call_id, "target_user_id": target,
+                           "candidate": make_candidate(n + sender)})
+            frames.append({"type": "ice_candidate", "call_id": call_id, "sender_id": sender,
+                           "candidate": make_candidate(n + sender)})
+    frames.append({"type": "call_end", "call_id": call_id})
+    frames.append({"type": "call_end", "call_id": call_id, "sender_id": caller})
+    return frames
+
+
+def chat_burst_frames(count):
+    frames = []
+    for n in range(count):
+        message_id = (1 << 40) + n
+        content = f"Сообщение {n}: привет, как дела? Встречаемся в {n % 24}:00"
+        frames.append({"type": "message", "receiver_id": 202, "content": content, "ack": "persist",
+                       "client_id": f"c{n}"})
+        frames.append({"type": "message", "message_id": message_id, "sender_id": 101, "content": content,
+                       "created_at": f"2025-01-01T12:{n // 60 % 60:02d}:{n % 60:02d}.{n:06d}",
+                       "is_group": False, "group_id": None})
+        frames.append({"type": "message_ack", "client_id": f"c{n}", "message_id": message_id, "persisted": True})
+    return frames
+
+
+def measure(fn, runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def report(title, frames, runs):
+    json_payloads = [json_codec.encode(frame) for frame in frames]
+    json_bytes = sum(len(payload.encode()) for payload in json_payloads)
+    print(f"\n{title}: {len(frames)} кадров")
+    print(f"{'':<22}{'байт':>10}{'кодирование':>14}{'разбор':>10}")
+    print(f"{'JSON':<22}{json_bytes:>10}"
+          f"{measure(lambda: [json_codec.encode(frame) for frame in frames], runs):>12.2f}мс"
+          f"{measure(lambda: [json_codec.decode(payload) for payload in json_payloads], runs):>8.2f}мс")
+    if msgpack is None:
+        print("MessagePack: msgpack не установлен")
+        return
+    codec = MsgpackCodec()
+    packed = [codec.encode(frame) for frame in frames]
+    assert [codec.decode(payload) for payload in packed] == frames, "MessagePack искажает кадры"
+    packed_bytes = sum(len(payload) for payload in packed)
+    print(f"{'MessagePack':<22}{packed_bytes:>10}"
+          f"{measure(lambda: [codec.encode(frame) for frame in frames], runs):>12.2f}мс"
+          f"{measure(lambda: [codec.decode(payload) for payload in packed], runs):>8.2f}мс")
+
+    def transcode():
+        return [OutgoingFrame.from_text(payload).packed for payload in json_payloads]
+
+    print(f"{'  из кадра брокера':<22}{'':>10}{measure(transcode, runs):>12.2f}мс")
+    print(f"MessagePack меньше JSON на {100 * (1 - packed_bytes / json_bytes):.0f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1000, help="сообщений в пачке чата")
+    parser.add_argument("--runs", type=int, default=50, help="повторов каждого замера")
+    args = parser.parse_args()
+
+    print(f"msgpack: {msgpack.version if msgpack else 'не установлен'}")
+    report("Установка звонка", call_setup_frames(), args.runs)
+    report(f"Пачка чата, {args.messages} сообщений", chat_burst_frames(args.messages), args.runs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Проверка бюджетов SQL-запросов: число запросов эндпоинта не должно расти с данными.
+
+Запуск из каталога backend:
+    python -m tools.check_query_budgets
+
+Скрипт поднимает приложение на временной SQLite базе, дает пользователю
+десятки друзей, входящих заявок, групп с участниками и сообщений, затем
+вызывает эндпоинты из BUDGETS и считает выполненные SQL-запросы. Каждый
+эндпоинт вызывается дважды, считается второй вызов (кэш токенов и состава
+групп уже прогрет). Код возврата 1, если какой-то эндпоинт превысил бюджет:
+обычно это значит, что в нем появился запрос на каждую строку (N+1).
+"""
+import os
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+os.environ["DATABASE_URL"] = "sqlite:///./chat.db"
+os.chdir(tempfile.mkdtemp(prefix="chat-budgets-"))
+
+from sqlalchemy import event
+from fastapi.testclient import TestClient
+from app.main import app
+from app.database import engine, read_engine, SessionLocal
+from app.models import User, Group, GroupMember, Friendship, Message
+from app.persistence import id_generator
+from app.conversations import backfill_summaries
+from app.usernames import username_index
+
+# Сколько строк каждого вида получает проверяемый пользователь
+ROWS = 25
+
+# Бюджет запросов на один вызов эндпоинта
+BUDGETS = {
+    "GET /friends": 1,
+    "GET /friends/requests": 1,
+    "GET /groups": 1,
+    "GET /groups/{id}": 3,
+    "GET /groups/{id}/members": 1,
+    "GET /groups/{id}/messages": 3,
+    "GET /messages/{id}": 2,
+    "GET /messages/search": 2,
+    "GET /conversations": 3,
+    "GET /sync": 4,
+    "GET /users": 1,
+    "GET /users/search": 1,
+}
+
+statements = []
+
+
+def count(conn, cursor, statement, parameters, context, executemany):
+    statements.append(statement)
+
+
+def seed(alice_id):
+    """Друзья, заявки, группы и переписка пользователя alice"""
+    db = SessionLocal()
+    try:
+        others = [User(username=f"budget{i}", hashed_password="x") for i in range(ROWS * 3)]
+        db.add_all(others)
+        db.commit()
+        ids = [user.id for user in others]
+        # Дружба в обе стороны хранения и входящие заявки
+        db.add_all(
+            Friendship(user_id=alice_id, friend_id=ids[i], status="accepted") if i % 2
+            else Friendship(user_id=ids[i], friend_id=alice_id, status="accepted")
+            for i in range(ROWS)
+        )
+        db.add_all(Friendship(user_id=ids[ROWS + i], friend_id=alice_id, status="pending") for i in range(ROWS))
+        groups = [Group(name=f"budget group {i}", creator_id=alice_id) for i in range(ROWS)]
+        db.add_all(groups)
+        db.commit()
+        for group in groups:
+            db.add(GroupMember(user_id=alice_id, group_id=group.id, is_admin=True))
+            db.add_all(GroupMember(user_id=ids[(group.id + k) % len(ids)], group_id=group.id) for k in range(ROWS))
+        db.add_all(
+            Message(id=id_generator.next_id(), sender_id=ids[i % ROWS] if i % 2 else alice_id,
+                    receiver_id=alice_id if i % 2 else ids[i % ROWS], content=f"budget message {i}")
+            for i in range(ROWS * 4)
+        )
+        db.add_all(
+            Message(id=id_generator.next_id(), sender_id=ids[0], receiver_id=alice_id, content=f"budget group {i}",
+                    is_group=True, group_id=groups[0].id)
+            for i in range(ROWS)
+        )
+        db.commit()
+        # Список чатов и индекс логинов обычно пополняются при записи сообщений и регистрации
+        backfill_summaries(db)
+        for user in others:
+            username_index.add(user.id, user.username, notify=False)
+        return ids[0], groups[0].id
+    finally:
+        db.close()
+
+
+def main():
+    failures = []
+    with TestClient(app) as client:
+        client.post("/register", json={"username": "budget_alice", "password": "pw"})
+        data = client.post("/login", data={"username": "budget_alice", "password": "pw"}).json()["data"]
+        headers = {"Authorization": f"Bearer {data['access_token']}"}
+        peer_id, group_id = seed(data["user_id"])
+        sync = client.get("/sync", headers=headers).json()["data"]["cursor"] - (1 << 40)
+
+        urls = {
+            "GET /friends": "/friends",
+            "GET /friends/requests": "/friends/requests",
+            "GET /groups": "/groups",
+            "GET /groups/{id}": f"/groups/{group_id}",
+            "GET /groups/{id}/members": f"/groups/{group_id}/members",
+            "GET /groups/{id}/messages": f"/groups/{group_id}/messages",
+            "GET /messages/{id}": f"/messages/{peer_id}",
+            "GET /messages/search": "/messages/search?q=budget",
+            "GET /conversations": "/conversations",
+            "GET /sync": f"/sync?since={sync}",
+            "GET /users": "/users",
+            "GET /users/search": "/users/search?q=budget",
+        }
+        engines = {engine, read_engine}
+        for target in engines:
+            event.listen(target, "before_cursor_execute", count)
+        try:
+            for name, url in urls.items():
+                client.get(url, headers=headers)
+                statements.clear()
+                response = client.get(url, headers=headers)
+                used = len(statements)
+                budget = BUDGETS[name]
+                ok = response.status_code == 200 and used <= budget
+                data = response.json()["data"]
+                rows = f", строк: {len(data)}" if isinstance(data, list) else ""
+                print(f"{'✅' if ok else '❌'} {name:<28} запросов: {used:>2} (бюджет {budget}){rows}")
+                if not ok:
+                    failures.append(name)
+                    for statement in statements:
+                        print(f"     {' '.join(statement.split())[:160]}")
+        finally:
+            for target in engines:
+                event.remove(target, "before_cursor_execute", count)
+
+    if failures:
+        print(f"\nПревышен бюджет запросов: {', '.join(failures)}")
+        return 1
+    print("\n✅ Все эндпоинты укладываются в бюджет запросов")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,309 @@
+"""Проверка планов запросов: горячие запросы не должны сканировать таблицы целиком.
+
+Запуск из каталога backend:
+    python -m tools.check_query_plans
+
+Скрипт поднимает приложение на временной SQLite базе, заполняет ее данными,
+прогоняет REST и WebSocket сценарии из main.py, а также обработчики chat.py
+и webrtc.py, перехватывает все SELECT/UPDATE/DELETE и выполняет для каждого
+EXPLAIN QUERY PLAN. Код возврата 1, если какой-то запрос делает SCAN таблицы.
+"""
+import asyncio
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+# EXPLAIN QUERY PLAN есть только у SQLite - работаем с ./chat.db во временном каталоге
+os.environ["DATABASE_URL"] = "sqlite:///./chat.db"
+os.chdir(tempfile.mkdtemp(prefix="chat-plans-"))
+
+from sqlalchemy import event
+from fastapi.testclient import TestClient
+from app.main import app
+from app.database import engine, read_engine, SessionLocal
+from app.models import User, Message, Group, GroupMember, Friendship, Call
+from app.connections import Connection, ConnectionHub
+from app import chat, webrtc
+from app.persistence import id_for_time
+
+SEED_USERS = 300
+SEED_MESSAGES = 20000
+
+# Шаги, которым полный проход по таблице разрешен по смыслу запроса
+ALLOWED_SCANS = {
+    "shutdown",             # сброс is_active у всех пользователей
+}
+
+# Виртуальная таблица FTS5 с индексом M - поиск по полнотекстовому индексу, а не перебор;
+# anon_N - подзапрос SQLAlchemy с LIMIT (его строки уже отобраны по индексу), а не таблица
+SCAN_RE = re.compile(r"^SCAN (?!anon_)(\w+)$|^SCAN (?!anon_)(\w+) (?!USING|VIRTUAL TABLE INDEX \d+:M)")
+
+captured = []
+current_step = "startup"
+
+
+def capture(conn, cursor, statement, parameters, context, executemany):
+    if executemany:
+        return
+    verb = statement.lstrip().split(None, 1)[0].upper()
+    if verb in ("SELECT", "UPDATE", "DELETE"):
+        captured.append((current_step, statement, parameters))
+
+
+def step(name):
+    global current_step
+    current_step = name
+
+
+def seed():
+    """Заполнение базы, чтобы планы строились на непустых таблицах"""
+    db = SessionLocal()
+    try:
+        users = []
+        for i in range(SEED_USERS):
+            user = User(username=f"seed{i}")
+            user.hashed_password = "x"
+            users.append(user)
+        db.add_all(users)
+        db.commit()
+        ids = [u.id for u in users]
+        groups = [Group(name=f"group{i}", creator_id=ids[i]) for i in range(20)]
+        db.add_all(groups)
+        db.commit()
+        db.add_all(GroupMember(user_id=ids[(g.id * 7 + k) % len(ids)], group_id=g.id) for g in groups for k in range(15))
+        db.add_all(Friendship(user_id=ids[i], friend_id=ids[(i + 1) % len(ids)], status="accepted") for i in range(len(ids)))
+        db.add_all(
+            Message(
+                sender_id=ids[i % len(ids)],
+                receiver_id=ids[(i * 31 + 1) % len(ids)],
+                content=f"seed message {i}",
+                is_group=(i % 5 == 0),
+                group_id=groups[i % len(groups)].id if i % 5 == 0 else None,
+            )
+            for i in range(SEED_MESSAGES)
+        )
+        db.add_all(Call(initiator_id=ids[i], receiver_id=ids[-i - 1], call_type="audio") for i in range(50))
+        db.commit()
+    finally:
+        db.close()
+
+
+class RecordingSocket:
+    """Заглушка WebSocket для прямого вызова обработчиков chat.py и webrtc.py"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_text(self, text):
+        self.sent.append(json.loads(text))
+
+
+def send_frame(websocket, user_id, frame):
+    """Отправить кадр и дождаться его обработки, чтобы запросы попали под свой шаг"""
+    step(f"ws {frame['type']}")
+    websocket.send_text(json.dumps(frame))
+    wait_processed(websocket, user_id)
+
+
+def wait_processed(websocket, user_id):
+    """Дождаться обработки всех ранее отправленных кадров этого соединения"""
+    websocket.send_text(json.dumps({
+        "type": "message", "receiver_id": user_id, "content": "sync", "ack": "persist", "client_id": "sync"
+    }))
+    while True:
+        frame = websocket.receive_json()
+        if frame.get("type") == "message_ack" and frame.get("client_id") == "sync":
+            return
+
+
+def run_scenarios():
+    with TestClient(app) as client:
+        def register(username):
+            step("POST /register")
+            client.post("/register", json={"username": username, "password": "pw"})
+            step("POST /login")
+            data = client.post("/login", data={"username": username, "password": "pw"}).json()["data"]
+            return data["user_id"], {"Authorization": f"Bearer {data['access_token']}"}
+
+        alice, ha = register("alice")
+        bob, hb = register("bob")
+        carol, hc = register("carol")
+
+        step("GET /users/search")
+        client.get("/users/search?q=seed", headers=ha)
+        step("GET /users")
+        client.get("/users", headers=ha)
+        client.get("/users?after=100&limit=10", headers=ha)
+        client.get("/users?stream=true", headers=ha)
+        step("POST /friends/add")
+        client.post("/friends/add", headers=ha, json={"friend_id": bob})
+        step("GET /friends/requests")
+        requests = client.get("/friends/requests", headers=hb).json()["data"]
+        step("POST /friends/accept")
+        for req in requests:
+            client.post(f"/friends/accept/{req['friendship_id']}", headers=hb)
+        step("GET /friends")
+        client.get("/friends", headers=ha)
+
+        step("POST /groups/create")
+        group_id = client.post("/groups/create", headers=ha, json={"name": "plans", "members": ["bob"]}).json()["data"]["group_id"]
+
+        step("ws connect")
+        with client.websocket_connect(f"/ws/{alice}") as wa, client.websocket_connect(f"/ws/{bob}") as wb:
+            for frame in [
+                {"type": "message", "receiver_id": bob, "content": "hello"},
+                {"type": "message", "receiver_id": carol, "content": "offline"},
+                {"type": "message", "receiver_id": bob, "content": "group", "is_group": True, "group_id": group_id},
+            ]:
+                send_frame(wa, alice, frame)
+            step("ws call_initiate")
+            wa.send_text(json.dumps({"type": "call_initiate", "receiver_id": bob, "call_type": "audio"}))
+            call_id = None
+            while call_id is None:
+                msg = wa.receive_json()
+                if msg.get("type") == "call_initiated":
+                    call_id = msg["call_id"]
+            for frame in [
+                {"type": "call_offer", "call_id": call_id, "sdp": {"type": "offer", "sdp": "v=0"}},
+                {"type": "ice_candidate", "call_id": call_id, "candidate": {}, "target_user_id": bob},
+                {"type": "call_end", "call_id": call_id},
+                {"type": "friend_request", "target_user_id": carol},
+                {"type": "group_invite", "group_id": group_id, "user_login": "carol"},
+                {"type": "remove_from_group", "group_id": group_id, "user_id": carol},
+            ]:
+                send_frame(wa, alice, frame)
+            for frame in [
+                {"type": "call_response", "call_id": call_id, "action": "accept", "sdp": {}},
+                {"type": "call_response", "call_id": call_id, "action": "decline"},
+                {"type": "mark_read", "peer_id": alice, "message_id": 1 << 40},
+                {"type": "mark_read", "group_id": group_id, "message_id": 1 << 40},
+            ]:
+                send_frame(wb, bob, frame)
+
+        for name, url in [
+            ("GET /messages/{id}", f"/messages/{bob}"),
+            ("GET /messages/{id}", f"/messages/{bob}?before=999999999999999"),
+            ("GET /groups/{id}/messages", f"/groups/{group_id}/messages"),
+            ("GET /messages/search", "/messages/search?q=seed+mess"),
+            ("GET /messages/search", "/messages/search?q=hello&limit=1&cursor=-1.0:1"),
+            ("GET /sync", "/sync"),
+            ("GET /sync", f"/sync?since={id_for_time(time.time() - 3600)}"),
+            ("GET /conversations", "/conversations"),
+            ("GET /conversations", "/conversations?before=999999999999999&limit=1"),
+            ("GET /groups", "/groups"),
+            ("GET /groups/{id}", f"/groups/{group_id}"),
+            ("GET /groups/{id}/members", f"/groups/{group_id}/members"),
+            ("GET /metrics", "/metrics"),
+        ]:
+            step(name)
+            client.get(url, headers=ha)
+
+        step("POST /groups/{id}/members")
+        client.post(f"/groups/{group_id}/members", headers=ha, json={"user_login": "carol"})
+        step("DELETE /groups/{id}/members/{id}")
+        client.delete(f"/groups/{group_id}/members/{carol}", headers=ha)
+        step("POST /groups/{id}/leave")
+        client.post(f"/groups/{group_id}/leave", headers=hb)
+        step("DELETE /groups/{id}")
+        client.delete(f"/groups/{group_id}", headers=ha)
+        step("DELETE /friends/{id}")
+        client.delete(f"/friends/{bob}", headers=ha)
+
+        step("ws connect")
+        with client.websocket_connect(f"/ws/{alice}") as wa:
+            group_id = client.post("/groups/create", headers=ha, json={"name": "ws"}).json()["data"]["group_id"]
+            for frame in [
+                {"type": "leave_group", "group_id": group_id},
+                {"type": "delete_group", "group_id": group_id},
+            ]:
+                send_frame(wa, alice, frame)
+
+        step("shutdown")
+    run_module_handlers(alice, bob)
+
+
+def run_module_handlers(alice, bob):
+    """Обработчики chat.py и webrtc.py, которые не подключены к main.py"""
+    async def scenario():
+        hub = ConnectionHub()
+        sockets = {}
+        for user_id in (alice, bob):
+            sockets[user_id] = RecordingSocket()
+            connection = Connection(sockets[user_id], user_id)
+            connection.start()
+            hub.register(connection)
+        db = SessionLocal()
+        try:
+            step("chat.handle_message")
+            persisted = await chat.handle_message({"receiver_id": bob, "content": "chat"}, alice, db, hub)
+            await persisted
+            step("chat.deliver_offline_messages")
+            await chat.deliver_offline_messages(hub.sessions(bob)[0], db, 1 << 62)
+            step("webrtc.handle_call_initiate")
+            await webrtc.handle_call_initiate({"receiver_id": bob}, alice, db, hub)
+            await asyncio.sleep(0.01)
+            call_id = sockets[bob].sent[-1]["call_id"]
+            for name, handler, data in [
+                ("webrtc.handle_call_offer", webrtc.handle_call_offer, {"call_id": call_id, "sdp": {}}),
+                ("webrtc.handle_call_response", webrtc.handle_call_response, {"call_id": call_id, "action": "accept"}),
+                ("webrtc.handle_ice_candidate", webrtc.handle_ice_candidate, {"call_id": call_id, "candidate": {}, "target_user_id": bob}),
+                ("webrtc.handle_call_end", webrtc.handle_call_end, {"call_id": call_id}),
+            ]:
+                step(name)
+                await handler(data, alice, db, hub)
+        finally:
+            db.close()
+            for connection in hub.connections():
+                await connection.close()
+        from app.persistence import message_writer
+        await message_writer.stop()
+
+    asyncio.run(scenario())
+
+
+def explain(statement, parameters):
+    with engine.connect() as conn:
+        rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+    return [row[-1] for row in rows]
+
+
+def main():
+    seed()
+    # Чтения идут через пул читателей, записи - через писателя
+    engines = {engine, read_engine}
+    for target in engines:
+        event.listen(target, "before_cursor_execute", capture)
+    try:
+        run_scenarios()
+    finally:
+        for target in engines:
+            event.remove(target, "before_cursor_execute", capture)
+
+    failures = []
+    checked = set()
+    for step_name, statement, parameters in captured:
+        if (step_name, statement) in checked:
+            continue
+        checked.add((step_name, statement))
+        for detail in explain(statement, parameters):
+            match = SCAN_RE.match(detail)
+            if match and step_name not in ALLOWED_SCANS:
+                failures.append((step_name, detail, statement))
+
+    print(f"Проверено запросов: {len(checked)}")
+    for step_name, detail, statement in failures:
+        print(f"\n❌ {step_name}: {detail}\n   {' '.join(statement.split())}")
+    if failures:
+        print(f"\nПолных сканирований таблиц: {len(failures)}")
+        return 1
+    print("✅ Полных сканирований таблиц нет")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())